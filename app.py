@@ -1,15 +1,31 @@
 import streamlit as st
-import openai
-import json
 import sys
 import os
+import time
+import uuid
+
+# Inizio del rerun, per misurare il tempo di esecuzione della pagina
+SCRIPT_STARTED = time.perf_counter()
 
 # Aggiungi la directory corrente al path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 try:
     from newsletter_generator import NewsletterGenerator
-    from utils import validate_inputs, format_output
+    from utils import validate_inputs, format_output, build_newsletter_data
+    from cache import ResponseCache
+    from clients import ClientRegistry, api_key_fingerprint
+    from scheduler import RequestScheduler
+    from cascade import ModelCascade
+    from circuit_breaker import CIRCUIT_CLOSED, CircuitBreaker
+    from brand_store import BrandProfileStore
+    from usage import UsageTracker
+    from sections import section_label
+    from similarity_cache import SimilarityCache
+    from singleflight import SingleFlight
+    from telemetry import Telemetry, configure_logging
+    from email_renderer import newsletter_html
+    from jobs import JOB_DONE, JOB_FAILED, JOB_QUEUED, JOB_RUNNING, JobQueue, newsletter_job
 except ImportError as e:
     st.error(f"Errore nell'importazione dei moduli: {e}")
     st.info("Assicurati che tutti i file Python siano nella stessa directory del progetto")
@@ -23,6 +39,121 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+@st.cache_resource
+def get_response_cache() -> ResponseCache:
+    """Cache delle risposte condivisa tra sessioni e rerun"""
+    return ResponseCache()
+
+@st.cache_resource
+def get_client_registry() -> ClientRegistry:
+    """Client OpenAI condivisi tra sessioni e rerun, con pool di connessioni keep-alive"""
+    return ClientRegistry()
+
+@st.cache_resource
+def get_scheduler(key_fingerprint: str) -> RequestScheduler:
+    """Scheduler condiviso per API key: i limiti di richieste e token sono per account"""
+    return RequestScheduler()
+
+@st.cache_resource
+def get_model_cascade() -> ModelCascade:
+    """Cascata GPT-4 -> GPT-3.5 condivisa, così le latenze osservate guidano l'hedging"""
+    return ModelCascade()
+
+@st.cache_resource
+def get_circuit_breaker() -> CircuitBreaker:
+    """Circuito condiviso: un disservizio del provider riguarda tutte le sessioni"""
+    return CircuitBreaker()
+
+@st.cache_resource
+def get_single_flight() -> SingleFlight:
+    """Generazioni in corso condivise tra sessioni: richieste identiche contemporanee ne fanno una sola"""
+    return SingleFlight()
+
+@st.cache_resource
+def get_telemetry() -> Telemetry:
+    """Tempi per fase, token e costi di tutte le sessioni; log JSON e metriche Prometheus opzionali"""
+    configure_logging(os.environ.get("NEWSLETTER_LOG_LEVEL", "INFO"))
+    telemetry = Telemetry(metrics_path=os.environ.get("NEWSLETTER_METRICS_FILE"))
+    if os.environ.get("NEWSLETTER_METRICS_PORT"):
+        telemetry.serve_metrics(int(os.environ["NEWSLETTER_METRICS_PORT"]))
+    return telemetry
+
+@st.cache_resource
+def get_brand_store() -> BrandProfileStore:
+    """Profili dei brand ricorrenti, con la descrizione già riassunta"""
+    return BrandProfileStore()
+
+@st.cache_resource
+def get_usage_tracker() -> UsageTracker:
+    """Token consumati e token di prompt serviti dalla cache del provider"""
+    return UsageTracker()
+
+@st.cache_resource
+def get_similarity_cache() -> SimilarityCache:
+    """Indice delle richieste già generate, per proporre bozze da richieste quasi identiche"""
+    return SimilarityCache()
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    """Coda di generazione condivisa: i job proseguono anche durante i rerun della pagina"""
+    return JobQueue()
+
+def show_generation_error(error):
+    """Messaggio di errore della generazione con i suggerimenti per i casi più comuni"""
+    if not error:
+        st.error("❌ Errore nella generazione della newsletter.")
+        st.info("💡 Possibili soluzioni:")
+        st.write("- Verifica che la tua API Key sia corretta")
+        st.write("- Controlla di avere crediti disponibili nel tuo account OpenAI")
+        st.write("- Prova a semplificare il brief del contenuto")
+        st.write("- Riprova tra qualche minuto")
+        return
+    
+    st.error(f"❌ Errore dettagliato: {error}")
+    
+    # Suggerimenti specifici per errori comuni
+    error_str = error.lower()
+    if "api" in error_str or "key" in error_str:
+        st.warning("🔑 Problema con l'API Key:")
+        st.write("- Verifica che l'API Key sia corretta")
+        st.write("- Assicurati di non aver raggiunto i limiti di utilizzo")
+    elif "model" in error_str:
+        st.warning("🤖 Problema con il modello AI:")
+        st.write("- Il modello GPT-4 potrebbe non essere disponibile")
+        st.write("- Prova di nuovo, l'app userà automaticamente GPT-3.5 come backup")
+    elif "quota" in error_str or "limit" in error_str:
+        st.warning("💳 Limite raggiunto:")
+        st.write("- Hai raggiunto il limite di utilizzo del tuo account OpenAI")
+        st.write("- Controlla il tuo piano su platform.openai.com")
+    else:
+        st.info("🔄 Prova queste soluzioni:")
+        st.write("- Ricarica la pagina e riprova")
+        st.write("- Semplifica il contenuto richiesto")
+        st.write("- Verifica la connessione internet")
+
+def record_timing(kind: str, started: float) -> None:
+    """Registra la durata di un rerun (pagina intera o frammento) per il riepilogo nella barra laterale"""
+    samples = st.session_state.setdefault("rerun_timings", {}).setdefault(kind, [])
+    samples.append(time.perf_counter() - started)
+    del samples[:-50]
+
+response_cache = get_response_cache()
+telemetry = get_telemetry()
+client_registry = get_client_registry()
+job_queue = get_job_queue()
+
+# Sessione nell'URL: ricaricando la pagina si ritrovano il job in corso e l'ultimo risultato
+session_id = st.query_params.get("session")
+if not session_id:
+    session_id = uuid.uuid4().hex
+    st.query_params["session"] = session_id
+if "job_id" not in st.session_state and "newsletter" not in st.session_state:
+    for previous_job in job_queue.list_jobs(session_id, limit=1):
+        if previous_job["status"] in (JOB_QUEUED, JOB_RUNNING):
+            st.session_state["job_id"] = previous_job["id"]
+        elif previous_job["status"] == JOB_DONE and previous_job["result"]:
+            st.session_state["newsletter"] = previous_job["result"]
+
 # Titolo principale
 st.title("📧 Newsletter AI Generator")
 st.markdown("Genera newsletter ottimizzate con intelligenza artificiale")
@@ -36,222 +167,426 @@ api_key = st.sidebar.text_input(
 )
 
 if api_key:
-    openai.api_key = api_key
     st.sidebar.success("✅ API Key configurata")
+    scheduler = get_scheduler(api_key_fingerprint(api_key))
+    scheduler_metrics = scheduler.metrics()
+    st.sidebar.caption(
+        f"Richieste in coda: {scheduler_metrics['queue_depth']} · "
+        f"in corso: {scheduler_metrics['in_flight']} · "
+        f"nuovi tentativi: {scheduler_metrics['retries']}"
+    )
 else:
     st.sidebar.warning("⚠️ Inserisci la tua API Key per continuare")
 
+# Modalità di generazione
+st.sidebar.header("⚙️ Generazione")
+pipeline_mode = st.sidebar.checkbox(
+    "Oggetti e contenuto in parallelo",
+    help="Genera oggetti e anteprime con un modello veloce mentre il contenuto viene scritto da GPT-4"
+)
+job_stats = job_queue.stats()
+st.sidebar.caption(
+    f"Generazioni in coda: {job_stats['queued']} · in corso: {job_stats['running']} "
+    f"(worker: {job_stats['workers']})"
+)
+flight_stats = get_single_flight().stats()
+if flight_stats["collapsed"]:
+    st.sidebar.caption(
+        f"Richieste identiche unite: {flight_stats['collapsed']} su {flight_stats['calls']} "
+        f"({flight_stats['collapse_rate']:.0%})"
+    )
+circuit_stats = get_circuit_breaker().stats()
+if circuit_stats["state"] != CIRCUIT_CLOSED:
+    st.sidebar.warning(
+        "⚠️ OpenAI non risponde: le newsletter vengono create dal template finché il servizio non torna disponibile"
+    )
+
+# Opzioni cache
+st.sidebar.header("🗄️ Cache risposte")
+bypass_cache = st.sidebar.checkbox(
+    "Ignora cache",
+    help="Genera sempre una nuova versione, anche se gli stessi dati sono già stati usati"
+)
+cache_stats = response_cache.stats()
+st.sidebar.caption(
+    f"Hit: {cache_stats['hits']} · Miss: {cache_stats['misses']} · "
+    f"Voci salvate: {cache_stats['entries']}"
+)
+suggest_similar = st.sidebar.checkbox(
+    "Proponi bozze da richieste simili",
+    value=True,
+    help="Se una richiesta quasi identica è già stata generata, mostra subito quel risultato come bozza"
+)
+similarity_threshold = st.sidebar.slider(
+    "Soglia di similarità", min_value=0.5, max_value=1.0, value=0.85, step=0.05,
+    disabled=not suggest_similar
+)
+usage_summary = get_usage_tracker().summary()
+if usage_summary["prompt_tokens"]:
+    st.sidebar.caption(
+        f"Token di prompt dalla cache del provider: {usage_summary['cached_tokens']} "
+        f"({usage_summary['cached_ratio']:.0%})"
+    )
+
+# Tempi di rerun: compilati a fine script, quando la pagina è stata tutta eseguita
+st.sidebar.header("📊 Prestazioni")
+rerun_timing = st.sidebar.empty()
+if st.sidebar.checkbox("Mostra tempi per fase", help="Durata delle fasi delle generazioni, token e costo stimato"):
+    telemetry_summary = telemetry.summary()
+    if not telemetry_summary["spans"]:
+        st.sidebar.caption("Nessuna generazione misurata finora")
+    else:
+        st.sidebar.dataframe(
+            [
+                {"fase": name, "n": stats["count"], "p50 ms": round(stats["p50_ms"], 1), "p95 ms": round(stats["p95_ms"], 1)}
+                for name, stats in sorted(telemetry_summary["spans"].items())
+            ],
+            hide_index=True
+        )
+        tokens = telemetry_summary["tokens"]
+        st.sidebar.caption(
+            f"Token: {sum(count for key, count in tokens.items() if not key.endswith(':cached'))} · "
+            f"costo stimato ${telemetry_summary['cost_usd']:.4f}"
+        )
+
 # Sezione principale solo se API key è presente
 if api_key:
     st.header("📋 Inserisci i dati per generare la newsletter")
     
-    # Creare due colonne per organizzare meglio il form
-    col1, col2 = st.columns(2)
-    
-    with col1:
-        st.subheader("🏢 Informazioni Azienda")
-        company_name = st.text_input("Nome dell'azienda *", help="Nome della tua azienda")
-        website_url = st.text_input("Link al sito web", help="URL del sito web aziendale")
-        company_description = st.text_area(
-            "Descrizione dell'azienda *", 
-            height=100,
-            help="Copia e incolla dalla pagina 'Chi siamo'"
-        )
+    # I campi stanno in un form: la pagina viene rieseguita solo all'invio, non a ogni modifica
+    with st.form("newsletter_form"):
+        # Creare due colonne per organizzare meglio il form
+        col1, col2 = st.columns(2)
         
-        st.subheader("📨 Tipo di Email")
-        email_type = st.selectbox(
-            "Tipologia di email *",
-            ["Newsletter", "DEM", "Automation"]
-        )
+        with col1:
+            st.subheader("🏢 Informazioni Azienda")
+            company_name = st.text_input("Nome dell'azienda *", help="Nome della tua azienda")
+            website_url = st.text_input("Link al sito web", help="URL del sito web aziendale")
+            company_description = st.text_area(
+                "Descrizione dell'azienda *", 
+                height=100,
+                help="Copia e incolla dalla pagina 'Chi siamo'"
+            )
         
-        email_objective = st.text_area(
-            "Obiettivo della mail *",
-            height=80,
-            help="Descrivi l'obiettivo principale di questa email"
-        )
+            st.subheader("📨 Tipo di Email")
+            email_type = st.selectbox(
+                "Tipologia di email *",
+                ["Newsletter", "DEM", "Automation"]
+            )
         
-        content_brief = st.text_area(
-            "Brief del contenuto *",
-            height=100,
-            help="Descrivi il contenuto che vuoi includere nella newsletter"
-        )
-    
-    with col2:
-        st.subheader("🎯 Target e Mercato")
-        target_audience = st.selectbox("Target audience *", ["B2B", "B2C"])
+            email_objective = st.text_area(
+                "Obiettivo della mail *",
+                height=80,
+                help="Descrivi l'obiettivo principale di questa email"
+            )
         
-        market_segment_1 = st.text_input("Segmento di mercato 1", help="Primo segmento di mercato")
-        market_segment_2 = st.text_input("Segmento di mercato 2", help="Secondo segmento di mercato")
-        market_segment_3 = st.text_input("Segmento di mercato 3", help="Terzo segmento di mercato")
+            content_brief = st.text_area(
+                "Brief del contenuto *",
+                height=100,
+                help="Descrivi il contenuto che vuoi includere nella newsletter"
+            )
         
-        st.subheader("🎨 Tone of Voice")
-        tone_options = ["Professionale", "Minimalista", "Persuasivo", "Informativo", "Ricercato", "Popolare", "Altro"]
-        tone_of_voice = st.selectbox("Tone of voice *", tone_options)
+        with col2:
+            st.subheader("🎯 Target e Mercato")
+            target_audience = st.selectbox("Target audience *", ["B2B", "B2C"])
         
-        if tone_of_voice == "Altro":
-            custom_tone = st.text_input("Specifica il tone of voice")
-            tone_of_voice = custom_tone if custom_tone else "Professionale"
+            market_segment_1 = st.text_input("Segmento di mercato 1", help="Primo segmento di mercato")
+            market_segment_2 = st.text_input("Segmento di mercato 2", help="Secondo segmento di mercato")
+            market_segment_3 = st.text_input("Segmento di mercato 3", help="Terzo segmento di mercato")
+        
+            st.subheader("🎨 Tone of Voice")
+            tone_options = ["Professionale", "Minimalista", "Persuasivo", "Informativo", "Ricercato", "Popolare", "Altro"]
+            tone_of_voice = st.selectbox("Tone of voice *", tone_options)
+        
+            custom_tone = st.text_input(
+                "Specifica il tone of voice",
+                help="Usato solo se scegli 'Altro'"
+            )
+        
+        # Sezione prodotti
+        st.subheader("🛍️ Prodotti (opzionale)")
+        col3, col4 = st.columns(2)
+        
+        with col3:
+            product_1 = st.text_input("Prodotto 1")
+            product_2 = st.text_input("Prodotto 2") 
+            product_3 = st.text_input("Prodotto 3")
+        
+        with col4:
+            product_link_1 = st.text_input("Link Prodotto 1")
+            product_link_2 = st.text_input("Link Prodotto 2")
+            product_link_3 = st.text_input("Link Prodotto 3")
+        
+        # Altre informazioni
+        col5, col6 = st.columns(2)
+        
+        with col5:
+            st.subheader("💡 Informazioni Aggiuntive")
+            usp_benefit = st.text_area(
+                "USP / Benefit",
+                height=80,
+                help="Unique Selling Proposition o benefici principali"
+            )
+        
+            language = st.selectbox(
+                "Lingua *",
+                ["Italiano", "Inglese", "Francese", "Spagnolo", "Tedesco"]
+            )
+        
+        with col6:
+            st.subheader("📝 Personalizzazione Testo")
+            forbidden_words = st.text_area(
+                "Parole vietate",
+                height=70,
+                help="Parole da non utilizzare, separate da virgola"
+            )
+        
+            required_words = st.text_area(
+                "Parole da usare",
+                height=70,
+                help="Parole che devono essere incluse, separate da virgola"
+            )
+        
+            discount_codes = st.text_input(
+                "Codici sconto disponibili",
+                help="Codici sconto da includere, separati da virgola"
+            )
+        
+        st.markdown("---")
+        generate_clicked = st.form_submit_button(
+            "🚀 Genera Newsletter", type="primary", use_container_width=True
+        )
+        
+        # Varianti per test A/B
+        with st.expander("🧪 Varianti oggetto e anteprima per test A/B"):
+            variants_count = st.slider("Numero di varianti", min_value=6, max_value=30, value=15)
+            variants_clicked = st.form_submit_button("Genera varianti")
     
-    # Sezione prodotti
-    st.subheader("🛍️ Prodotti (opzionale)")
-    col3, col4 = st.columns(2)
+    if tone_of_voice == "Altro":
+        tone_of_voice = custom_tone if custom_tone else "Professionale"
     
-    with col3:
-        product_1 = st.text_input("Prodotto 1")
-        product_2 = st.text_input("Prodotto 2") 
-        product_3 = st.text_input("Prodotto 3")
+    with telemetry.span("validate_inputs"):
+        # Preparare i dati per la generazione
+        form_data = build_newsletter_data({
+            "company_name": company_name,
+            "website_url": website_url,
+            "company_description": company_description,
+            "email_type": email_type,
+            "email_objective": email_objective,
+            "content_brief": content_brief,
+            "target_audience": target_audience,
+            "market_segment_1": market_segment_1,
+            "market_segment_2": market_segment_2,
+            "market_segment_3": market_segment_3,
+            "tone_of_voice": tone_of_voice,
+            "product_1": product_1,
+            "product_link_1": product_link_1,
+            "product_2": product_2,
+            "product_link_2": product_link_2,
+            "product_3": product_3,
+            "product_link_3": product_link_3,
+            "usp_benefit": usp_benefit,
+            "language": language,
+            "forbidden_words": forbidden_words,
+            "required_words": required_words,
+            "discount_codes": discount_codes
+        })
+        
+        # Validazione: campi obbligatori, URL del sito e link dei prodotti (come nella CLI)
+        input_errors = validate_inputs(form_data)
     
-    with col4:
-        product_link_1 = st.text_input("Link Prodotto 1")
-        product_link_2 = st.text_input("Link Prodotto 2")
-        product_link_3 = st.text_input("Link Prodotto 3")
+    def create_generator() -> NewsletterGenerator:
+        """Generatore che usa le risorse condivise tra sessioni (cache, client, scheduler...)"""
+        return NewsletterGenerator(
+            api_key,
+            cache=response_cache,
+            client=client_registry.get(api_key),
+            scheduler=scheduler,
+            cascade=get_model_cascade(),
+            circuit_breaker=get_circuit_breaker(),
+            single_flight=get_single_flight(),
+            brand_store=get_brand_store(),
+            usage_tracker=get_usage_tracker(),
+            similarity_cache=get_similarity_cache(),
+            telemetry=telemetry
+        )
     
-    # Altre informazioni
-    col5, col6 = st.columns(2)
+    if generate_clicked:
+        if input_errors:
+            st.error(f"❌ {'; '.join(input_errors)}")
+        else:
+            # La generazione gira in un worker: il pulsante accoda il job e la pagina resta interattiva
+            st.session_state["job_id"] = job_queue.submit(
+                session_id,
+                "newsletter",
+                newsletter_job(
+                    create_generator(),
+                    form_data,
+                    use_cache=not bypass_cache,
+                    pipeline=pipeline_mode,
+                    similarity_threshold=similarity_threshold if suggest_similar else None
+                )
+            )
+            st.session_state.pop("newsletter", None)
+            st.session_state.pop("generation_error", None)
     
-    with col5:
-        st.subheader("💡 Informazioni Aggiuntive")
-        usp_benefit = st.text_area(
-            "USP / Benefit",
-            height=80,
-            help="Unique Selling Proposition o benefici principali"
-        )
+    # Stato della generazione in corso: il frammento si aggiorna da solo finché il job non termina,
+    # senza rieseguire il resto della pagina
+    @st.fragment(run_every=1.0 if "job_id" in st.session_state else None)
+    def job_panel():
+        started = time.perf_counter()
+        job = None
+        if "job_id" in st.session_state:
+            job = job_queue.get(st.session_state["job_id"], session_id)
+            if job is None or job["status"] in (JOB_DONE, JOB_FAILED):
+                del st.session_state["job_id"]
         
-        language = st.selectbox(
-            "Lingua *",
-            ["Italiano", "Inglese", "Francese", "Spagnolo", "Tedesco"]
-        )
+        if job is not None and job["status"] == JOB_DONE:
+            if job["result"] and job["result"].get("result"):
+                # Il risultato resta in session_state: sopravvive ai rerun (download, rigenerazione sezioni)
+                st.session_state["newsletter"] = job["result"]
+            else:
+                st.session_state["generation_error"] = None
+            # Rerun completo: il frammento smette di aggiornarsi e l'esito resta visibile
+            st.rerun()
+        elif job is not None and job["status"] == JOB_FAILED:
+            st.session_state["generation_error"] = job["error"]
+            st.rerun()
+        elif job is not None:
+            if job["status"] == JOB_QUEUED:
+                st.info(f"⏳ Richiesta in coda (posizione {job['position']})...")
+            else:
+                st.info("🤖 Sto generando la tua newsletter...")
+            
+            # Oggetti, anteprime e contenuto man mano che il worker li pubblica
+            partial = job["partial"] or {}
+            if partial.get("subjects") or partial.get("previews"):
+                st.markdown(
+                    "\n".join(f"- 📧 {s}" for s in partial.get("subjects", [])) + "\n" +
+                    "\n".join(f"- 👀 {p}" for p in partial.get("previews", []))
+                )
+            if partial.get("content"):
+                st.markdown(partial["content"])
+        elif "generation_error" in st.session_state:
+            show_generation_error(st.session_state["generation_error"])
+        record_timing("frammento stato", started)
     
-    with col6:
-        st.subheader("📝 Personalizzazione Testo")
-        forbidden_words = st.text_area(
-            "Parole vietate",
-            height=70,
-            help="Parole da non utilizzare, separate da virgola"
-        )
+    job_panel()
+    
+    # Risultato dell'ultima generazione, con rigenerazione delle singole sezioni: i pulsanti
+    # rieseguono solo questo frammento
+    @st.fragment
+    def result_panel():
+        if "newsletter" not in st.session_state:
+            return
+        started = time.perf_counter()
+        newsletter = st.session_state["newsletter"]
+        result = newsletter["result"]
+        st.success("✅ Newsletter generata con successo!")
+        if newsletter["draft"]:
+            st.caption(f"⚡ Bozza da una richiesta simile (similarità {newsletter['similarity']:.0%})")
+        elif newsletter["time_to_first_token"] is not None:
+            st.caption(
+                f"⏱️ Primo token dopo {newsletter['time_to_first_token']:.2f}s · "
+                f"tempo totale {newsletter['total_time']:.2f}s"
+            )
+        elif newsletter["total_time"] is not None:
+            st.caption(f"⏱️ Tempo totale {newsletter['total_time']:.2f}s")
+        if newsletter["draft"]:
+            st.info("💡 Questa è una bozza generata per una richiesta molto simile.")
+            if st.button("✏️ Adatta la bozza ai dati attuali",
+                         help="Aggiorna la bozza con il modello veloce, più economico di una nuova generazione"):
+                with st.spinner("🤖 Sto adattando la bozza..."):
+                    newsletter["result"] = create_generator().adapt_similar(
+                        {"result": result}, newsletter["data"]
+                    )
+                newsletter["draft"] = False
+                newsletter["time_to_first_token"] = newsletter["total_time"] = None
+                st.rerun(scope="fragment")
+        if result.get("constraint_issues"):
+            st.warning(
+                "⚠️ Vincoli non rispettati dopo la correzione automatica:\n- "
+                + "\n- ".join(result["constraint_issues"])
+            )
         
-        required_words = st.text_area(
-            "Parole da usare",
-            height=70,
-            help="Parole che devono essere incluse, separate da virgola"
-        )
+        # Mostrare i risultati
+        st.header("📄 Risultato Generato")
         
-        discount_codes = st.text_input(
-            "Codici sconto disponibili",
-            help="Codici sconto da includere, separati da virgola"
-        )
-    
-    # Pulsante per generare
-    st.markdown("---")
-    
-    if st.button("🚀 Genera Newsletter", type="primary", use_container_width=True):
-        # Validazione input obbligatori
-        required_fields = {
-            "Nome azienda": company_name,
-            "Descrizione azienda": company_description,
-            "Obiettivo email": email_objective,
-            "Brief contenuto": content_brief
-        }
+        # Oggetti email
+        st.subheader("📧 Oggetti Email (max 40 caratteri)")
+        for i, subject in enumerate(result.get("email_subjects", []), 1):
+            char_count = len(subject)
+            color = "🟢" if char_count <= 40 else "🔴"
+            st.write(f"**{i}.** {subject} {color} ({char_count} caratteri)")
+        
+        # Anteprime email
+        st.subheader("👀 Anteprime Email (max 100 caratteri)")
+        for i, preview in enumerate(result.get("email_previews", []), 1):
+            char_count = len(preview)
+            color = "🟢" if char_count <= 100 else "🔴"
+            st.write(f"**{i}.** {preview} {color} ({char_count} caratteri)")
         
-        missing_fields = [field for field, value in required_fields.items() if not value.strip()]
+        # Contenuto newsletter, sezione per sezione
+        st.subheader("📝 Contenuto Newsletter")
+        generator = create_generator()
+        for section in generator.get_sections(result, newsletter["data"]):
+            text_col, button_col = st.columns([6, 1])
+            with text_col:
+                st.markdown(section["text"])
+            with button_col:
+                if st.button("🔄 Rigenera", key=f"regenerate_{section['id']}",
+                             help=f"Riscrive solo questa sezione ({section_label(section)})"):
+                    with st.spinner("🤖 Sto riscrivendo la sezione..."):
+                        newsletter["result"] = generator.regenerate_section(
+                            result, section["id"], newsletter["data"]
+                        )
+                    st.rerun(scope="fragment")
         
-        if missing_fields:
-            st.error(f"❌ Campi obbligatori mancanti: {', '.join(missing_fields)}")
+        # Pulsante download
+        with telemetry.span("render"):
+            newsletter_text = format_output(result)
+            email_html = newsletter_html(result, newsletter["data"])
+        company_slug = newsletter["data"]["company_name"].lower().replace(' ', '_')
+        text_col, html_col = st.columns(2)
+        with text_col:
+            st.download_button(
+                label="📥 Scarica Newsletter",
+                data=newsletter_text,
+                file_name=f"newsletter_{company_slug}.txt",
+                mime="text/plain"
+            )
+        with html_col:
+            st.download_button(
+                label="📧 Scarica HTML email",
+                data=email_html,
+                file_name=f"newsletter_{company_slug}.html",
+                mime="text/html",
+                help="HTML a tabelle con stili in linea, pronto per Mailchimp e gli altri servizi email"
+            )
+        record_timing("frammento risultato", started)
+    
+    result_panel()
+    
+    # Varianti per test A/B
+    if variants_clicked:
+        if input_errors:
+            st.error(f"❌ {'; '.join(input_errors)}")
         else:
-            # Preparare i dati per la generazione
-            data = {
-                "company_name": company_name,
-                "website_url": website_url,
-                "company_description": company_description,
-                "email_type": email_type,
-                "email_objective": email_objective,
-                "content_brief": content_brief,
-                "target_audience": target_audience,
-                "market_segments": [market_segment_1, market_segment_2, market_segment_3],
-                "tone_of_voice": tone_of_voice,
-                "products": [
-                    {"name": product_1, "link": product_link_1} if product_1 else None,
-                    {"name": product_2, "link": product_link_2} if product_2 else None,
-                    {"name": product_3, "link": product_link_3} if product_3 else None
-                ],
-                "usp_benefit": usp_benefit,
-                "language": language,
-                "forbidden_words": [w.strip() for w in forbidden_words.split(",") if w.strip()],
-                "required_words": [w.strip() for w in required_words.split(",") if w.strip()],
-                "discount_codes": [c.strip() for c in discount_codes.split(",") if c.strip()]
-            }
-            
-            # Filtrare prodotti nulli
-            data["products"] = [p for p in data["products"] if p is not None]
+            with st.spinner("🤖 Sto generando le varianti..."):
+                st.session_state["variants"] = create_generator().generate_subject_variants(
+                    form_data, count=variants_count
+                )
+    
+    if "variants" in st.session_state:
+        variants = st.session_state["variants"]
+        with st.expander("🧪 Varianti per test A/B", expanded=True):
+            st.subheader(f"📧 Oggetti ({len(variants['email_subjects'])} varianti)")
+            for i, subject in enumerate(variants["email_subjects"], 1):
+                st.write(f"**{i}.** {subject} ({len(subject)} caratteri)")
             
-            try:
-                with st.spinner("🤖 Sto generando la tua newsletter..."):
-                    generator = NewsletterGenerator(api_key)
-                    result = generator.generate_newsletter(data)
-                
-                if result:
-                    st.success("✅ Newsletter generata con successo!")
-                    
-                    # Mostrare i risultati
-                    st.header("📄 Risultato Generato")
-                    
-                    # Oggetti email
-                    st.subheader("📧 Oggetti Email (max 40 caratteri)")
-                    for i, subject in enumerate(result.get("email_subjects", []), 1):
-                        char_count = len(subject)
-                        color = "🟢" if char_count <= 40 else "🔴"
-                        st.write(f"**{i}.** {subject} {color} ({char_count} caratteri)")
-                    
-                    # Anteprime email
-                    st.subheader("👀 Anteprime Email (max 100 caratteri)")
-                    for i, preview in enumerate(result.get("email_previews", []), 1):
-                        char_count = len(preview)
-                        color = "🟢" if char_count <= 100 else "🔴"
-                        st.write(f"**{i}.** {preview} {color} ({char_count} caratteri)")
-                    
-                    # Contenuto newsletter
-                    st.subheader("📝 Contenuto Newsletter")
-                    st.markdown(result.get("newsletter_content", ""))
-                    
-                    # Pulsante download
-                    newsletter_text = format_output(result)
-                    st.download_button(
-                        label="📥 Scarica Newsletter",
-                        data=newsletter_text,
-                        file_name=f"newsletter_{company_name.lower().replace(' ', '_')}.txt",
-                        mime="text/plain"
-                    )
-                    
-                else:
-                    st.error("❌ Errore nella generazione della newsletter.")
-                    st.info("💡 Possibili soluzioni:")
-                    st.write("- Verifica che la tua API Key sia corretta")
-                    st.write("- Controlla di avere crediti disponibili nel tuo account OpenAI")
-                    st.write("- Prova a semplificare il brief del contenuto")
-                    st.write("- Riprova tra qualche minuto")
-                    
-            except Exception as e:
-                st.error(f"❌ Errore dettagliato: {str(e)}")
-                
-                # Suggerimenti specifici per errori comuni
-                error_str = str(e).lower()
-                if "api" in error_str or "key" in error_str:
-                    st.warning("🔑 Problema con l'API Key:")
-                    st.write("- Verifica che l'API Key sia corretta")
-                    st.write("- Assicurati di non aver raggiunto i limiti di utilizzo")
-                elif "model" in error_str:
-                    st.warning("🤖 Problema con il modello AI:")
-                    st.write("- Il modello GPT-4 potrebbe non essere disponibile")
-                    st.write("- Prova di nuovo, l'app userà automaticamente GPT-3.5 come backup")
-                elif "quota" in error_str or "limit" in error_str:
-                    st.warning("💳 Limite raggiunto:")
-                    st.write("- Hai raggiunto il limite di utilizzo del tuo account OpenAI")
-                    st.write("- Controlla il tuo piano su platform.openai.com")
-                else:
-                    st.info("🔄 Prova queste soluzioni:")
-                    st.write("- Ricarica la pagina e riprova")
-                    st.write("- Semplifica il contenuto richiesto")
-                    st.write("- Verifica la connessione internet")
+            st.subheader(f"👀 Anteprime ({len(variants['email_previews'])} varianti)")
+            for i, preview in enumerate(variants["email_previews"], 1):
+                st.write(f"**{i}.** {preview} ({len(preview)} caratteri)")
 
 else:
     st.info("👈 Inserisci la tua OpenAI API Key nella barra laterale per iniziare")
@@ -271,3 +606,10 @@ else:
 # Footer
 st.markdown("---")
 st.markdown("🚀 **Newsletter AI Generator** - Sviluppato da Daniele Pisciottano e il suo amico Claude 🦕")
+
+# Tempo di esecuzione di questo rerun e degli ultimi rerun dei frammenti
+record_timing("pagina", SCRIPT_STARTED)
+rerun_timing.caption(" · ".join(
+    f"{kind}: ultimo {samples[-1] * 1000:.0f} ms, mediana {sorted(samples)[len(samples) // 2] * 1000:.0f} ms"
+    for kind, samples in st.session_state["rerun_timings"].items()
+))
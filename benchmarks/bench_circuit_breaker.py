@@ -0,0 +1,160 @@
+"""Latenza delle generazioni durante un disservizio simulato del provider.
+
+Uso:
+    python benchmarks/bench_circuit_breaker.py [--requests 60] [--timeout 0.2] [--interval 0.05]
+
+Il backend stub fallisce con un timeout (dopo --timeout secondi) per la prima metà
+delle richieste e torna a rispondere nella seconda metà; le richieste partono ogni
+--interval secondi. Si confrontano p50/p99 e numero di risposte da template con e
+senza interruttore di circuito.
+
+Prima verifica, con i tempi ridotti di 100 volte, che un provider lento ma sano (risposte
+in 40 "secondi", sotto il budget di 90 del modello) non apra il circuito e che una prova
+lenta ma riuscita lo richiuda: lo script fallisce (codice di uscita 1) se non succede.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+from typing import List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from cascade import ModelCascade
+from circuit_breaker import CIRCUIT_CLOSED, CircuitBreaker
+from newsletter_generator import NewsletterGenerator
+from providers import StubProvider
+from scheduler import RequestScheduler
+
+DATA = {
+    "company_name": "Azienda Demo",
+    "company_description": "Torrefazione artigianale",
+    "website_url": "https://example.com",
+    "email_type": "Newsletter",
+    "email_objective": "Presentare la nuova miscela",
+    "content_brief": "Nuova miscela estiva, spedizione gratuita per il weekend",
+    "target_audience": "B2C",
+    "market_segments": [],
+    "tone_of_voice": "Professionale",
+    "language": "Italiano",
+    "products": [{"name": "Miscela Estate", "link": ""}],
+    "forbidden_words": [],
+    "required_words": [],
+    "discount_codes": [],
+}
+
+
+class APITimeoutError(Exception):
+    """Stesso nome dell'errore di timeout dell'SDK, così scheduler e circuito lo riconoscono"""
+
+
+class OutageProvider(StubProvider):
+    def __init__(self, timeout: float):
+        super().__init__()
+        self.timeout = timeout
+        self.down = True
+
+    def create(self, *args, **kwargs):
+        if self.down:
+            time.sleep(self.timeout)
+            raise APITimeoutError("Request timed out")
+        return super().create(*args, **kwargs)
+
+
+class SlowProvider(StubProvider):
+    """Risponde sempre, dopo latency secondi"""
+
+    def create(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return super().create(*args, **kwargs)
+
+
+def check_slow_provider(scale: float = 0.01) -> Optional[str]:
+    """Provider sano ma lento (40 s, sotto il budget di 90 s del modello): nessun template"""
+    breaker = CircuitBreaker(
+        window_seconds=60 * scale, slow_call_seconds=120 * scale, open_seconds=30 * scale
+    )
+    generator = NewsletterGenerator(
+        "demo",
+        provider=SlowProvider(latency=0.0),
+        scheduler=RequestScheduler(1e9, 1e12),
+        cascade=ModelCascade([("gpt-4", 90 * scale), ("gpt-3.5-turbo", 45 * scale)],
+                             default_hedge_delay=60 * scale),
+        circuit_breaker=breaker,
+    )
+    generator.provider.latency = 40 * scale
+    fallbacks = sum(
+        bool(generator.generate_newsletter(dict(DATA, content_brief=f"{DATA['content_brief']} {i}"),
+                                           use_cache=False).get("fallback"))
+        for i in range(12)
+    )
+    if fallbacks or breaker.opened:
+        return f"{fallbacks}/12 risposte da template, circuito aperto {breaker.opened} volte"
+
+    # Prova lenta ma riuscita a circuito semiaperto: il circuito si richiude
+    def timeout() -> None:
+        raise APITimeoutError("Request timed out")
+
+    probe_breaker = CircuitBreaker(min_calls=1, open_seconds=0.0, half_open_probes=1, slow_call_seconds=0.01)
+    try:
+        probe_breaker.call(timeout)
+    except APITimeoutError:
+        pass
+    probe_breaker.call(lambda: time.sleep(0.02))
+    if probe_breaker.state != CIRCUIT_CLOSED:
+        return f"prova lenta riuscita: circuito {probe_breaker.state}"
+    return None
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(requests: int, timeout: float, interval: float, breaker: bool) -> None:
+    provider = OutageProvider(timeout)
+    generator = NewsletterGenerator(
+        "demo",
+        provider=provider,
+        # Limiti di richieste e token molto alti: qui interessa solo l'effetto del disservizio
+        scheduler=RequestScheduler(1e9, 1e12, max_retries=1, base_delay=timeout / 4),
+        circuit_breaker=CircuitBreaker(open_seconds=timeout * 2) if breaker else CircuitBreaker(min_calls=10 ** 9),
+    )
+    samples, fallbacks = [], 0
+    for i in range(requests):
+        if i == requests // 2:
+            provider.down = False
+        started = time.perf_counter()
+        result = generator.generate_newsletter(DATA, use_cache=False)
+        samples.append(time.perf_counter() - started)
+        time.sleep(max(0.0, interval - samples[-1]))
+        fallbacks += bool(result.get("fallback"))
+    label = "con circuito" if breaker else "senza circuito"
+    print(
+        f"{label:<16} p50 {percentile(samples, 0.5) * 1e3:8.1f} ms  "
+        f"p99 {percentile(samples, 0.99) * 1e3:8.1f} ms  "
+        f"media {statistics.mean(samples) * 1e3:8.1f} ms  template {fallbacks}/{requests}"
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--timeout", type=float, default=0.2)
+    parser.add_argument("--interval", type=float, default=0.05)
+    args = parser.parse_args()
+
+    failure = check_slow_provider()
+    print(f"Verifica provider lento ma sano: {'ok' if failure is None else 'FALLITA: ' + failure}\n")
+    if failure is not None:
+        return 1
+
+    for breaker in (False, True):
+        run(args.requests, args.timeout, args.interval, breaker)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,399 @@
+"""Suite di benchmark end-to-end sul server locale di benchmarks/fake_openai.py.
+
+Uso:
+    python benchmarks/bench_e2e.py [--requests 40] [--concurrency 1,4,16] [--backend http|openai]
+    python benchmarks/bench_e2e.py --update-baseline     # salva i valori come nuovo riferimento
+
+Prima verifica il comportamento sul server locale (lo script fallisce se una verifica
+non passa):
+  - i frammenti dello stream ricompongono la risposta e il risultato analizzato;
+  - un 429 con Retry-After viene ritentato e la generazione riesce;
+  - con 500 continui l'interruttore si apre e si risponde con il template;
+  - una risposta troncata dal limite di token viene ripetuta con un budget più ampio,
+    con e senza stream, e in cache finisce solo quella completa.
+
+Poi misura, senza chiamare OpenAI:
+  - latenza end-to-end (p50/p90/p99) di generate_newsletter, anche in streaming (tempo al primo token);
+  - throughput a diversi livelli di concorrenza;
+  - latenza e generazioni riuscite con il 5% di 429 e il 5% di 500 iniettati;
+  - microbenchmark di _build_prompt e _parse_response;
+  - memoria allocata durante una serie di generazioni (picco tracemalloc).
+
+I valori vengono confrontati con benchmarks/baseline.json: lo script fallisce (codice
+di uscita 1) se una metrica peggiora oltre --tolerance. Il server risponde con
+latenza fissa e bassa, così i tempi misurano soprattutto il costo del nostro codice.
+I microbenchmark prendono il migliore di più giri e il loro riferimento è scalato sulla
+velocità della macchina (calibration_us, un carico fisso misurato insieme a loro).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from cache import ResponseCache
+from circuit_breaker import CircuitBreaker
+from fake_openai import FakeOpenAI, FakeOpenAIServer, load_responses
+from newsletter_generator import NewsletterGenerator
+from providers import HTTPProvider, load_provider
+from response_parser import RESPONSE_KEYS, decode_structured
+from scheduler import RequestScheduler
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# Risposte registrate valide: la suite misura il percorso riuscito, non il template di fallback
+RESPONSE_NAMES = ["json_indentato", "json_ascii_escape", "json_lungo"]
+
+DATA = {
+    "company_name": "Verdi Giardini",
+    "company_description": "Attrezzi da giardino e vasi artigianali, spedizione in tutta Italia",
+    "website_url": "https://example.com",
+    "email_type": "Newsletter",
+    "email_objective": "Presentare la collezione di primavera",
+    "content_brief": "Nuovi attrezzi in acciaio inox, vasi fatti a mano, sconto del 10% fino al 30 aprile",
+    "target_audience": "B2C",
+    "market_segments": ["Hobbisti", "Orti urbani"],
+    "tone_of_voice": "Professionale",
+    "language": "Italiano",
+    "products": [{"name": "Set attrezzi Pro", "link": "https://example.com/pro"}],
+    "usp_benefit": "Consegna in 48 ore",
+    "forbidden_words": [],
+    "required_words": [],
+    "discount_codes": ["PRIMAVERA10"],
+}
+
+# Metrica -> (unità, True se più alto è meglio, scarto assoluto tollerato)
+METRICS = {
+    "latency_p50_ms": ("ms", False, 2.0),
+    "latency_p90_ms": ("ms", False, 3.0),
+    "latency_p99_ms": ("ms", False, 5.0),
+    "stream_ttft_p50_ms": ("ms", False, 2.0),
+    "stream_total_p50_ms": ("ms", False, 3.0),
+    "errors_success_rate": ("", True, 0.05),
+    "errors_p99_ms": ("ms", False, 50.0),
+    "build_prompt_us": ("µs", False, 5.0),
+    "parse_response_us": ("µs", False, 5.0),
+    "memory_peak_kb": ("KB", False, 256.0),
+    "calibration_us": ("µs", False, 0.0),
+}
+# Metriche confrontate in proporzione alla velocità della macchina (calibration_us)
+MACHINE_RELATIVE = ("build_prompt_us", "parse_response_us")
+MICRO_ROUNDS = 5
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def request_data(index: int) -> Dict:
+    """Richiesta diversa per ogni indice, così cache e unione delle richieste non intervengono"""
+    return dict(DATA, content_brief=f"{DATA['content_brief']} (richiesta {index})")
+
+
+def make_generator(base_url: str, backend: str, circuit_breaker: Optional[CircuitBreaker] = None) -> NewsletterGenerator:
+    if backend == "http":
+        provider = HTTPProvider("bench", base_url=base_url)
+    else:
+        os.environ["OPENAI_BASE_URL"] = base_url
+        provider = load_provider("openai", "bench")
+    # Limiti di richieste e token molto alti: lo scheduler non deve rallentare il benchmark
+    scheduler = RequestScheduler(1e9, 1e12, base_delay=0.01, max_delay=0.1)
+    return NewsletterGenerator("bench", provider=provider, scheduler=scheduler, circuit_breaker=circuit_breaker)
+
+
+def is_fallback(result: Dict) -> bool:
+    return result["newsletter_content"].startswith(f"# Newsletter {DATA['company_name']}")
+
+
+def check_stream(backend: str) -> Optional[str]:
+    """I frammenti dello stream ricompongono la risposta registrata e il risultato analizzato"""
+    response = load_responses(names=RESPONSE_NAMES[:1])[0]
+    server, base_url = start_server("fixed:0", 0.0, responses=[response])
+    try:
+        stream = make_generator(base_url, backend).generate_newsletter(request_data(0), use_cache=False, stream=True)
+        text = "".join(stream)
+    finally:
+        server.stop()
+    if text != response["content"]:
+        return f"testo ricomposto diverso dalla risposta ({len(text)} caratteri su {len(response['content'])})"
+    expected = decode_structured(response["content"])
+    if stream.error is not None or {key: stream.result.get(key) for key in RESPONSE_KEYS} != expected:
+        return f"risultato dello stream diverso dalla risposta analizzata (errore: {stream.error})"
+    return None
+
+
+def check_rate_limit(backend: str) -> Optional[str]:
+    """Un 429 con Retry-After viene ritentato dallo scheduler e la generazione riesce"""
+    server, base_url = start_server("fixed:0", 0.0, rate_429=0.5)
+    try:
+        results = [make_generator(base_url, backend).generate_newsletter(request_data(i), use_cache=False)
+                   for i in range(4)]
+        stats = server.fake.stats()
+    finally:
+        server.stop()
+    if stats["429"] == 0:
+        return "nessun 429 iniettato"
+    if any(is_fallback(result) for result in results):
+        return f"generazioni finite nel template dopo {stats['429']} risposte 429"
+    return None
+
+
+def check_breaker(backend: str) -> Optional[str]:
+    """Con 500 continui l'interruttore si apre: template subito, senza altre richieste al server"""
+    breaker = CircuitBreaker(min_calls=3, open_seconds=60.0)
+    server, base_url = start_server("fixed:0", 0.0, rate_500=1.0)
+    try:
+        generator = make_generator(base_url, backend, breaker)
+        results = [generator.generate_newsletter(request_data(i), use_cache=False) for i in range(3)]
+        requests = server.fake.stats()["requests"]
+        results.append(generator.generate_newsletter(request_data(3), use_cache=False))
+        extra = server.fake.stats()["requests"] - requests
+    finally:
+        server.stop()
+    if not breaker.is_open():
+        return f"interruttore chiuso dopo {requests} risposte 500"
+    if not all(is_fallback(result) for result in results):
+        return "risultato diverso dal template con il provider in errore"
+    if extra:
+        return f"{extra} richieste al server con l'interruttore aperto"
+    return None
+
+
+def check_truncated(backend: str) -> Optional[str]:
+    """Una risposta oltre il budget di token viene ripetuta con più token, non finisce nel template né in cache"""
+    recorded = decode_structured(load_responses(names=["json_lungo"])[0]["content"])
+    long_result = dict(recorded, newsletter_content=recorded["newsletter_content"] * 3)
+    content = json.dumps(long_result, ensure_ascii=False, indent=2)
+    server, base_url = start_server("fixed:0", 0.0, responses=[{"name": "json_molto_lungo", "content": content}])
+    try:
+        for stream in (False, True):
+            generator = make_generator(base_url, backend)
+            generator.cache = ResponseCache(":memory:")
+            data = request_data(int(stream))
+            if stream:
+                response = generator.generate_newsletter(data, stream=True)
+                for _ in response:
+                    pass
+                result = response.result
+            else:
+                result = generator.generate_newsletter(data)
+            if result.get("fallback") or {key: result.get(key) for key in RESPONSE_KEYS} != long_result:
+                return f"risultato {'dello stream ' if stream else ''}diverso dalla risposta completa"
+            cached = generator.cache.get(generator._prepare_request(data)[1])
+            if cached is None or decode_structured(cached) != long_result:
+                return f"risposta {'dello stream ' if stream else ''}in cache assente o troncata"
+        truncated = server.fake.stats()["truncated"]
+    finally:
+        server.stop()
+    if truncated < 2:
+        return f"{truncated} risposte troncate dal server, ne servono 2"
+    return None
+
+
+def run_checks(backend: str) -> List[str]:
+    failures = []
+    for check in (check_stream, check_rate_limit, check_breaker, check_truncated):
+        failure = check(backend)
+        print(f"{check.__name__:<24} {'ok' if failure is None else 'FALLITA: ' + failure}")
+        if failure is not None:
+            failures.append(check.__name__)
+    return failures
+
+
+def bench_latency(base_url: str, backend: str, requests: int) -> Dict[str, float]:
+    generator = make_generator(base_url, backend)
+    samples = []
+    for i in range(requests):
+        started = time.perf_counter()
+        generator.generate_newsletter(request_data(i), use_cache=False)
+        samples.append(time.perf_counter() - started)
+
+    ttft, totals = [], []
+    for i in range(requests):
+        stream = generator.generate_newsletter(request_data(requests + i), use_cache=False, stream=True)
+        for _ in stream:
+            pass
+        ttft.append(stream.time_to_first_token or 0.0)
+        totals.append(stream.total_time)
+    return {
+        "latency_p50_ms": percentile(samples, 0.5) * 1e3,
+        "latency_p90_ms": percentile(samples, 0.9) * 1e3,
+        "latency_p99_ms": percentile(samples, 0.99) * 1e3,
+        "stream_ttft_p50_ms": percentile(ttft, 0.5) * 1e3,
+        "stream_total_p50_ms": percentile(totals, 0.5) * 1e3,
+    }
+
+
+def bench_throughput(base_url: str, backend: str, requests: int, levels: List[int]) -> Dict[str, float]:
+    metrics = {}
+    for level in levels:
+        generator = make_generator(base_url, backend)
+        count = max(requests, level * 4)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=level) as executor:
+            list(executor.map(lambda i: generator.generate_newsletter(request_data(i), use_cache=False), range(count)))
+        metrics[f"throughput_c{level}_rps"] = count / (time.perf_counter() - started)
+    return metrics
+
+
+def bench_errors(base_url: str, backend: str, requests: int) -> Dict[str, float]:
+    generator = make_generator(base_url, backend)
+    samples, successes = [], 0
+    for i in range(requests):
+        started = time.perf_counter()
+        result = generator.generate_newsletter(request_data(i), use_cache=False)
+        samples.append(time.perf_counter() - started)
+        successes += not is_fallback(result)
+    return {"errors_success_rate": successes / requests, "errors_p99_ms": percentile(samples, 0.99) * 1e3}
+
+
+def best_us(repeat: int, func) -> float:
+    """Tempo per chiamata del giro più veloce: il rumore della macchina pesa solo in su"""
+    best = float("inf")
+    for _ in range(MICRO_ROUNDS):
+        started = time.perf_counter()
+        for i in range(repeat):
+            func(i)
+        best = min(best, time.perf_counter() - started)
+    return best / repeat * 1e6
+
+
+def bench_micro(repeat: int) -> Dict[str, float]:
+    generator = NewsletterGenerator("bench", backend="stub")
+    contents = [r["content"] for r in load_responses(names=RESPONSE_NAMES)]
+    # Carico fisso in puro Python (JSON, stringhe, dizionari), per scalare i riferimenti sulla macchina
+    sample = json.dumps(DATA, ensure_ascii=False)
+
+    return {
+        "build_prompt_us": best_us(repeat, lambda i: generator._build_prompt(request_data(i))),
+        "parse_response_us": best_us(repeat, lambda i: generator._parse_response(contents[i % len(contents)], DATA)),
+        "calibration_us": best_us(repeat, lambda i: " ".join(sorted(json.loads(sample)["content_brief"].split()))),
+    }
+
+
+def bench_memory(base_url: str, backend: str, requests: int) -> Dict[str, float]:
+    generator = make_generator(base_url, backend)
+    # Prima generazione fuori misura: import pigri e strutture create una volta sola
+    generator.generate_newsletter(request_data(0), use_cache=False)
+    tracemalloc.start()
+    for i in range(1, requests + 1):
+        generator.generate_newsletter(request_data(i), use_cache=False)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"memory_peak_kb": peak / 1024}
+
+
+def compare(metrics: Dict[str, float], baseline: Dict[str, float], tolerance: float) -> List[str]:
+    """Metriche peggiorate rispetto al riferimento oltre la tolleranza relativa (e lo scarto assoluto)"""
+    regressions = []
+    # Macchina più lenta (o più carica) di quella del riferimento: i microbenchmark lo seguono
+    scale = 1.0
+    if metrics.get("calibration_us") and baseline.get("calibration_us"):
+        scale = max(1.0, metrics["calibration_us"] / baseline["calibration_us"])
+    for name, value in metrics.items():
+        if name not in baseline or name == "calibration_us":
+            continue
+        reference = baseline[name] * (scale if name in MACHINE_RELATIVE else 1.0)
+        if name.startswith("throughput_"):
+            higher_is_better, slack = True, 0.0
+        else:
+            _, higher_is_better, slack = METRICS[name]
+        if higher_is_better:
+            limit = reference / (1 + tolerance) - slack
+            if value < limit:
+                regressions.append(f"{name}: {value:.2f} < {limit:.2f} (riferimento {reference:.2f})")
+        else:
+            limit = reference * (1 + tolerance) + slack
+            if value > limit:
+                regressions.append(f"{name}: {value:.2f} > {limit:.2f} (riferimento {reference:.2f})")
+    return regressions
+
+
+def start_server(latency: str, token_delay: float, rate_429: float = 0.0, rate_500: float = 0.0,
+                 responses: Optional[List[Dict]] = None) -> Tuple[FakeOpenAIServer, str]:
+    fake = FakeOpenAI(
+        responses or load_responses(names=RESPONSE_NAMES), latency=latency, token_delay=token_delay,
+        rate_429=rate_429, rate_500=rate_500, retry_after=0.01,
+    )
+    server = FakeOpenAIServer(fake)
+    return server, server.start()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=40)
+    parser.add_argument("--concurrency", default="1,4,16")
+    parser.add_argument("--latency", default="fixed:0.02", help="latenza del server (vedi fake_openai.py)")
+    parser.add_argument("--token-delay", type=float, default=0.0005)
+    parser.add_argument("--repeat", type=int, default=2000, help="ripetizioni dei microbenchmark")
+    parser.add_argument("--backend", choices=["http", "openai"], default="http",
+                        help="http: client della libreria standard; openai: SDK OpenAI con OPENAI_BASE_URL")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="peggioramento relativo tollerato")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.concurrency.split(",") if level]
+    metrics: Dict[str, float] = {}
+
+    failures = run_checks(args.backend)
+    print()
+
+    server, base_url = start_server(args.latency, args.token_delay)
+    try:
+        metrics.update(bench_latency(base_url, args.backend, args.requests))
+        metrics.update(bench_throughput(base_url, args.backend, args.requests, levels))
+        metrics.update(bench_memory(base_url, args.backend, args.requests))
+    finally:
+        server.stop()
+
+    server, base_url = start_server(args.latency, args.token_delay, rate_429=0.05, rate_500=0.05)
+    try:
+        metrics.update(bench_errors(base_url, args.backend, args.requests))
+    finally:
+        server.stop()
+
+    metrics.update(bench_micro(args.repeat))
+
+    for name, value in metrics.items():
+        unit = "req/s" if name.startswith("throughput_") else METRICS[name][0]
+        print(f"{name:<24} {value:10.2f} {unit}")
+
+    if failures:
+        print(f"\nVerifiche fallite: {', '.join(failures)}")
+        return 1
+
+    if args.update_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"backend": args.backend, "metrics": {k: round(v, 3) for k, v in metrics.items()}}, f, indent=2)
+            f.write("\n")
+        print(f"\nRiferimento salvato in {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("\nNessun riferimento salvato: esegui con --update-baseline")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    if baseline.get("backend") != args.backend:
+        print(f"\nRiferimento misurato con il backend {baseline.get('backend')}: confronto saltato")
+        return 0
+    regressions = compare(metrics, baseline["metrics"], args.tolerance)
+    if regressions:
+        print("\nRegressioni rispetto al riferimento:")
+        for line in regressions:
+            print(f"  {line}")
+        return 1
+    print("\nNessuna regressione rispetto al riferimento")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+"""Resa delle newsletter per email: renderer a passata singola contro la catena di regex.
+
+Uso:
+    python benchmarks/bench_email_renderer.py [--batch 2000] [--repeat 5] [--large-sections 2000]
+
+Confronta utils.markdown_to_mailchimp_format (sei passate di re.sub sull'intero
+testo, output in pseudo-markup) con EmailRenderer (una passata, HTML a tabelle con
+stili in linea) sui contenuti registrati in benchmarks/responses.jsonl:
+  - tempo per newsletter e newsletter al secondo in un'esportazione in blocco;
+  - un documento grande (--large-sections sezioni) reso intero e in streaming, con
+    il picco di memoria tracemalloc dei due modi.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from email_renderer import EmailRenderer
+from fake_openai import load_responses
+from response_parser import decode_structured
+from utils import markdown_to_mailchimp_format
+
+
+def load_contents() -> List[str]:
+    contents = []
+    for response in load_responses():
+        structured = decode_structured(response["content"])
+        if structured is not None:
+            contents.append(structured["newsletter_content"])
+    return contents
+
+
+def best_of(repeat: int, func: Callable[[], None]) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def peak_kb(func: Callable[[], None]) -> float:
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--batch", type=int, default=2000, help="newsletter per esportazione")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--large-sections", type=int, default=2000, help="sezioni del documento grande")
+    args = parser.parse_args()
+
+    contents = load_contents()
+    batch = [contents[i % len(contents)] for i in range(args.batch)]
+    renderer = EmailRenderer()
+    documents = [{"markdown": content, "title": "Novità", "default_url": "https://example.com"} for content in batch]
+
+    size = sum(len(content) for content in batch) / len(batch)
+    print(f"{len(batch)} newsletter, {size:.0f} caratteri in media\n")
+    for label, func in (
+        ("catena di regex", lambda: [markdown_to_mailchimp_format(content) for content in batch]),
+        ("EmailRenderer", lambda: renderer.render_many(documents)),
+    ):
+        seconds = best_of(args.repeat, func)
+        print(f"{label:<18} {seconds / len(batch) * 1e6:8.1f} µs/newsletter  {len(batch) / seconds:10.0f} newsletter/s")
+
+    # Documento grande: le sezioni centrali ripetute
+    body = contents[0].split("\n\n", 1)[-1]
+    large = contents[0] + ("\n\n" + body) * args.large_sections
+    chunks = [large[i:i + 64] for i in range(0, len(large), 64)]
+    print(f"\nDocumento grande: {len(large) / 1024:.0f} KB")
+    for label, func in (
+        ("catena di regex", lambda: markdown_to_mailchimp_format(large)),
+        ("render", lambda: renderer.render(large)),
+        ("stream", lambda: sum(len(part) for part in renderer.stream(chunks))),
+    ):
+        seconds = best_of(args.repeat, func)
+        print(f"{label:<18} {seconds * 1e3:8.1f} ms  picco {peak_kb(func):9.0f} KB")
+
+
+if __name__ == "__main__":
+    main()
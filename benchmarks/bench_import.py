@@ -0,0 +1,66 @@
+"""Tempo di import dei moduli principali, in processi Python nuovi.
+
+Uso:
+    python benchmarks/bench_import.py [--runs 10] [--max-ms 150]
+
+Ogni modulo viene importato più volte in un interprete nuovo; si riporta la mediana.
+Lo script fallisce (codice di uscita 1) se un modulo carica uno degli SDK o delle
+librerie pesanti elencate in HEAVY_MODULES, oppure se la mediana supera --max-ms.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ("newsletter_generator", "response_parser", "utils")
+# Librerie che il core deve caricare solo quando servono davvero
+HEAVY_MODULES = ("openai", "httpx", "asyncio", "tiktoken", "streamlit")
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+heavy = sorted(name for name in {heavy!r} if name in sys.modules)
+print(json.dumps({{"elapsed": elapsed, "heavy": heavy}}))
+"""
+
+
+def measure(module: str) -> dict:
+    probe = PROBE.format(module=module, heavy=HEAVY_MODULES)
+    output = subprocess.run(
+        [sys.executable, "-c", probe], cwd=ROOT, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--max-ms", type=float, default=150.0)
+    args = parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        # Il primo import compila i .pyc: non viene conteggiato
+        measure(module)
+        samples = [measure(module) for _ in range(args.runs)]
+        median = statistics.median(s["elapsed"] for s in samples) * 1e3
+        heavy = sorted({name for s in samples for name in s["heavy"]})
+        status = "ok"
+        if heavy:
+            status = f"carica {', '.join(heavy)}"
+            failed = True
+        elif median > args.max_ms:
+            status = f"oltre {args.max_ms:.0f} ms"
+            failed = True
+        print(f"{module:<24} mediana {median:7.1f} ms  {status}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""Benchmark del parsing delle risposte sul corpus di risposte registrate.
+
+Uso:
+    python benchmarks/bench_parser.py [--repeat 2000]
+
+Confronta il parser incrementale (risposta intera e in streaming a frammenti) con il
+parsing originale basato su json.loads + scansione euristica delle righe.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from response_parser import IncrementalResponseParser, parse_response
+
+CORPUS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "responses.jsonl")
+
+
+def load_corpus(path: str = CORPUS_PATH) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def legacy_parse(content: str, company: str) -> Dict:
+    """Parsing originale di NewsletterGenerator._parse_response, come riferimento"""
+    try:
+        if content.strip().startswith('{'):
+            result = json.loads(content)
+            if all(key in result for key in ['email_subjects', 'email_previews', 'newsletter_content']):
+                return result
+    except ValueError:
+        pass
+
+    lines = content.strip().split('\n')
+    subjects = []
+    previews = []
+    current_section = None
+    content_lines = []
+    for line in lines:
+        line = line.strip()
+        if any(word in line.lower() for word in ["oggett", "subject"]):
+            current_section = "subjects"
+        elif any(word in line.lower() for word in ["anteprima", "preview"]):
+            current_section = "previews"
+        elif any(word in line.lower() for word in ["contenuto", "newsletter", "content"]):
+            current_section = "content"
+        elif line and current_section:
+            if current_section == "subjects" and len(subjects) < 3:
+                clean_line = line.replace("1.", "").replace("2.", "").replace("3.", "").replace("-", "").strip()
+                clean_line = clean_line.replace('"', '').replace("'", "")
+                if clean_line and len(clean_line) <= 40:
+                    subjects.append(clean_line)
+            elif current_section == "previews" and len(previews) < 3:
+                clean_line = line.replace("1.", "").replace("2.", "").replace("3.", "").replace("-", "").strip()
+                clean_line = clean_line.replace('"', '').replace("'", "")
+                if clean_line and len(clean_line) <= 100:
+                    previews.append(clean_line)
+            elif current_section == "content":
+                content_lines.append(line)
+    while len(subjects) < 3:
+        subjects.append(f"Newsletter {company}"[:40])
+    while len(previews) < 3:
+        previews.append(f"Scopri le novità di {company}"[:100])
+    return {
+        "email_subjects": subjects[:3],
+        "email_previews": previews[:3],
+        "newsletter_content": '\n'.join(content_lines) if content_lines else content
+    }
+
+
+def streamed_parse(content: str, company: str, chunk_size: int = 16) -> Dict:
+    parser = IncrementalResponseParser()
+    for i in range(0, len(content), chunk_size):
+        parser.feed(content[i:i + chunk_size])
+    return parse_response(content, company, parser)
+
+
+def measure(func, content: str, repeat: int) -> float:
+    """Tempo medio per chiamata in microsecondi"""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(content, "Verdi Giardini")
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    print(f"{'risposta':<22}{'byte':>7}{'legacy µs':>12}{'nuovo µs':>11}{'stream µs':>11}  oggetti estratti")
+    for sample in load_corpus():
+        content = sample["content"]
+        legacy_us = measure(legacy_parse, content, args.repeat)
+        new_us = measure(parse_response, content, args.repeat)
+        stream_us = measure(streamed_parse, content, args.repeat)
+        legacy_subjects = legacy_parse(content, "Verdi Giardini")["email_subjects"]
+        new_subjects = parse_response(content, "Verdi Giardini")["email_subjects"]
+        recovered = "=" if legacy_subjects == new_subjects else f"{legacy_subjects} -> {new_subjects}"
+        print(f"{sample['name']:<22}{len(content.encode('utf-8')):>7}"
+              f"{legacy_us:>12.1f}{new_us:>11.1f}{stream_us:>11.1f}  {recovered}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
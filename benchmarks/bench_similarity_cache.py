@@ -0,0 +1,150 @@
+"""Benchmark della cache per similarità (MinHash LSH) con molte richieste salvate.
+
+Uso:
+    python benchmarks/bench_similarity_cache.py [--entries 100000] [--queries 2000]
+
+Riempie un indice su file temporaneo con richieste sintetiche, poi misura la ricerca
+di richieste quasi identiche (stesso brief con spazi, punteggiatura o una parola diversa)
+e di richieste nuove. Il tempo della sola ricerca nell'indice è riportato separatamente
+da quello totale, che include normalizzazione e firma MinHash della richiesta.
+
+Prima verifica che due campagne diverse dello stesso brand (descrizione aziendale lunga,
+obiettivo e brief diversi) non vengano scambiate per richieste simili: lo script
+fallisce (codice di uscita 1) se succede.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from similarity_cache import SimilarityCache, request_scope
+
+WORDS = (
+    "offerta nuova collezione estate inverno sconto clienti prodotto qualità spedizione gratuita "
+    "evento lancio caffè tè design sostenibile artigianale made italy novità esclusiva limitata "
+    "settimana weekend iscritti newsletter regalo premium servizio consulenza webinar corso "
+    "software cloud sicurezza dati aziende professionisti famiglie sport benessere viaggio"
+).split()
+
+
+def make_request(rng: random.Random, brand: int) -> Dict:
+    brief = " ".join(rng.choice(WORDS) for _ in range(rng.randint(25, 60)))
+    return {
+        "company_name": f"Azienda {brand}",
+        "company_description": f"Descrizione dell'azienda {brand}",
+        "email_type": "Newsletter",
+        "email_objective": " ".join(rng.choice(WORDS) for _ in range(8)),
+        "content_brief": brief,
+        "target_audience": rng.choice(["B2B", "B2C"]),
+        "market_segments": [],
+        "tone_of_voice": "Professionale",
+        "language": "Italiano",
+        "products": [],
+        "forbidden_words": [],
+        "required_words": [],
+        "discount_codes": [],
+    }
+
+
+def near_duplicate(rng: random.Random, data: Dict) -> Dict:
+    """Stessa richiesta con spazi, punteggiatura e una parola del brief diversi"""
+    words = data["content_brief"].split()
+    words[rng.randrange(len(words))] = rng.choice(WORDS)
+    brief = "  ".join(words).capitalize() + "!"
+    return dict(data, content_brief=brief)
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def report(label: str, samples: List[float]) -> None:
+    print(
+        f"{label:<32} p50 {percentile(samples, 0.5) * 1e3:7.3f} ms  "
+        f"p99 {percentile(samples, 0.99) * 1e3:7.3f} ms  "
+        f"media {statistics.mean(samples) * 1e3:7.3f} ms"
+    )
+
+
+def check_same_brand(rng: random.Random) -> Optional[str]:
+    """Stesso brand con descrizione lunga, campagna diversa: nessuna bozza; stessa campagna riformulata: bozza"""
+    cache = SimilarityCache(":memory:")
+    data = make_request(rng, brand=1)
+    data["company_description"] = " ".join(rng.choice(WORDS) for _ in range(400))
+    cache.add(data, {"email_subjects": [], "email_previews": [], "newsletter_content": "campagna 1"})
+
+    other = dict(
+        data,
+        email_objective="Invitare i clienti al webinar di lancio del servizio cloud",
+        content_brief="Webinar gratuito giovedì alle 18 sulla sicurezza dei dati per professionisti",
+    )
+    match = cache.lookup(other)
+    if match is not None:
+        return f"campagna diversa trovata come simile ({match['similarity']:.2f})"
+    if cache.lookup(near_duplicate(rng, data)) is None:
+        return "campagna riformulata non trovata"
+    return None
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=100_000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    failure = check_same_brand(rng)
+    print(f"Verifica stesso brand, campagna diversa: {'ok' if failure is None else 'FALLITA: ' + failure}\n")
+    if failure is not None:
+        return 1
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "similar.sqlite")
+        cache = SimilarityCache(path, max_entries=args.entries)
+        stored = []
+        started = time.perf_counter()
+        for i in range(args.entries):
+            data = make_request(rng, brand=i % 500)
+            cache.add(data, {"email_subjects": [], "email_previews": [], "newsletter_content": str(i)})
+            if i % max(1, args.entries // args.queries) == 0:
+                stored.append(data)
+        build = time.perf_counter() - started
+        print(f"Voci: {cache.stats()['entries']}  inserimento {build:.1f}s "
+              f"({build / args.entries * 1e3:.3f} ms/voce)")
+
+        started = time.perf_counter()
+        cache = SimilarityCache(path, max_entries=args.entries)
+        print(f"Caricamento dell'indice da disco: {time.perf_counter() - started:.2f}s")
+
+        near = [near_duplicate(rng, rng.choice(stored)) for _ in range(args.queries)]
+        fresh = [make_request(rng, brand=rng.randrange(500)) for _ in range(args.queries)]
+
+        for label, queries in (("quasi identiche", near), ("nuove", fresh)):
+            index_times, total_times, hits = [], [], 0
+            for data in queries:
+                started = time.perf_counter()
+                match = cache.lookup(data)
+                total_times.append(time.perf_counter() - started)
+                hits += match is not None
+
+                scope, signature = request_scope(data), cache.signature(data)
+                started = time.perf_counter()
+                cache._nearest(scope, signature)
+                index_times.append(time.perf_counter() - started)
+            print(f"\nRichieste {label}: trovate {hits}/{len(queries)}")
+            report("ricerca nell'indice", index_times)
+            report("totale (firma + ricerca + lettura)", total_times)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,310 @@
+"""Server locale compatibile con le chat completions di OpenAI, per benchmark senza costi.
+
+Uso:
+    python benchmarks/fake_openai.py [--port 8000] [--latency lognormal:0.8,0.4]
+                                     [--token-delay 0.002] [--rate-429 0.05] [--rate-500 0.02]
+                                     [--responses benchmarks/responses.jsonl] [--names json_indentato,json_lungo]
+
+Poi, ad esempio:
+    NEWSLETTER_PROVIDER=http OPENAI_BASE_URL=http://127.0.0.1:8000/v1 streamlit run app.py
+    (con l'SDK installato basta OPENAI_BASE_URL)
+
+Risponde a POST /v1/chat/completions con e senza stream (server-sent events, con
+l'uso dei token nell'ultimo frammento se richiesto da stream_options). Le risposte
+sono quelle registrate nel file JSONL (campi name e content), in rotazione; le
+richieste di oggetti, corpo, sezioni e correzioni ricevono una risposta nel formato
+atteso. La latenza prima della risposta segue la distribuzione indicata (fixed:s,
+uniform:a,b, normal:media,dev, lognormal:mediana,sigma); una quota di richieste
+riceve 429 (con Retry-After) o 500. Come l'API, una risposta più lunga di max_tokens
+(stimati a 4 caratteri per token) viene tagliata con finish_reason "length". GET /stats
+restituisce i contatori.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from constraints import REPAIR_SCHEMA, REPAIR_SYSTEM_PROMPT
+from newsletter_generator import BODY_SYSTEM_PROMPT, SECTION_SYSTEM_PROMPT, SUBJECTS_SYSTEM_PROMPT
+from response_parser import SUBJECTS_SCHEMA, decode_structured
+
+RESPONSES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "responses.jsonl")
+
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """Distribuzione della latenza in secondi: fixed:s, uniform:a,b, normal:media,dev, lognormal:mediana,sigma"""
+    kind, _, args = spec.partition(":")
+    values = [float(v) for v in args.split(",") if v]
+    if kind == "fixed" and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == "uniform" and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == "normal" and len(values) == 2:
+        return lambda rng: max(0.0, rng.gauss(values[0], values[1]))
+    if kind == "lognormal" and len(values) == 2:
+        return lambda rng: rng.lognormvariate(math.log(values[0]), values[1])
+    raise ValueError(f"Distribuzione di latenza non valida: {spec}")
+
+
+def load_responses(path: str = RESPONSES_PATH, names: Optional[List[str]] = None) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        responses = [json.loads(line) for line in f if line.strip()]
+    if names:
+        responses = [r for r in responses if r["name"] in names]
+    if not responses:
+        raise ValueError("Nessuna risposta registrata da servire")
+    return responses
+
+
+class FakeOpenAI:
+    """Stato del server: risposte registrate, latenza, errori iniettati e contatori"""
+
+    def __init__(
+        self,
+        responses: Optional[List[Dict]] = None,
+        latency: str = "fixed:0",
+        token_delay: float = 0.0,
+        chunk_size: int = 16,
+        rate_429: float = 0.0,
+        rate_500: float = 0.0,
+        retry_after: float = 0.05,
+        seed: int = 7,
+    ):
+        self.responses = responses if responses is not None else load_responses()
+        self.latency = parse_latency(latency)
+        self.token_delay = token_delay
+        self.chunk_size = chunk_size
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._cycle = itertools.cycle(range(len(self.responses)))
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "streams": 0, "cancelled": 0, "truncated": 0, "429": 0, "500": 0}
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def draw(self) -> Dict:
+        """Latenza, errore da iniettare (None, 429 o 500) e risposta registrata per la prossima richiesta"""
+        with self._lock:
+            roll = self._rng.random()
+            error = 429 if roll < self.rate_429 else 500 if roll < self.rate_429 + self.rate_500 else None
+            return {
+                "latency": self.latency(self._rng),
+                "error": error,
+                "recorded": self.responses[next(self._cycle)]["content"],
+            }
+
+    def content_for(self, request: Dict, recorded: str) -> str:
+        """Testo della risposta nel formato atteso dal tipo di richiesta"""
+        messages = request.get("messages") or [{}]
+        system = messages[0].get("content") or ""
+        schema = ((request.get("response_format") or {}).get("json_schema") or {}).get("name")
+        structured = decode_structured(recorded)
+        if schema == REPAIR_SCHEMA["name"] or system.startswith(REPAIR_SYSTEM_PROMPT):
+            return json.dumps({"items": []})
+        if schema == SUBJECTS_SCHEMA["name"] or system == SUBJECTS_SYSTEM_PROMPT:
+            if structured is None:
+                structured = {"email_subjects": ["Le novità del mese"] * 3, "email_previews": ["Tutte le novità"] * 3}
+            return json.dumps(
+                {k: structured[k] for k in ("email_subjects", "email_previews")}, ensure_ascii=False
+            )
+        if system in (BODY_SYSTEM_PROMPT, SECTION_SYSTEM_PROMPT):
+            body = structured["newsletter_content"] if structured else recorded
+            return body.split("\n\n", 1)[-1] if system == SECTION_SYSTEM_PROMPT else body
+        return recorded
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return dict(self.counters)
+
+
+def _usage(request: Dict, content: str) -> Dict:
+    prompt_tokens = sum(len(m.get("content") or "") for m in request.get("messages") or []) // 4
+    completion_tokens = max(1, len(content) // 4)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": 0},
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server: "FakeOpenAIServer"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send_json(self, status: int, payload: Dict, headers: Optional[Dict] = None) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        if self.path.rstrip("/") == "/stats":
+            self._send_json(200, self.server.fake.stats())
+        elif self.path.rstrip("/") in ("/v1/models", "/models"):
+            self._send_json(200, {"object": "list", "data": [{"id": "gpt-4", "object": "model"}]})
+        else:
+            self._send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self) -> None:
+        if self.path.rstrip("/") not in ("/v1/chat/completions", "/chat/completions"):
+            self._send_json(404, {"error": {"message": "Not found"}})
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        fake = self.server.fake
+        fake._count("requests")
+        draw = fake.draw()
+        time.sleep(draw["latency"])
+
+        if draw["error"] == 429:
+            fake._count("429")
+            self._send_json(
+                429, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                {"Retry-After": f"{fake.retry_after:g}"},
+            )
+            return
+        if draw["error"] == 500:
+            fake._count("500")
+            self._send_json(500, {"error": {"message": "The server had an error", "type": "server_error"}})
+            return
+
+        content = fake.content_for(request, draw["recorded"])
+        finish_reason = "stop"
+        max_tokens = request.get("max_tokens")
+        if max_tokens and len(content) // 4 > max_tokens:
+            fake._count("truncated")
+            content, finish_reason = content[:max_tokens * 4], "length"
+        n = int(request.get("n") or 1)
+        completion_id = f"chatcmpl-fake{int(time.time() * 1000)}"
+        base = {"id": completion_id, "created": int(time.time()), "model": request.get("model", "gpt-4")}
+        if request.get("stream"):
+            fake._count("streams")
+            self._stream(request, content, base, finish_reason)
+            return
+        self._send_json(200, dict(
+            base,
+            object="chat.completion",
+            choices=[
+                {"index": i, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}
+                for i in range(n)
+            ],
+            usage=_usage(request, content),
+        ))
+
+    def _stream(self, request: Dict, content: str, base: Dict, finish_reason: str = "stop") -> None:
+        fake = self.server.fake
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(payload) -> None:
+            data = b"data: " + (payload if isinstance(payload, bytes) else json.dumps(payload).encode("utf-8")) + b"\n\n"
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def chunk(delta: Dict, finish_reason: Optional[str] = None) -> Dict:
+            return dict(base, object="chat.completion.chunk", usage=None,
+                        choices=[{"index": 0, "delta": delta, "finish_reason": finish_reason}])
+
+        try:
+            event(chunk({"role": "assistant", "content": ""}))
+            for i in range(0, len(content), fake.chunk_size):
+                if fake.token_delay:
+                    time.sleep(fake.token_delay)
+                event(chunk({"content": content[i:i + fake.chunk_size]}))
+            event(chunk({}, finish_reason))
+            if (request.get("stream_options") or {}).get("include_usage"):
+                event(dict(base, object="chat.completion.chunk", choices=[], usage=_usage(request, content)))
+            event(b"[DONE]")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # Stream chiuso dal client (es. richiesta di copertura che ha perso)
+            fake._count("cancelled")
+
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    """Server HTTP multithread; start() lo avvia in background e restituisce la base_url"""
+
+    daemon_threads = True
+
+    def __init__(self, fake: FakeOpenAI, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), Handler)
+        self.fake = fake
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self.serve_forever, name="fake-openai", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", default="lognormal:0.8,0.4")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="attesa tra due frammenti dello stream")
+    parser.add_argument("--chunk-size", type=int, default=16)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-500", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--responses", default=RESPONSES_PATH)
+    parser.add_argument("--names", default="", help="nomi delle risposte da servire, separati da virgola")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    fake = FakeOpenAI(
+        load_responses(args.responses, [n for n in args.names.split(",") if n]),
+        latency=args.latency,
+        token_delay=args.token_delay,
+        chunk_size=args.chunk_size,
+        rate_429=args.rate_429,
+        rate_500=args.rate_500,
+        retry_after=args.retry_after,
+        seed=args.seed,
+    )
+    server = FakeOpenAIServer(fake, args.host, args.port)
+    print(f"Server in ascolto su {server.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
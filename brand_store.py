@@ -0,0 +1,103 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Optional
+from urllib.parse import urlparse
+
+from cache import DEFAULT_CACHE_DIR
+
+DEFAULT_BRAND_PATH = os.path.join(DEFAULT_CACHE_DIR, "brands.sqlite")
+
+
+def brand_key(company_name: str, website_url: str = "") -> str:
+    """Chiave del brand: nome normalizzato + dominio del sito (senza www)"""
+    name = " ".join((company_name or "").lower().split())
+    domain = urlparse(website_url or "").netloc.lower()
+    if domain.startswith("www."):
+        domain = domain[4:]
+    return f"{name}|{domain}"
+
+
+def source_hash(data: Dict) -> str:
+    """Impronta della descrizione sorgente: se cambia, il riassunto va rifatto"""
+    source = " ".join((data.get("company_description") or "").split())
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+class BrandProfileStore:
+    """Profili dei brand ricorrenti su SQLite, con la descrizione già riassunta
+
+    Il riassunto viene calcolato una sola volta per brand e riusato nei prompt
+    successivi; se la descrizione cambia il profilo viene rigenerato.
+    """
+
+    def __init__(self, path: str = DEFAULT_BRAND_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS brands (
+                brand_key TEXT PRIMARY KEY,
+                company_name TEXT NOT NULL,
+                website_url TEXT NOT NULL,
+                source_hash TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                tone_of_voice TEXT NOT NULL,
+                uses INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get(self, data: Dict) -> Optional[Dict]:
+        """Profilo del brand, oppure None se assente o se i testi sorgente sono cambiati"""
+        key = brand_key(data.get("company_name", ""), data.get("website_url", ""))
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT source_hash, summary, tone_of_voice, uses FROM brands WHERE brand_key = ?",
+                (key,),
+            ).fetchone()
+            if row is None or row[0] != source_hash(data):
+                return None
+            self._conn.execute("UPDATE brands SET uses = uses + 1 WHERE brand_key = ?", (key,))
+            self._conn.commit()
+        return {"summary": row[1], "tone_of_voice": row[2], "uses": row[3] + 1}
+
+    def save(self, data: Dict, summary: str) -> Dict:
+        """Salva (o sostituisce) il profilo del brand"""
+        key = brand_key(data.get("company_name", ""), data.get("website_url", ""))
+        tone = data.get("tone_of_voice") or ""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO brands "
+                "(brand_key, company_name, website_url, source_hash, summary, tone_of_voice, uses, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, 1, ?)",
+                (key, data.get("company_name", ""), data.get("website_url") or "",
+                 source_hash(data), summary, tone, time.time()),
+            )
+            self._conn.commit()
+        return {"summary": summary, "tone_of_voice": tone, "uses": 1}
+
+    def get_or_create(self, data: Dict, summarize: Callable[[Dict], str]) -> Dict:
+        """Profilo del brand, calcolando il riassunto con summarize se manca o è scaduto"""
+        profile = self.get(data)
+        if profile is not None:
+            return profile
+        return self.save(data, summarize(data))
+
+    def delete(self, company_name: str, website_url: str = "") -> None:
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM brands WHERE brand_key = ?", (brand_key(company_name, website_url),)
+            )
+            self._conn.commit()
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM brands").fetchone()[0]
@@ -0,0 +1,232 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# (modello, budget di latenza in secondi)
+DEFAULT_TIERS = [("gpt-4", 90.0), ("gpt-3.5-turbo", 45.0)]
+
+
+class LatencyTracker:
+    """Latenze recenti delle chiamate riuscite, per modello"""
+
+    def __init__(self, window: int = 200, min_samples: int = 5):
+        self.min_samples = min_samples
+        self._window = window
+        self._samples: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def record(self, model: str, seconds: float) -> None:
+        with self._lock:
+            self._samples.setdefault(model, deque(maxlen=self._window)).append(seconds)
+
+    def percentile(self, model: str, p: float) -> Optional[float]:
+        """Percentile p (0-1) delle latenze osservate, None se i campioni sono troppo pochi"""
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1, int(round(p * (len(samples) - 1))))
+        return samples[index]
+
+
+class ModelCascade:
+    """Cascata di modelli con budget di latenza e richieste di copertura (hedging)
+
+    Il primo livello parte subito. Se non risponde entro il percentile configurato
+    delle sue latenze recenti, parte in parallelo una richiesta al livello successivo
+    (più veloce) e vince la prima risposta valida. Un livello che fallisce o supera il
+    proprio budget passa subito la mano al successivo; se tutti falliscono run()
+    restituisce None e il chiamante usa il template locale.
+    """
+
+    def __init__(
+        self,
+        tiers: Optional[List[Tuple[str, float]]] = None,
+        hedge_percentile: float = 0.9,
+        default_hedge_delay: float = 30.0,
+        max_workers: int = 8,
+    ):
+        self.tiers = list(tiers or DEFAULT_TIERS)
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.latencies = LatencyTracker()
+        # Per gli stream conta l'attesa del primo frammento, non la durata della risposta
+        self.first_token_latencies = LatencyTracker()
+        self.hedges = 0
+        self.wins: Dict[str, int] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="cascade")
+        self._lock = threading.Lock()
+
+    def hedge_delay(self, model: str, budget: float, latencies: Optional[LatencyTracker] = None) -> float:
+        """Attesa prima di lanciare la richiesta di copertura per il modello"""
+        observed = (latencies or self.latencies).percentile(model, self.hedge_percentile)
+        delay = observed if observed is not None else self.default_hedge_delay
+        return min(delay, budget)
+
+    def _timed(self, call: Callable[[str], Dict], model: str) -> Dict:
+        start = time.perf_counter()
+        result = call(model)
+        self.latencies.record(model, time.perf_counter() - start)
+        return result
+
+    def run(self, call: Callable[[str], Dict]) -> Tuple[Optional[Dict], Optional[str]]:
+        """Esegue call(modello) lungo la cascata; restituisce (risultato, modello vincente)
+
+        call deve sollevare un'eccezione se la risposta non è valida.
+        """
+        running: Dict[Future, Tuple[str, float]] = {}
+        next_tier = 0
+        hedge_at = None
+
+        def launch() -> None:
+            nonlocal next_tier, hedge_at
+            model, budget = self.tiers[next_tier]
+            next_tier += 1
+            now = time.monotonic()
+            # La chiamata eredita il contesto, così le sue fasi restano nella traccia della generazione
+            future = self._executor.submit(contextvars.copy_context().run, self._timed, call, model)
+            running[future] = (model, now + budget)
+            hedge_at = None
+            if next_tier < len(self.tiers):
+                hedge_at = now + self.hedge_delay(model, budget)
+
+        launch()
+        while running:
+            now = time.monotonic()
+            deadlines = [deadline for _, deadline in running.values()]
+            if hedge_at is not None:
+                deadlines.append(hedge_at)
+            timeout = max(0.0, min(deadlines) - now)
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                model, _ = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning("Modello %s non disponibile: %s", model, e)
+                    if next_tier < len(self.tiers):
+                        launch()
+                    continue
+                with self._lock:
+                    self.wins[model] = self.wins.get(model, 0) + 1
+                return result, model
+
+            now = time.monotonic()
+            # Livelli oltre il budget: si smette di attenderli (la chiamata termina in background)
+            for future, (model, deadline) in list(running.items()):
+                if now >= deadline:
+                    logger.warning("Modello %s oltre il budget di latenza", model)
+                    running.pop(future)
+                    if next_tier < len(self.tiers):
+                        launch()
+
+            if hedge_at is not None and now >= hedge_at and next_tier < len(self.tiers):
+                with self._lock:
+                    self.hedges += 1
+                launch()
+
+        return None, None
+
+    def _first_delta(self, deltas: Iterator[str], model: str) -> str:
+        start = time.perf_counter()
+        for delta in deltas:
+            if delta:
+                self.first_token_latencies.record(model, time.perf_counter() - start)
+                return delta
+        raise ValueError(f"Stream vuoto da {model}")
+
+    def stream(self, open_stream: Callable[[str], Iterator[str]],
+               on_model: Optional[Callable[[str], None]] = None) -> Iterator[str]:
+        """Come run(), per le risposte in streaming: vince il primo livello che produce un frammento
+
+        open_stream(modello) restituisce l'iteratore dei frammenti; la copertura parte se il
+        primo frammento non arriva entro il percentile delle attese recenti. Gli stream
+        perdenti vengono chiusi e on_model(modello vincente) è chiamata prima del primo
+        frammento. Un errore dopo il primo frammento arriva al chiamante; se nessun livello
+        risponde non viene prodotto nulla.
+        """
+        running: Dict[Future, Tuple[str, float, Iterator[str]]] = {}
+        next_tier = 0
+        hedge_at = None
+
+        def launch() -> None:
+            nonlocal next_tier, hedge_at
+            model, budget = self.tiers[next_tier]
+            next_tier += 1
+            now = time.monotonic()
+            deltas = open_stream(model)
+            future = self._executor.submit(contextvars.copy_context().run, self._first_delta, deltas, model)
+            running[future] = (model, now + budget, deltas)
+            hedge_at = None
+            if next_tier < len(self.tiers):
+                hedge_at = now + self.hedge_delay(model, budget, self.first_token_latencies)
+
+        def discard(future: Future, deltas: Iterator[str]) -> None:
+            # Lo stream si chiude quando il thread ha finito di leggerlo
+            future.add_done_callback(lambda _: getattr(deltas, "close", lambda: None)())
+
+        launch()
+        winner = None
+        while running:
+            now = time.monotonic()
+            deadlines = [deadline for _, deadline, _ in running.values()]
+            if hedge_at is not None:
+                deadlines.append(hedge_at)
+            timeout = max(0.0, min(deadlines) - now)
+            done, _ = wait(list(running), timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                model, _, deltas = running.pop(future)
+                try:
+                    first = future.result()
+                except Exception as e:
+                    logger.warning("Modello %s non disponibile: %s", model, e)
+                    if next_tier < len(self.tiers):
+                        launch()
+                    continue
+                if winner is None:
+                    winner = model, first, deltas
+                else:
+                    discard(future, deltas)
+            if winner is not None:
+                break
+
+            now = time.monotonic()
+            for future, (model, deadline, deltas) in list(running.items()):
+                if now >= deadline:
+                    logger.warning("Modello %s oltre il budget di latenza", model)
+                    running.pop(future)
+                    discard(future, deltas)
+                    if next_tier < len(self.tiers):
+                        launch()
+
+            if hedge_at is not None and now >= hedge_at and next_tier < len(self.tiers):
+                with self._lock:
+                    self.hedges += 1
+                launch()
+
+        for future, (_, _, deltas) in running.items():
+            discard(future, deltas)
+        if winner is None:
+            return
+        model, first, deltas = winner
+        with self._lock:
+            self.wins[model] = self.wins.get(model, 0) + 1
+        if on_model is not None:
+            on_model(model)
+        try:
+            yield first
+            yield from deltas
+        finally:
+            getattr(deltas, "close", lambda: None)()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"hedges": self.hedges, "wins": dict(self.wins)}
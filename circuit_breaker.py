@@ -0,0 +1,186 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+
+from scheduler import error_status, is_retryable
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Chiamata rifiutata perché il circuito verso il provider è aperto"""
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"Provider non disponibile, nuovo tentativo tra {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """Interruttore di circuito sulle chiamate al provider
+
+    Da chiuso registra esito e latenza delle chiamate recenti: se la quota di errori
+    temporanei (5xx, timeout, errori di rete) o di chiamate lente supera la soglia, il circuito
+    si apre e per open_seconds le chiamate vengono rifiutate subito con CircuitOpenError,
+    così il chiamante passa al template senza attendere i timeout. Trascorsa l'attesa
+    il circuito è semiaperto: passano solo alcune chiamate di prova, che lo richiudono
+    se vanno a buon fine (anche se lente) o lo riaprono al primo errore.
+
+    Una chiamata è lenta oltre slow_call_seconds, oppure oltre la soglia passata a
+    call()/acall() per quella chiamata (es. il budget di latenza del modello): una
+    risposta completa di GPT-4 può richiedere normalmente più di un minuto.
+    """
+
+    def __init__(
+        self,
+        window_seconds: float = 60.0,
+        min_calls: int = 5,
+        failure_rate: float = 0.5,
+        slow_call_seconds: float = 120.0,
+        slow_call_rate: float = 0.8,
+        open_seconds: float = 30.0,
+        half_open_probes: int = 2,
+    ):
+        self.window_seconds = window_seconds
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._lock = threading.Lock()
+        self._state = CIRCUIT_CLOSED
+        self._opened_at = 0.0
+        # Esiti recenti: (istante, errore, lenta)
+        self._calls: Deque[Tuple[float, bool, bool]] = deque()
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            self._refresh(time.monotonic())
+            return self._state
+
+    def is_open(self) -> bool:
+        """True se le chiamate verrebbero rifiutate (senza consumare una chiamata di prova)"""
+        with self._lock:
+            self._refresh(time.monotonic())
+            return self._state == CIRCUIT_OPEN or (
+                self._state == CIRCUIT_HALF_OPEN and self._probes_in_flight >= self.half_open_probes
+            )
+
+    def _refresh(self, now: float) -> None:
+        """Passa da aperto a semiaperto allo scadere dell'attesa (chiamato con il lock)"""
+        if self._state == CIRCUIT_OPEN and now - self._opened_at >= self.open_seconds:
+            self._state = CIRCUIT_HALF_OPEN
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+
+    def _open(self, now: float) -> None:
+        if self._state != CIRCUIT_OPEN:
+            self.opened += 1
+            logger.warning("Circuito verso il provider aperto: uso il template di fallback")
+        self._state = CIRCUIT_OPEN
+        self._opened_at = now
+        self._calls.clear()
+
+    def acquire(self) -> bool:
+        """Riserva una chiamata; restituisce True se è una chiamata di prova
+
+        Solleva CircuitOpenError se il circuito è aperto o le prove sono già tutte in corso.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refresh(now)
+            if self._state == CIRCUIT_CLOSED:
+                return False
+            if self._state == CIRCUIT_HALF_OPEN and self._probes_in_flight < self.half_open_probes:
+                self._probes_in_flight += 1
+                return True
+            self.rejected += 1
+            retry_in = max(0.0, self.open_seconds - (now - self._opened_at))
+        raise CircuitOpenError(retry_in)
+
+    def record(self, seconds: float, error: Optional[BaseException] = None, probe: bool = False,
+               slow_call_seconds: Optional[float] = None) -> None:
+        """Registra l'esito di una chiamata riservata con acquire()"""
+        # Gli errori definitivi (chiave non valida, richiesta errata) non dicono nulla sullo stato
+        # del provider e i 429 vengono già assorbiti dallo scheduler rallentando le richieste
+        failed = isinstance(error, Exception) and is_retryable(error) and error_status(error) != 429
+        slow = seconds >= (slow_call_seconds if slow_call_seconds is not None else self.slow_call_seconds)
+        with self._lock:
+            now = time.monotonic()
+            if probe:
+                self._probes_in_flight = max(0, self._probes_in_flight - 1)
+                if self._state != CIRCUIT_HALF_OPEN:
+                    return
+                # Una prova lenta ma riuscita dice che il provider risponde: conta come successo
+                if failed:
+                    self._open(now)
+                elif error is None:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_probes:
+                        self._state = CIRCUIT_CLOSED
+                        logger.info("Circuito verso il provider richiuso")
+                return
+            if self._state != CIRCUIT_CLOSED:
+                return
+
+            self._calls.append((now, failed, slow))
+            while self._calls and now - self._calls[0][0] > self.window_seconds:
+                self._calls.popleft()
+            total = len(self._calls)
+            if total < self.min_calls:
+                return
+            failures = sum(1 for _, f, _ in self._calls if f)
+            slow_calls = sum(1 for _, _, s in self._calls if s)
+            if failures / total >= self.failure_rate or slow_calls / total >= self.slow_call_rate:
+                self._open(now)
+
+    def call(self, func: Callable[[], T], slow_call_seconds: Optional[float] = None) -> T:
+        """Esegue func attraverso il circuito; slow_call_seconds sostituisce la soglia di lentezza"""
+        probe = self.acquire()
+        started = time.perf_counter()
+        try:
+            result = func()
+        except Exception as e:
+            self.record(time.perf_counter() - started, e, probe, slow_call_seconds)
+            raise
+        self.record(time.perf_counter() - started, probe=probe, slow_call_seconds=slow_call_seconds)
+        return result
+
+    async def acall(self, func: Callable[[], Awaitable[T]], slow_call_seconds: Optional[float] = None) -> T:
+        """Versione asincrona di call"""
+        probe = self.acquire()
+        started = time.perf_counter()
+        try:
+            result = await func()
+        except BaseException as e:
+            # Anche una cancellazione libera la chiamata di prova (senza contare come esito)
+            self.record(time.perf_counter() - started, e, probe, slow_call_seconds)
+            raise
+        self.record(time.perf_counter() - started, probe=probe, slow_call_seconds=slow_call_seconds)
+        return result
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._refresh(time.monotonic())
+            total = len(self._calls)
+            return {
+                "state": self._state,
+                "calls": total,
+                "failure_rate": sum(1 for _, f, _ in self._calls if f) / total if total else 0.0,
+                "slow_rate": sum(1 for _, _, s in self._calls if s) / total if total else 0.0,
+                "opened": self.opened,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,178 @@
+"""Generazione massiva di newsletter da riga di comando.
+
+Esempio:
+    python cli.py campagne.csv -o risultati.jsonl --workers 8
+
+Ogni riga del file di input (CSV con intestazione oppure JSONL) viene convertita nello
+stesso dizionario dati costruito dall'app Streamlit, validata e generata. I risultati
+vengono scritti in JSONL nello stesso ordine dell'input, man mano che sono pronti;
+rilanciando lo stesso comando l'elaborazione riprende dalla prima riga non completata.
+Le righe generate con il template di fallback (provider non raggiungibile o circuito
+aperto) hanno "fallback": true e alla ripresa vengono rigenerate.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from cache import ResponseCache
+from email_renderer import newsletter_html
+from telemetry import Telemetry, configure_logging
+from utils import build_newsletter_data, validate_inputs
+
+
+def iter_rows(path: str) -> Iterator[Dict]:
+    """Legge le righe del file di input una alla volta (CSV o JSONL)"""
+    if path.lower().endswith((".jsonl", ".ndjson")):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        with open(path, encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                yield row
+
+
+def count_completed(path: str) -> int:
+    """Conta le righe già completate nel file di output, scartando un'eventuale riga troncata
+
+    Il conteggio si ferma alla prima riga generata con il template di fallback: da lì
+    l'output viene troncato e la ripresa la rigenera (le successive già generate
+    tornano dalla cache delle risposte).
+    """
+    if not os.path.exists(path):
+        return 0
+
+    completed = 0
+    valid_bytes = 0
+    with open(path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if isinstance(record, dict) and record.get("fallback"):
+                break
+            completed += 1
+            valid_bytes += len(line)
+
+    # Rimuove la coda scritta a metà da un'esecuzione interrotta (o da rigenerare)
+    if valid_bytes < os.path.getsize(path):
+        with open(path, "r+b") as f:
+            f.truncate(valid_bytes)
+    return completed
+
+
+def process_row(generator, index: int, row: Dict, use_cache: bool, html: bool = False) -> Dict:
+    """Valida e genera una singola riga"""
+    with generator.telemetry.span("validate_inputs"):
+        data = build_newsletter_data(row)
+        errors = validate_inputs(data)
+    if errors:
+        return {"row": index, "company_name": data["company_name"], "errors": errors, "fallback": False,
+                "result": None}
+
+    result = generator.generate_newsletter(data, use_cache=use_cache)
+    if html:
+        result["newsletter_html"] = newsletter_html(result, data)
+    return {"row": index, "company_name": data["company_name"], "errors": [],
+            "fallback": bool(result.get("fallback")), "result": result}
+
+
+def run(args: argparse.Namespace) -> int:
+    from newsletter_generator import NewsletterGenerator
+
+    api_key = args.api_key or os.environ.get("OPENAI_API_KEY")
+    if not api_key:
+        print("Errore: specifica --api-key oppure la variabile OPENAI_API_KEY", file=sys.stderr)
+        return 2
+
+    configure_logging(args.log_level, json_logs=args.log_format == "json")
+    telemetry = Telemetry(metrics_path=args.metrics_file)
+    cache = None if args.no_cache else ResponseCache()
+    generator = NewsletterGenerator(api_key, cache=cache, telemetry=telemetry)
+
+    skip = count_completed(args.output) if args.resume else 0
+    if skip:
+        print(f"Ripresa dalla riga {skip + 1}", file=sys.stderr)
+
+    rows = (
+        (index, row)
+        for index, row in enumerate(iter_rows(args.input))
+        if index >= skip
+    )
+    max_in_flight = max(1, args.workers) * 2
+    done = 0
+    fallbacks = 0
+
+    mode = "a" if args.resume else "w"
+    with open(args.output, mode, encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        pending = []
+
+        def flush_head() -> None:
+            nonlocal done, fallbacks
+            record = pending.pop(0).result()
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            done += 1
+            if record["errors"]:
+                print(f"Riga {record['row'] + 1}: {'; '.join(record['errors'])}", file=sys.stderr)
+            elif record["fallback"]:
+                fallbacks += 1
+                print(f"Riga {record['row'] + 1}: template di fallback (provider non disponibile)", file=sys.stderr)
+
+        # Finestra limitata di richieste in corso: memoria costante anche su file molto grandi
+        for index, row in rows:
+            pending.append(executor.submit(process_row, generator, index, row, not args.no_cache, args.html))
+            if len(pending) >= max_in_flight:
+                flush_head()
+        while pending:
+            flush_head()
+
+    telemetry.write_metrics()
+    print(f"Completate {done} righe ({skip + done} totali) in {args.output}", file=sys.stderr)
+    if fallbacks:
+        print(f"{fallbacks} righe con il template di fallback: rilancia lo stesso comando per rigenerarle",
+              file=sys.stderr)
+    return 0
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Genera newsletter in blocco da un file CSV o JSONL")
+    parser.add_argument("input", help="File di input (.csv con intestazione oppure .jsonl)")
+    parser.add_argument("-o", "--output", required=True, help="File JSONL di output")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Numero di generazioni in parallelo")
+    parser.add_argument("--api-key", help="OpenAI API Key (default: OPENAI_API_KEY)")
+    parser.add_argument("--no-cache", action="store_true", help="Non usare la cache delle risposte")
+    parser.add_argument("--html", action="store_true", help="Aggiunge a ogni risultato l'HTML dell'email (newsletter_html)")
+    parser.add_argument(
+        "--no-resume",
+        dest="resume",
+        action="store_false",
+        help="Riparte dall'inizio sovrascrivendo il file di output"
+    )
+    parser.add_argument(
+        "--log-level",
+        default="WARNING",
+        help="Livello dei log su stderr (INFO include i tempi di ogni fase)"
+    )
+    parser.add_argument("--log-format", choices=["json", "text"], default="json", help="Formato dei log")
+    parser.add_argument("--metrics-file", help="File delle metriche in formato Prometheus, aggiornato durante l'esecuzione")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    return run(parse_args(argv))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
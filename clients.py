@@ -0,0 +1,109 @@
+import hashlib
+import importlib.util
+import logging
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def api_key_fingerprint(api_key: str) -> str:
+    """Impronta dell'API key, usata come chiave senza conservare la chiave in chiaro"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class ClientRegistry:
+    """Registro thread-safe di client OpenAI condivisi, uno per API key
+
+    Ogni client usa un pool di connessioni httpx con keep-alive (e HTTP/2 se il
+    pacchetto h2 è installato), così le generazioni successive riutilizzano le
+    connessioni TLS già aperte. I client inutilizzati da più di idle_ttl secondi
+    vengono chiusi.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 20,
+        max_keepalive_connections: int = 10,
+        keepalive_expiry: float = 60.0,
+        idle_ttl: float = 15 * 60,
+        timeout: float = 120.0,
+    ):
+        self.max_connections = max_connections
+        self.max_keepalive_connections = max_keepalive_connections
+        self.keepalive_expiry = keepalive_expiry
+        self.idle_ttl = idle_ttl
+        self.timeout = timeout
+        self.http2 = importlib.util.find_spec("h2") is not None
+        self.created = 0
+        self.reused = 0
+        self._clients: Dict[str, Tuple[object, float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, api_key: str):
+        """Restituisce il client per l'API key, creandolo se necessario
+
+        Restituisce None se è installato solo l'SDK OpenAI legacy (< 1.0).
+        """
+        key = api_key_fingerprint(api_key)
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now, keep=key)
+            entry = self._clients.get(key)
+            if entry is not None:
+                self._clients[key] = (entry[0], now)
+                self.reused += 1
+                return entry[0]
+
+            client = self._build_client(api_key)
+            if client is not None:
+                self._clients[key] = (client, now)
+                self.created += 1
+            return client
+
+    def _build_client(self, api_key: str):
+        try:
+            import httpx
+            from openai import OpenAI
+        except ImportError:
+            return None
+
+        http_client = httpx.Client(
+            http2=self.http2,
+            timeout=httpx.Timeout(self.timeout, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+        )
+        # I tentativi sono gestiti da scheduler.RequestScheduler
+        return OpenAI(api_key=api_key, http_client=http_client, max_retries=0)
+
+    def _evict_idle(self, now: float, keep: Optional[str] = None) -> None:
+        """Chiude i client non usati da più di idle_ttl secondi (chiamato con il lock)"""
+        expired = [
+            key for key, (_, last_used) in self._clients.items()
+            if key != keep and now - last_used > self.idle_ttl
+        ]
+        for key in expired:
+            client, _ = self._clients.pop(key)
+            try:
+                client.close()
+            except Exception as e:
+                logger.warning("Errore nella chiusura del client: %s", e)
+
+    def close(self) -> None:
+        """Chiude tutti i client"""
+        with self._lock:
+            self._evict_idle(float("inf"))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "clients": len(self._clients),
+                "created": self.created,
+                "reused": self.reused,
+                "http2": self.http2,
+            }
@@ -0,0 +1,258 @@
+import json
+import re
+import unicodedata
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from prompt_budget import estimate_tokens
+from response_parser import (
+    CONTENT_KEY, MAX_PREVIEW_LENGTH, MAX_SUBJECT_LENGTH, PREVIEWS_KEY, SUBJECTS_KEY
+)
+
+_PARAGRAPH_SPLIT = re.compile(r'\n\s*\n')
+
+
+def fold(text: str) -> str:
+    """Testo senza accenti e senza distinzione tra maiuscole e minuscole"""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+class AhoCorasick:
+    """Automa di Aho-Corasick: trova tutte le occorrenze di più parole in un solo passaggio"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns = list(patterns)
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[int]] = [[]]
+
+        for index, pattern in enumerate(self.patterns):
+            node = 0
+            for char in pattern:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                node = next_node
+            if pattern:
+                self._out[node].append(index)
+
+        # Collegamenti di fallimento in ampiezza
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[child] = self._goto[fallback].get(char, 0)
+                self._out[child].extend(self._out[self._fail[child]])
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int, int]]:
+        """Occorrenze come (inizio, fine, indice della parola)"""
+        node = 0
+        goto = self._goto
+        fail = self._fail
+        for i, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for index in self._out[node]:
+                yield i - len(self.patterns[index]) + 1, i + 1, index
+
+
+class ConstraintChecker:
+    """Verifica parole vietate/obbligatorie e limiti di caratteri su una newsletter generata
+
+    Le parole vengono cercate a parola intera, senza distinguere maiuscole e accenti,
+    con un solo automa per entrambe le liste.
+    """
+
+    def __init__(self, forbidden_words: Iterable[str] = (), required_words: Iterable[str] = ()):
+        self.forbidden = [w.strip() for w in forbidden_words if w and w.strip()]
+        self.required = [w.strip() for w in required_words if w and w.strip()]
+        self._automaton = AhoCorasick([fold(w) for w in self.forbidden + self.required])
+
+    def find_words(self, text: str) -> Tuple[List[str], List[str]]:
+        """Parole vietate e obbligatorie presenti nel testo"""
+        folded = fold(text)
+        forbidden, required = set(), set()
+        for start, end, index in self._automaton.iter_matches(folded):
+            if start > 0 and folded[start - 1].isalnum():
+                continue
+            if end < len(folded) and folded[end].isalnum():
+                continue
+            if index < len(self.forbidden):
+                forbidden.add(self.forbidden[index])
+            else:
+                required.add(self.required[index - len(self.forbidden)])
+        return sorted(forbidden), sorted(required)
+
+    def check(self, result: Dict) -> List[Dict]:
+        """Elenco delle violazioni: ognuna indica campo, posizione, testo e problemi"""
+        violations = []
+        found_required = set()
+
+        def scan(field: str, index: int, text: str, max_length: Optional[int]) -> None:
+            problems = []
+            forbidden, required = self.find_words(text)
+            found_required.update(required)
+            if forbidden:
+                problems.append(f"contiene parole vietate: {', '.join(forbidden)}")
+            if max_length is not None and len(text) > max_length:
+                problems.append(f"supera {max_length} caratteri ({len(text)})")
+            if problems:
+                violations.append({"field": field, "index": index, "text": text, "problems": problems})
+
+        for i, subject in enumerate(result.get(SUBJECTS_KEY, [])):
+            scan(SUBJECTS_KEY, i, subject, MAX_SUBJECT_LENGTH)
+        for i, preview in enumerate(result.get(PREVIEWS_KEY, [])):
+            scan(PREVIEWS_KEY, i, preview, MAX_PREVIEW_LENGTH)
+        paragraphs = split_paragraphs(result.get(CONTENT_KEY, ""))
+        for i, paragraph in enumerate(paragraphs):
+            scan(CONTENT_KEY, i, paragraph, None)
+
+        missing = [w for w in self.required if w not in found_required]
+        if missing:
+            problem = f"deve includere le parole: {', '.join(missing)}"
+            index = _body_paragraph_index(paragraphs)
+            existing = next(
+                (v for v in violations if v["field"] == CONTENT_KEY and v["index"] == index), None
+            )
+            if existing is not None:
+                existing["problems"].append(problem)
+            elif index is not None:
+                violations.append({"field": CONTENT_KEY, "index": index, "text": paragraphs[index], "problems": [problem]})
+        return violations
+
+
+def split_paragraphs(content: str) -> List[str]:
+    return [p for p in _PARAGRAPH_SPLIT.split(content or "") if p.strip()]
+
+
+def join_paragraphs(paragraphs: List[str]) -> str:
+    return "\n\n".join(paragraphs)
+
+
+def _body_paragraph_index(paragraphs: List[str]) -> Optional[int]:
+    """Primo paragrafo di testo (non titolo né pulsante), dove inserire le parole mancanti"""
+    for i, paragraph in enumerate(paragraphs):
+        stripped = paragraph.strip()
+        if not stripped.startswith(("#", "**[", "---")):
+            return i
+    return 0 if paragraphs else None
+
+
+def describe_violations(violations: List[Dict]) -> List[str]:
+    """Descrizioni leggibili delle violazioni, per l'interfaccia"""
+    labels = {SUBJECTS_KEY: "Oggetto", PREVIEWS_KEY: "Anteprima", CONTENT_KEY: "Paragrafo"}
+    return [
+        f"{labels.get(v['field'], v['field'])} {v['index'] + 1}: {'; '.join(v['problems'])}"
+        for v in violations
+    ]
+
+
+REPAIR_SCHEMA = {
+    "name": "newsletter_repairs",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "items": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "string"},
+                        "text": {"type": "string"},
+                    },
+                    "required": ["id", "text"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["items"],
+        "additionalProperties": False,
+    },
+}
+
+REPAIR_SYSTEM_PROMPT = (
+    "Sei un copywriter di email marketing. Riscrivi solo i testi indicati correggendo i "
+    "problemi elencati, mantenendo lingua, tono, significato e formattazione markdown. "
+    'Rispondi SOLO in JSON: {"items": [{"id": "...", "text": "..."}]}, con lo stesso id di ogni testo.'
+)
+
+_ID_PREFIXES = {SUBJECTS_KEY: "s", PREVIEWS_KEY: "p", CONTENT_KEY: "c"}
+
+
+def _violation_id(violation: Dict) -> str:
+    return f"{_ID_PREFIXES[violation['field']]}{violation['index']}"
+
+
+def build_repair_messages(violations: List[Dict], forbidden_words: Iterable[str] = ()) -> List[Dict]:
+    """Messaggi per correggere in una sola richiesta solo i testi con violazioni"""
+    items = []
+    for violation in violations:
+        problems = list(violation["problems"])
+        if violation["field"] == SUBJECTS_KEY:
+            problems.append(f"massimo {MAX_SUBJECT_LENGTH} caratteri")
+        elif violation["field"] == PREVIEWS_KEY:
+            problems.append(f"massimo {MAX_PREVIEW_LENGTH} caratteri")
+        items.append({"id": _violation_id(violation), "text": violation["text"], "problems": problems})
+
+    prompt = json.dumps({"items": items}, ensure_ascii=False)
+    forbidden = [w for w in forbidden_words if w and w.strip()]
+    if forbidden:
+        prompt += f"\n\nNon usare mai queste parole: {', '.join(forbidden)}"
+    return [
+        {"role": "system", "content": REPAIR_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def apply_repairs(result: Dict, violations: List[Dict], content: str) -> Dict:
+    """Nuovo risultato con i testi corretti al posto di quelli segnalati
+
+    I testi non restituiti (o vuoti) dal modello restano invariati.
+    """
+    try:
+        start = content.find("{")
+        payload = json.loads(content[start:content.rfind("}") + 1]) if start >= 0 else {}
+    except ValueError:
+        payload = {}
+    items = payload.get("items") if isinstance(payload, dict) else None
+    repaired = {}
+    for item in items or []:
+        if isinstance(item, dict) and isinstance(item.get("text"), str) and item["text"].strip():
+            repaired[str(item.get("id"))] = item["text"].strip()
+
+    fixed = dict(result)
+    fixed[SUBJECTS_KEY] = list(result.get(SUBJECTS_KEY, []))
+    fixed[PREVIEWS_KEY] = list(result.get(PREVIEWS_KEY, []))
+    paragraphs = split_paragraphs(result.get(CONTENT_KEY, ""))
+    content_changed = False
+    for violation in violations:
+        text = repaired.get(_violation_id(violation))
+        if text is None:
+            continue
+        field, index = violation["field"], violation["index"]
+        if field == CONTENT_KEY:
+            if index < len(paragraphs):
+                paragraphs[index] = text
+                content_changed = True
+        elif index < len(fixed[field]):
+            # Oggetti e anteprime restano su una riga
+            fixed[field][index] = " ".join(text.split())
+    if content_changed:
+        fixed[CONTENT_KEY] = join_paragraphs(paragraphs)
+    return fixed
+
+
+def repair_max_tokens(violations: List[Dict]) -> int:
+    """max_tokens della richiesta di correzione: proporzionato ai soli testi da riscrivere"""
+    return sum(estimate_tokens(v["text"]) * 2 + 30 for v in violations) + 20
@@ -0,0 +1,268 @@
+import re
+from html import escape
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Aspetto dell'email: colori, font e larghezza del contenuto (in pixel)
+DEFAULT_THEME = {
+    "font_family": "Arial, Helvetica, sans-serif",
+    "text_color": "#333333",
+    "heading_color": "#111111",
+    "accent_color": "#1a73e8",
+    "button_text_color": "#ffffff",
+    "background": "#f4f4f4",
+    "content_background": "#ffffff",
+    "rule_color": "#e0e0e0",
+    "width": 600,
+    "lang": "it",
+}
+
+_HEADING = re.compile(r"(#{1,6})[ \t]+(\S.*?)(?:[ \t]+#+)?[ \t]*$")
+_RULE = re.compile(r"(?:-{3,}|\*{3,}|_{3,})$")
+# Pulsante su una riga da solo: **[TESTO]**, **[TESTO](link)** o [**TESTO**](link)
+_CTA = re.compile(r"\*\*\[([^\]\n]+)\](?:\(([^)\s]*)\))?\*\*$|\[\*\*([^\]\n]+)\*\*\]\(([^)\s]*)\)$")
+_ITEM = re.compile(r"(?:[-*+]|(\d{1,3})[.)])[ \t]+(\S.*)$")
+# Blocchi separati da righe vuote; una riga che inizia così può aprire un blocco di altro tipo
+_BLANK_LINES = re.compile(r"\n(?:[ \t]*\n)+")
+_LINE_START = re.compile(r"\n[ \t]*(?:[#*_+\-\[]|\d{1,3}[.)])")
+_STARTERS = frozenset("#*_+-[0123456789")
+_LINE_BREAK = re.compile(r"[ \t]*\n[ \t]*")
+# Elementi in linea, riconosciuti in un'unica scansione: **grassetto** e [testo](link)
+_INLINE = re.compile(r"\*\*(.+?)\*\*|\[([^\]\n]+)\]\(([^)\s]*)\)")
+_UNSAFE_SCHEMES = ("javascript:", "vbscript:", "data:")
+
+
+def _escape(text: str) -> str:
+    """Testo con & < > convertiti in entità e i caratteri oltre Latin-1 come riferimenti numerici
+
+    Emoji, virgolette tipografiche o € diventano &#...;: ne basterebbe uno per far occupare
+    all'intero documento da 2 a 4 byte per carattere.
+    """
+    text = escape(text, quote=False)
+    if text.isascii():
+        return text
+    return text.encode("latin-1", "xmlcharrefreplace").decode("latin-1")
+
+
+def _safe_url(url: str, default_url: str) -> str:
+    """URL per l'attributo href; il testo arriva già con & < > convertiti in entità"""
+    url = url.strip()
+    if not url or url.lower().startswith(_UNSAFE_SCHEMES):
+        return default_url
+    return url.replace('"', "&quot;")
+
+
+class EmailRenderer:
+    """Converte il markdown della newsletter in HTML per email, a tabelle e con stili in linea
+
+    Il testo viene convertito in entità HTML e percorso una volta sola: ogni blocco è
+    classificato dal primo carattere (titolo, separatore, pulsante, elenco o paragrafo)
+    e grassetti e link sono sostituiti con un'unica espressione regolare, solo nei
+    blocchi che possono contenerli. Stili e frammenti HTML sono preparati nel
+    costruttore, così la resa di ogni blocco è una formattazione di stringa: lo stesso
+    renderer si riusa per tutte le newsletter.
+    """
+
+    def __init__(self, theme: Optional[Dict] = None):
+        self.theme = dict(DEFAULT_THEME, **(theme or {}))
+        t = self.theme
+        font = f"font-family:{t['font_family']};"
+        cell = f"padding:0 32px 16px 32px;{font}"
+
+        self._paragraph = (
+            f'<tr><td style="{cell}font-size:16px;line-height:24px;color:{t["text_color"]};">%s</td></tr>\n'
+        )
+        self._list = (
+            f'<tr><td style="{cell}font-size:16px;line-height:24px;color:{t["text_color"]};">'
+            f'<%s style="margin:0;padding:0 0 0 24px;">%s</%s></td></tr>\n'
+        )
+        self._item = '<li style="margin:0 0 8px 0;">%s</li>'
+        self._headings = {
+            level: (
+                f'<tr><td style="padding:{top}px 32px 12px 32px;{font}">'
+                f'<h{level} style="margin:0;font-size:{size}px;line-height:{size + 8}px;'
+                f'color:{t["heading_color"]};font-weight:bold;">%s</h{level}></td></tr>\n'
+            )
+            for level, size, top in ((1, 26, 32), (2, 21, 16), (3, 18, 12), (4, 16, 12), (5, 16, 12), (6, 16, 12))
+        }
+        self._rule = (
+            f'<tr><td style="padding:8px 32px 24px 32px;"><table role="presentation" width="100%" '
+            f'cellspacing="0" cellpadding="0" border="0"><tr><td style="border-top:1px solid {t["rule_color"]};'
+            f'font-size:0;line-height:0;">&nbsp;</td></tr></table></td></tr>\n'
+        )
+        # Pulsante "a prova di client": cella colorata con il link all'interno
+        self._button = (
+            f'<tr><td align="center" style="padding:8px 32px 24px 32px;">'
+            f'<table role="presentation" cellspacing="0" cellpadding="0" border="0"><tr>'
+            f'<td align="center" bgcolor="{t["accent_color"]}" style="border-radius:4px;">'
+            f'<a href="%s" target="_blank" style="display:inline-block;padding:12px 28px;{font}'
+            f'font-size:16px;font-weight:bold;color:{t["button_text_color"]};text-decoration:none;'
+            f'border-radius:4px;">%s</a></td></tr></table></td></tr>\n'
+        )
+        self._link = f'<a href="%s" target="_blank" style="color:{t["accent_color"]};text-decoration:underline;">%s</a>'
+        self._head = (
+            f'<!DOCTYPE html>\n<html lang="{t["lang"]}">\n<head>\n<meta charset="utf-8">\n'
+            f'<meta name="viewport" content="width=device-width, initial-scale=1">\n<title>%s</title>\n</head>\n'
+            f'<body style="margin:0;padding:0;background-color:{t["background"]};">\n'
+            f'<div style="display:none;max-height:0;overflow:hidden;mso-hide:all;">%s</div>\n'
+            f'<table role="presentation" width="100%%" cellspacing="0" cellpadding="0" border="0" '
+            f'style="background-color:{t["background"]};">\n<tr><td align="center" style="padding:24px 12px;">\n'
+            f'<table role="presentation" width="{t["width"]}" cellspacing="0" cellpadding="0" border="0" '
+            f'style="width:100%%;max-width:{t["width"]}px;background-color:{t["content_background"]};">\n'
+        )
+        self._tail = '<tr><td style="font-size:0;line-height:0;height:16px;">&nbsp;</td></tr>\n' \
+                     '</table>\n</td></tr>\n</table>\n</body>\n</html>\n'
+
+    def _replace_inline(self, match: "re.Match") -> str:
+        bold, label, url = match.groups()
+        if bold is not None:
+            return f"<strong>{self._inline(bold)}</strong>"
+        return self._link % (_safe_url(url, "#"), self._inline(label))
+
+    def _inline(self, text: str) -> str:
+        """Grassetti e link di un blocco (testo già convertito in entità HTML)"""
+        if "*" not in text and "[" not in text:
+            return text
+        return _INLINE.sub(self._replace_inline, text)
+
+    def _classify(self, line: str, default_url: str) -> Tuple[str, str]:
+        """Tipo di una riga non vuota dal primo carattere: ("block", html), ("ul"/"ol", voce) o ("text", riga)"""
+        first = line[0]
+        if first == "#":
+            match = _HEADING.match(line)
+            if match:
+                return "block", self._headings[len(match.group(1))] % self._inline(match.group(2))
+        elif first in "-*_" and _RULE.match(line):
+            return "block", self._rule
+        if first == "*" or first == "[":
+            match = _CTA.match(line)
+            if match:
+                label, url, alt_label, alt_url = match.groups()
+                return "block", self._button % (_safe_url(url or alt_url or "", default_url), label or alt_label)
+        if first in "-*+" or first.isdigit():
+            match = _ITEM.match(line)
+            if match:
+                return ("ol" if match.group(1) else "ul"), self._item % self._inline(match.group(2))
+        return "text", line
+
+    def _lines(self, lines: Iterable[str], default_url: str, out: List[str]) -> None:
+        """Blocco con righe di tipo diverso (es. titolo seguito dal testo), riga per riga"""
+        paragraph: List[str] = []
+        items: List[str] = []
+        list_kind = ""
+        for line in lines:
+            line = line.strip()
+            kind, value = self._classify(line, default_url) if line else ("", "")
+            if paragraph and kind != "text":
+                out.append(self._paragraph % self._inline("<br>\n".join(paragraph)))
+                paragraph = []
+            if items and kind != list_kind:
+                out.append(self._list % (list_kind, "".join(items), list_kind))
+                items = []
+            if kind == "block":
+                out.append(value)
+            elif kind == "text":
+                paragraph.append(value)
+            elif kind:
+                items.append(value)
+                list_kind = kind
+        if paragraph:
+            out.append(self._paragraph % self._inline("<br>\n".join(paragraph)))
+        if items:
+            out.append(self._list % (list_kind, "".join(items), list_kind))
+
+    def _write_blocks(self, markdown: str, default_url: str, out: List[str]) -> None:
+        """Aggiunge a out le righe della tabella del contenuto, una per blocco"""
+        text = _escape(markdown)
+        default_url = _safe_url(_escape(default_url), "#")
+        append = out.append
+        paragraph, inline = self._paragraph, self._inline
+        for block in _BLANK_LINES.split(text):
+            block = block.strip()
+            if not block:
+                continue
+            single = "\n" not in block
+            if block[0] not in _STARTERS:
+                # Caso più frequente: paragrafo di testo, eventualmente su più righe
+                if single:
+                    append(paragraph % inline(block))
+                    continue
+                if not _LINE_START.search(block):
+                    append(paragraph % inline(_LINE_BREAK.sub("<br>\n", block)))
+                    continue
+            if not single:
+                self._lines(block.split("\n"), default_url, out)
+                continue
+            kind, value = self._classify(block, default_url)
+            if kind == "block":
+                append(value)
+            elif kind == "text":
+                append(paragraph % inline(block))
+            else:
+                append(self._list % (kind, value, kind))
+
+    def blocks(self, markdown: str, default_url: str = "#") -> Iterator[str]:
+        """Righe della tabella del contenuto, una per blocco
+
+        Il testo viene diviso sulle righe vuote; un blocco di una sola riga o un paragrafo
+        senza righe che aprono altri blocchi si rende direttamente, gli altri riga per riga.
+        I pulsanti senza link (**[TESTO]**) puntano a default_url.
+        """
+        out: List[str] = []
+        self._write_blocks(markdown, default_url, out)
+        return iter(out)
+
+    def stream(self, chunks: Iterable[str], title: str = "", preheader: str = "",
+               default_url: str = "#") -> Iterator[str]:
+        """Documento HTML a pezzi, da frammenti di markdown di lunghezza qualsiasi
+
+        I blocchi non attraversano mai una riga vuota: il testo ricevuto viene reso fino
+        all'ultima riga vuota e il resto attende i frammenti successivi, così la memoria
+        resta limitata alla sezione in corso anche per documenti molto grandi.
+        """
+        yield self._head % (_escape(title), _escape(preheader))
+        pending = ""
+        for chunk in chunks:
+            searched = max(0, len(pending) - 1)
+            pending += chunk
+            cut = pending.rfind("\n\n", searched)
+            if cut >= 0:
+                yield from self.blocks(pending[:cut], default_url)
+                pending = pending[cut + 2:]
+        yield from self.blocks(pending, default_url)
+        yield self._tail
+
+    def render(self, markdown: str, title: str = "", preheader: str = "", default_url: str = "#") -> str:
+        """Documento HTML completo dell'email"""
+        # Un'unica lista per tutto il documento, unita una volta sola alla fine
+        parts = [self._head % (_escape(title), _escape(preheader))]
+        self._write_blocks(markdown, default_url, parts)
+        parts.append(self._tail)
+        return "".join(parts)
+
+    def render_many(self, documents: Iterable[Dict]) -> List[str]:
+        """Resa in blocco: ogni documento è un dizionario con markdown e, opzionali, title, preheader e default_url"""
+        render = self.render
+        return [
+            render(d["markdown"], d.get("title", ""), d.get("preheader", ""), d.get("default_url") or "#")
+            for d in documents
+        ]
+
+
+_default_renderer: Optional[EmailRenderer] = None
+
+
+def newsletter_html(result: Dict, data: Optional[Dict] = None, renderer: Optional[EmailRenderer] = None) -> str:
+    """HTML dell'email per un risultato di generazione: primo oggetto come titolo, prima anteprima come preheader"""
+    global _default_renderer
+    if renderer is None:
+        if _default_renderer is None:
+            _default_renderer = EmailRenderer()
+        renderer = _default_renderer
+    subjects = result.get("email_subjects") or [""]
+    previews = result.get("email_previews") or [""]
+    return renderer.render(
+        result.get("newsletter_content", ""),
+        title=subjects[0],
+        preheader=previews[0],
+        default_url=(data or {}).get("website_url") or "#",
+    )
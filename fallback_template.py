@@ -0,0 +1,110 @@
+import string
+from typing import Dict, List, Tuple
+
+from constraints import ConstraintChecker
+from response_parser import MAX_PREVIEW_LENGTH, MAX_SUBJECT_LENGTH
+
+_FORMATTER = string.Formatter()
+
+
+def _compile(template: str) -> Tuple[Tuple[str, str], ...]:
+    """Scompone il template una volta sola in coppie (testo fisso, campo)"""
+    return tuple((literal, field or "") for literal, field, _, _ in _FORMATTER.parse(template))
+
+
+def _render(compiled: Tuple[Tuple[str, str], ...], values: Dict[str, str]) -> str:
+    return "".join(literal + (values[field] if field else "") for literal, field in compiled)
+
+
+# Blocchi del contenuto, compilati all'import: a circuito aperto la resa è solo una concatenazione
+_HEADER = _compile("# Newsletter {company}\n\n{intro}\n\n**[SCOPRI DI PIÙ]**\n\n## Cosa abbiamo per te\n\n{brief}\n")
+_PRODUCT = _compile("\n## {name}\n\nScopri tutti i dettagli di {name}.\n\n**[SCOPRI {name_upper}]**\n")
+_USP = _compile("\n## Perché scegliere {company}\n\n{usp}\n")
+_DISCOUNT = _compile("\n## Offerta esclusiva\n\n{codes}\n")
+_CLOSING = _compile("\n---\n\nGrazie per la tua fiducia in {company}.\n\n**[{cta}]**\n\nIl team di {company}\n")
+
+_SUBJECTS = tuple(_compile(t) for t in (
+    "Novità da {company}",
+    "Codice {code} per te",
+    "Scopri {product}",
+    "News da {company}",
+    "Le ultime da {company}",
+))
+_PREVIEWS = tuple(_compile(t) for t in (
+    "Scopri le ultime novità di {company}",
+    "Usa il codice {code} sul tuo prossimo ordine",
+    "{product} e molto altro ti aspettano",
+    "Rimani sempre aggiornato con {company}",
+    "Tutte le novità in un'unica email",
+))
+
+
+def shorten(text: str, limit: int) -> str:
+    """Accorcia il testo a limit caratteri senza spezzare le parole"""
+    text = " ".join(text.split())
+    if len(text) <= limit:
+        return text
+    cut = text[:limit + 1].rsplit(" ", 1)[0] if " " in text[:limit + 1] else text[:limit]
+    return cut.rstrip(" ,;:.-")
+
+
+def _pick(templates, values: Dict[str, str], limit: int, checker: ConstraintChecker, count: int = 3) -> List[str]:
+    """Primi count testi non vuoti, distinti e senza parole vietate (con ripiego sui generici)"""
+    chosen: List[str] = []
+    discarded: List[str] = []
+    for compiled in templates:
+        fields = [field for _, field in compiled if field]
+        if any(not values[field] for field in fields):
+            continue
+        text = shorten(_render(compiled, values), limit)
+        if not text or text in chosen or text in discarded:
+            continue
+        (discarded if checker.find_words(text)[0] else chosen).append(text)
+        if len(chosen) == count:
+            return chosen
+    return (chosen + discarded)[:count]
+
+
+def render_fallback(data: Dict) -> Dict:
+    """Newsletter da template, senza chiamare il modello
+
+    Usata quando il provider non risponde o il circuito è aperto: riprende obiettivo,
+    brief, prodotti (uno per sezione, con il proprio pulsante), USP e codici sconto;
+    oggetti e anteprime rispettano i limiti di caratteri senza troncare le parole ed
+    evitano le parole vietate quando c'è un'alternativa.
+    """
+    company = data.get('company_name') or 'la nostra azienda'
+    objective = (data.get('email_objective') or '').strip()
+    brief = (data.get('content_brief') or '').strip()
+    products = [p['name'] for p in data.get('products') or [] if p and p.get('name')]
+    codes = [code for code in data.get('discount_codes') or [] if code]
+    checker = ConstraintChecker(data.get('forbidden_words') or ())
+
+    intro = "Siamo entusiasti di condividere con te le nostre ultime novità e aggiornamenti."
+    parts = [_render(_HEADER, {
+        "company": company,
+        "intro": f"{objective}\n\n{intro}" if objective else intro,
+        "brief": brief or "Contenuti esclusivi e offerte speciali pensati per te.",
+    })]
+    for name in products:
+        parts.append(_render(_PRODUCT, {"name": name, "name_upper": name.upper()}))
+    if data.get('usp_benefit'):
+        parts.append(_render(_USP, {"company": company, "usp": data['usp_benefit']}))
+    if codes:
+        lines = [f"Usa il codice: **{code}**" for code in codes]
+        parts.append(_render(_DISCOUNT, {"codes": "\n\n".join(lines)}))
+    parts.append(_render(_CLOSING, {
+        "company": company,
+        "cta": "VISITA IL SITO" if data.get('website_url') else "SCOPRI DI PIÙ",
+    }))
+
+    values = {
+        "company": company,
+        "code": codes[0] if codes else "",
+        "product": products[0] if products else "",
+    }
+    return {
+        'email_subjects': _pick(_SUBJECTS, values, MAX_SUBJECT_LENGTH, checker),
+        'email_previews': _pick(_PREVIEWS, values, MAX_PREVIEW_LENGTH, checker),
+        'newsletter_content': "".join(parts),
+    }
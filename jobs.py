@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from cache import DEFAULT_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_JOBS_PATH = os.path.join(DEFAULT_CACHE_DIR, "jobs.sqlite")
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Intervallo minimo tra due aggiornamenti del risultato parziale di un job
+PARTIAL_INTERVAL = 0.3
+
+Report = Callable[[Dict], None]
+
+
+class JobQueue:
+    """Coda di job persistente su SQLite eseguita da un pool di worker
+
+    Stato, risultati parziali e risultati finali sono salvati per job e per sessione,
+    così l'interfaccia può interrogarli a ogni rerun senza bloccarsi sulla generazione.
+    Le funzioni da eseguire (e quindi le API key) restano solo in memoria: i job in
+    coda o in corso al riavvio del processo vengono segnati come falliti.
+    """
+
+    def __init__(self, path: str = DEFAULT_JOBS_PATH, workers: int = 4,
+                 retention_seconds: float = 24 * 3600):
+        self.path = path
+        self.workers = workers
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                status TEXT NOT NULL,
+                partial TEXT,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                started_at REAL,
+                finished_at REAL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_session ON jobs (session_id, created_at)")
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE status IN (?, ?)",
+            (JOB_FAILED, "Interrotto dal riavvio del server", time.time(), JOB_QUEUED, JOB_RUNNING),
+        )
+        self._conn.commit()
+        self.purge()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+
+    def submit(self, session_id: str, kind: str, fn: Callable[[Report], Dict]) -> str:
+        """Accoda fn(report) e restituisce subito l'ID del job
+
+        fn può chiamare report(parziale) per pubblicare risultati intermedi; il dizionario
+        restituito diventa il risultato del job.
+        """
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, session_id, kind, status, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, session_id, kind, JOB_QUEUED, time.time()),
+            )
+            self._conn.commit()
+        self._executor.submit(self._run, job_id, fn)
+        return job_id
+
+    def _run(self, job_id: str, fn: Callable[[Report], Dict]) -> None:
+        self._update(job_id, status=JOB_RUNNING, started_at=time.time())
+
+        def report(partial: Dict) -> None:
+            self._update(job_id, partial=json.dumps(partial, ensure_ascii=False))
+
+        try:
+            result = fn(report)
+        except Exception as e:
+            logger.error("Errore nel job %s: %s", job_id, e)
+            self._update(job_id, status=JOB_FAILED, error=str(e), finished_at=time.time())
+            return
+        self._update(
+            job_id, status=JOB_DONE, result=json.dumps(result, ensure_ascii=False),
+            partial=None, finished_at=time.time()
+        )
+
+    def _update(self, job_id: str, **fields) -> None:
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            self._conn.execute(
+                f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id)
+            )
+            self._conn.commit()
+
+    def get(self, job_id: str, session_id: Optional[str] = None) -> Optional[Dict]:
+        """Stato del job (None se non esiste o appartiene a un'altra sessione)"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, session_id, kind, status, partial, result, error, created_at, "
+                "started_at, finished_at FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+            if row is None or (session_id is not None and row[1] != session_id):
+                return None
+            position = 0
+            if row[3] == JOB_QUEUED:
+                position = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = ? AND created_at <= ?",
+                    (JOB_QUEUED, row[7]),
+                ).fetchone()[0]
+        return self._row_to_job(row, position)
+
+    def list_jobs(self, session_id: str, limit: int = 20) -> List[Dict]:
+        """Job della sessione, dal più recente"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, session_id, kind, status, partial, result, error, created_at, "
+                "started_at, finished_at FROM jobs WHERE session_id = ? "
+                "ORDER BY created_at DESC LIMIT ?",
+                (session_id, limit),
+            ).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    @staticmethod
+    def _row_to_job(row, position: int = 0) -> Dict:
+        return {
+            "id": row[0],
+            "session_id": row[1],
+            "kind": row[2],
+            "status": row[3],
+            "partial": json.loads(row[4]) if row[4] else None,
+            "result": json.loads(row[5]) if row[5] else None,
+            "error": row[6],
+            "created_at": row[7],
+            "started_at": row[8],
+            "finished_at": row[9],
+            "position": position,
+        }
+
+    def purge(self) -> int:
+        """Elimina i job terminati da più di retention_seconds"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (JOB_DONE, JOB_FAILED, time.time() - self.retention_seconds),
+            )
+            self._conn.commit()
+        return cursor.rowcount
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {
+            "workers": self.workers,
+            "queued": counts.get(JOB_QUEUED, 0),
+            "running": counts.get(JOB_RUNNING, 0),
+            "done": counts.get(JOB_DONE, 0),
+            "failed": counts.get(JOB_FAILED, 0),
+        }
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+def newsletter_job(generator, data: Dict, use_cache: bool = True, pipeline: bool = False,
+                   similarity_threshold: Optional[float] = None) -> Callable[[Report], Dict]:
+    """Funzione del job di generazione di una newsletter, da passare a JobQueue.submit
+
+    Pubblica come risultato parziale oggetti, anteprime e contenuto man mano che arrivano.
+    Il risultato contiene 'result', 'data', 'draft' (bozza da una richiesta simile),
+    'similarity' e i tempi in secondi ('time_to_first_token', 'total_time').
+    """
+    def run(report: Report) -> Dict:
+        started = time.perf_counter()
+        job = {"data": data, "draft": False, "similarity": None,
+               "time_to_first_token": None, "total_time": None}
+
+        if similarity_threshold is not None and use_cache:
+            match = generator.find_similar(data, similarity_threshold)
+            if match is not None:
+                return dict(job, result=match["result"], draft=True, similarity=match["similarity"])
+
+        if pipeline:
+            def on_subjects(subjects: List[str], previews: List[str]) -> None:
+                report({"subjects": subjects, "previews": previews, "content": ""})
+
+            result = generator.generate_newsletter_pipeline(data, use_cache=use_cache, on_subjects=on_subjects)
+            return dict(job, result=result, total_time=time.perf_counter() - started)
+
+        stream = generator.generate_newsletter(data, use_cache=use_cache, stream=True)
+        last_report = 0.0
+        for _ in stream:
+            if time.perf_counter() - last_report >= PARTIAL_INTERVAL:
+                parser = stream.parser
+                report({"subjects": parser.subjects, "previews": parser.previews, "content": parser.content})
+                last_report = time.perf_counter()
+        return dict(
+            job, result=stream.result,
+            time_to_first_token=stream.time_to_first_token, total_time=stream.total_time
+        )
+
+    return run
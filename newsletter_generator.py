@@ -1,300 +1,1234 @@
-try:
-    from openai import OpenAI
-    NEW_OPENAI = True
-except ImportError:
-    try:
-        import openai
-        NEW_OPENAI = False
-    except ImportError:
-        import subprocess
-        import sys
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "openai"])
-        import openai
-        NEW_OPENAI = False
-
+import contextvars
+import copy
 import json
-from typing import Dict, List, Optional
+import logging
+import math
+import textwrap
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Union
 
-class NewsletterGenerator:
-    def __init__(self, api_key: str):
-        self.api_key = api_key
-        if NEW_OPENAI:
-            self.client = OpenAI(api_key=api_key)
-        else:
-            openai.api_key = api_key
-    
-    def generate_newsletter(self, data: Dict) -> Optional[Dict]:
-        """Genera la newsletter completa usando OpenAI"""
-        try:
-            # Costruire il prompt principale
-            prompt = self._build_prompt(data)
-            
-            # Chiamata a OpenAI
-            if NEW_OPENAI:
-                response = self.client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[
-                        {
-                            "role": "system", 
-                            "content": self._get_system_prompt()
-                        },
-                        {
-                            "role": "user", 
-                            "content": prompt
-                        }
-                    ],
-                    max_tokens=4000,
-                    temperature=0.7
-                )
-                content = response.choices[0].message.content
-            else:
-                response = openai.ChatCompletion.create(
-                    model="gpt-4",
-                    messages=[
-                        {
-                            "role": "system", 
-                            "content": self._get_system_prompt()
-                        },
-                        {
-                            "role": "user", 
-                            "content": prompt
-                        }
-                    ],
-                    max_tokens=4000,
-                    temperature=0.7
-                )
-                content = response.choices[0].message.content
-            
-            # Parsing della risposta
-            return self._parse_response(content, data)
-            
-        except Exception as e:
-            print(f"Errore dettagliato nella generazione: {str(e)}")
-            print(f"Tipo errore: {type(e)}")
-            # Prova con GPT-3.5 se GPT-4 non funziona
-            try:
-                return self._generate_with_fallback_model(data)
-            except Exception as e2:
-                print(f"Errore anche con modello fallback: {str(e2)}")
-                return self._generate_fallback_content(data)
-    
-    def _generate_fallback_content(self, data: Dict) -> Dict:
-        """Genera contenuto di fallback in caso di errore"""
-        company = data.get('company_name', 'la nostra azienda')
-        objective = data.get('email_objective', 'informare i clienti')
-        
-        # Contenuto personalizzato basato sui dati inseriti
-        newsletter_content = f"""# Newsletter {company}
+from cache import ResponseCache, make_cache_key
+from brand_store import BrandProfileStore, brand_key, source_hash
+from cascade import ModelCascade
+from circuit_breaker import CircuitBreaker
+from constraints import (
+    REPAIR_SCHEMA, ConstraintChecker, apply_repairs, build_repair_messages, describe_violations,
+    repair_max_tokens
+)
+from fallback_template import render_fallback
+from providers import DEFAULT_BACKEND, ChatProvider, load_provider
+from prompt_budget import (
+    COMPACTABLE_FIELDS, collapse_whitespace, compact_fields, completion_budget,
+    estimate_messages_tokens, estimate_tokens
+)
+from response_parser import (
+    RESPONSE_KEYS, RESPONSE_SCHEMA, SUBJECTS_SCHEMA, IncrementalResponseParser, decode_structured,
+    parse_response, response_format_for
+)
+from scheduler import RequestScheduler
+from sections import find_section, replace_section, section_label, split_sections
+from similarity import prune_near_duplicates
+from similarity_cache import SimilarityCache
+from singleflight import Flight, SingleFlight
+from telemetry import Span, Telemetry, annotate
+from usage import UsageTracker
 
-{objective}
+logger = logging.getLogger(__name__)
 
-Siamo entusiasti di condividere con te le nostre ultime novità e aggiornamenti.
+SYSTEM_PROMPT = textwrap.dedent("""
+    Sei un esperto di email marketing e copywriting. Il tuo compito è generare newsletter ottimizzate
+    seguendo esattamente questo formato:
 
-**[SCOPRI DI PIÙ]**
+    1. 3 proposte di oggetto email (massimo 40 caratteri ciascuno)
+    2. 3 proposte di anteprima email (massimo 100 caratteri ciascuno)
+    3. Contenuto newsletter strutturato con:
+       - Titolo principale
+       - Paragrafo principale
+       - Call to action
+       - Sezioni prodotto (se presenti) con descrizioni, prezzi, CTA
+       - Chiusura e CTA finale
 
-## Cosa abbiamo per te
+    Rispondi SEMPRE in formato JSON con questa struttura:
+    {
+        "email_subjects": ["oggetto1", "oggetto2", "oggetto3"],
+        "email_previews": ["anteprima1", "anteprima2", "anteprima3"],
+        "newsletter_content": "contenuto completo in markdown"
+    }
 
-{data.get('content_brief', 'Contenuti esclusivi e offerte speciali pensati per te.')}"""
+    Adatta il contenuto al tone of voice richiesto e rispetta tutti i vincoli specificati.
+""").strip()
 
-        # Aggiungi prodotti se presenti
-        if data.get('products'):
-            newsletter_content += "\n\n## I nostri prodotti\n"
-            for product in data['products']:
-                if product and product.get('name'):
-                    newsletter_content += f"\n### {product['name']}\n"
-                    newsletter_content += f"Scopri tutti i dettagli di {product['name']}.\n"
-                    if product.get('link'):
-                        newsletter_content += f"**[SCOPRI {product['name'].upper()}]**\n"
+# Regole di generazione statiche: stanno nel prompt di sistema, prima dei dati variabili,
+# così il prefisso dei messaggi resta identico tra le richieste e il provider può metterlo in cache
+GENERATION_INSTRUCTIONS = textwrap.dedent("""
+    Genera:
+    1. 3 oggetti email accattivanti (MAX 40 caratteri)
+    2. 3 anteprime email persuasive (MAX 100 caratteri)
+    3. Newsletter completa con struttura professionale
 
-        # USP/Benefit
-        if data.get('usp_benefit'):
-            newsletter_content += f"\n\n## Perché scegliere {company}\n\n{data['usp_benefit']}\n"
+    Per la newsletter, includi:
+    - Titolo coinvolgente
+    - Paragrafo introduttivo che catturi l'attenzione
+    - Call to action principale
+    - Sezioni prodotto dettagliate (se presenti) con descrizioni, benefici e CTA
+    - Chiusura persuasiva con CTA finale
 
-        # Codici sconto
-        if data.get('discount_codes'):
-            newsletter_content += f"\n\n## Offerta esclusiva\n\nUsa il codice: **{data['discount_codes'][0]}**\n"
+    Usa un linguaggio adatto al tone of voice e al target specificato.
+    Rispetta RIGOROSAMENTE i limiti di caratteri per oggetti e anteprime.
+""").strip()
 
-        newsletter_content += f"""
+STATIC_SYSTEM_PROMPT = SYSTEM_PROMPT + "\n\n" + GENERATION_INSTRUCTIONS
 
----
+# Prompt di sistema della modalità pipeline: oggetti/anteprime e corpo vengono generati da due chiamate parallele
+SUBJECTS_SYSTEM_PROMPT = textwrap.dedent("""
+    Sei un esperto di email marketing e copywriting. Il tuo compito è scrivere oggetti e anteprime email.
 
-Grazie per la tua fiducia in {company}.
+    Genera:
+    1. 3 oggetti email accattivanti (MAX 40 caratteri)
+    2. 3 anteprime email persuasive (MAX 100 caratteri)
 
-**[VISITA IL SITO]**
+    Rispondi SEMPRE in formato JSON con questa struttura:
+    {
+        "email_subjects": ["oggetto1", "oggetto2", "oggetto3"],
+        "email_previews": ["anteprima1", "anteprima2", "anteprima3"]
+    }
 
-Il team di {company}
-"""
-        
-        return {
-            'email_subjects': [
-                f"News da {company}"[:40],
-                f"Novità {company}"[:40],
-                f"Offerte {company}"[:40]
-            ],
-            'email_previews': [
-                f"Scopri le ultime novità di {company}"[:100],
-                f"Non perdere le nostre offerte esclusive"[:100],
-                f"Rimani sempre aggiornato con noi"[:100]
-            ],
-            'newsletter_content': newsletter_content
-        }
-    
-    def _get_system_prompt(self) -> str:
-        """Prompt di sistema per definire il comportamento dell'AI"""
-        return """
-        Sei un esperto di email marketing e copywriting. Il tuo compito è generare newsletter ottimizzate 
-        seguendo esattamente questo formato:
+    Adatta il testo al tone of voice richiesto e rispetta RIGOROSAMENTE i limiti di caratteri.
+""").strip()
 
-        1. 3 proposte di oggetto email (massimo 40 caratteri ciascuno)
-        2. 3 proposte di anteprima email (massimo 100 caratteri ciascuno)
-        3. Contenuto newsletter strutturato con:
-           - Titolo principale
-           - Paragrafo principale 
-           - Call to action
-           - Sezioni prodotto (se presenti) con descrizioni, prezzi, CTA
-           - Chiusura e CTA finale
+BODY_SYSTEM_PROMPT = textwrap.dedent("""
+    Sei un esperto di email marketing e copywriting. Il tuo compito è scrivere il contenuto di una newsletter.
 
-        Rispondi SEMPRE in formato JSON con questa struttura:
-        {
-            "email_subjects": ["oggetto1", "oggetto2", "oggetto3"],
-            "email_previews": ["anteprima1", "anteprima2", "anteprima3"],
-            "newsletter_content": "contenuto completo in markdown"
-        }
+    Per la newsletter, includi:
+    - Titolo coinvolgente
+    - Paragrafo introduttivo che catturi l'attenzione
+    - Call to action principale
+    - Sezioni prodotto dettagliate (se presenti) con descrizioni, benefici e CTA
+    - Chiusura persuasiva con CTA finale
+
+    Rispondi SOLO con il contenuto completo della newsletter in markdown, senza JSON e senza oggetti o anteprime.
+    Usa un linguaggio adatto al tone of voice e al target specificato e rispetta tutti i vincoli specificati.
+""").strip()
 
-        Adatta il contenuto al tone of voice richiesto e rispetta tutti i vincoli specificati.
+# Prompt di sistema per rigenerare una sola sezione della newsletter
+SECTION_SYSTEM_PROMPT = textwrap.dedent("""
+    Sei un esperto di email marketing e copywriting. Il tuo compito è riscrivere una singola sezione
+    di una newsletter già scritta, proponendo una versione nuova e migliore.
+
+    Mantieni la stessa struttura markdown della sezione (titoli, grassetti, pulsanti **[TESTO]** e link),
+    una lunghezza simile, il tone of voice e la lingua indicati.
+    Rispondi SOLO con il markdown della sezione riscritta, senza commenti e senza il resto della newsletter.
+""").strip()
+
+# Prompt di sistema per adattare una bozza generata per una richiesta quasi identica
+ADAPT_SYSTEM_PROMPT = STATIC_SYSTEM_PROMPT + "\n\n" + textwrap.dedent("""
+    Ti viene fornita anche una BOZZA già scritta per una richiesta molto simile: adattala ai dati
+    della campagna modificando solo ciò che serve (brief, obiettivo, dettagli) e mantenendo il resto.
+""").strip()
+
+# Profilo del brand della generazione in corso, (impronta del brand, profilo o None): risolto una
+# volta prima di parallelizzare, i thread avviati con copy_context() lo ereditano
+_brand_profile: contextvars.ContextVar[Optional[Tuple[str, Optional[Dict]]]] = contextvars.ContextVar(
+    "brand_profile", default=None
+)
+
+
+def strip_code_fence(content: str) -> str:
+    """Rimuove il blocco ``` in cui alcuni modelli racchiudono comunque il markdown"""
+    content = content.strip()
+    if content.startswith("```"):
+        content = content.split("\n", 1)[1] if "\n" in content else ""
+        content = content.rstrip().removesuffix("```").rstrip()
+    return content
+
+def estimate_request_tokens(messages: List[Dict], max_tokens: int) -> int:
+    """Stima dei token consumati da una richiesta (prompt + completamento)"""
+    return estimate_messages_tokens(messages) + max_tokens
+
+class TruncatedResponse(ValueError):
+    """Risposta interrotta dal limite di max_tokens (finish_reason "length")"""
+    def __init__(self, model: str, max_tokens: int):
+        super().__init__(f"Risposta di {model} troncata a {max_tokens} token")
+        self.model = model
+        self.max_tokens = max_tokens
+
+class NewsletterStream:
+    """Iteratore sui frammenti di testo generati in streaming
+    
+    Durante l'iterazione `parser` espone oggetti, anteprime e contenuto già estratti;
+    al termine `result` contiene il risultato completo, insieme al tempo al primo
+    token e al tempo totale (in secondi). Un testo troncato dal limite di token non va
+    in cache: il risultato viene rigenerato con un budget più ampio. Con `shared` lo
+    stream segue una generazione identica già in corso (vedi singleflight) e ne riceve
+    frammenti e risultato.
+    """
+    def __init__(self, generator: "NewsletterGenerator", data: Dict, deltas: Iterator[str],
+                 cache_key: Optional[str] = None, on_done: Optional[Callable[[Optional[Dict]], None]] = None,
+                 shared: Optional[Flight] = None, span: Optional[Span] = None):
+        self._generator = generator
+        self._data = data
+        self._deltas = deltas
+        self._cache_key = cache_key
+        self._on_done = on_done
+        self._shared = shared
+        self._span = span if span is not None else generator.telemetry.start_span("generate", mode="stream")
+        self.started_at = time.perf_counter()
+        self.time_to_first_token: Optional[float] = None
+        self.total_time: Optional[float] = None
+        self.content = ""
+        self.parser = IncrementalResponseParser()
+        self.result: Optional[Dict] = None
+        self.error: Optional[str] = None
+        self.truncated: Optional[TruncatedResponse] = None
+    
+    def __iter__(self) -> Iterator[str]:
+        try:
+            yield from self._iterate()
+        finally:
+            # Anche se l'iterazione viene interrotta, chi attende la stessa generazione viene sbloccato
+            if self._on_done is not None:
+                on_done, self._on_done = self._on_done, None
+                on_done(self.result)
+            if self.time_to_first_token is not None:
+                self._span.set(ttft_ms=round(self.time_to_first_token * 1e3, 3))
+            self._span.end()
+    
+    def _iterate(self) -> Iterator[str]:
+        parts = []
+        try:
+            for delta in self._deltas:
+                if not delta:
+                    continue
+                if self.time_to_first_token is None:
+                    self.time_to_first_token = time.perf_counter() - self.started_at
+                parts.append(delta)
+                self.parser.feed(delta)
+                yield delta
+        except TruncatedResponse as e:
+            logger.warning("Stream interrotto: %s", e)
+            self.truncated = e
+        except Exception as e:
+            logger.error("Errore durante lo streaming: %s", e)
+            self.error = str(e)
+        
+        self.content = "".join(parts)
+        self.total_time = time.perf_counter() - self.started_at
+        with self._generator.telemetry.use(self._span):
+            self._finish()
+    
+    def _finish(self) -> None:
+        """Risultato finale: da una generazione seguita, dal parsing del testo o dal template"""
+        if self._shared is not None and self.error is None:
+            # Risultato della generazione seguita: niente nuovo parsing né nuove correzioni
+            try:
+                shared = self._shared.wait(self._generator.single_flight.max_age)
+            except TimeoutError as e:
+                # Il testo seguito è completo: si analizza come una generazione propria
+                logger.warning("Risultato della generazione seguita non disponibile: %s", e)
+                shared = None
+            if shared is not None:
+                self.result = copy.deepcopy(shared)
+                return
+        if self.truncated is not None:
+            self._span.set(truncated=True)
+            self.result = self._generator._retry_truncated(self._data, self.truncated)
+            return
+        if self.error is not None or not self.content:
+            self.result = self._generator._generate_fallback_content(self._data)
+            return
+        
+        if self._cache_key is not None:
+            self._generator.cache.set(self._cache_key, self.content)
+        result = self._generator._parse_response(self.content, self._data, self.parser)
+        self.result = self._generator._remember_similar(
+            self._data, self._generator.enforce_constraints(result, self._data)
+        )
+
+class NewsletterGenerator:
+    def __init__(self, api_key: str, cache: Optional[ResponseCache] = None, client=None,
+                 scheduler: Optional[RequestScheduler] = None, cascade: Optional[ModelCascade] = None,
+                 brand_store: Optional[BrandProfileStore] = None,
+                 usage_tracker: Optional[UsageTracker] = None,
+                 similarity_cache: Optional[SimilarityCache] = None,
+                 provider: Optional[ChatProvider] = None, backend: str = DEFAULT_BACKEND,
+                 circuit_breaker: Optional[CircuitBreaker] = None,
+                 single_flight: Optional[SingleFlight] = None,
+                 telemetry: Optional[Telemetry] = None):
+        self.api_key = api_key
+        self.usage_tracker = usage_tracker if usage_tracker is not None else UsageTracker()
+        # Tempi per fase, token e costi stimati (log JSON e metriche Prometheus)
+        self.telemetry = telemetry if telemetry is not None else Telemetry()
+        self.cache = cache
+        self.brand_store = brand_store
+        self.similarity_cache = similarity_cache
+        # I tentativi sono gestiti dallo scheduler, non dai retry interni dell'SDK
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        # Con il provider lento o irraggiungibile le richieste passano subito al template
+        self.circuit_breaker = circuit_breaker if circuit_breaker is not None else CircuitBreaker()
+        # Generazioni identiche contemporanee (doppio clic, stessa campagna da più utenti) ne eseguono una sola
+        self.single_flight = single_flight if single_flight is not None else SingleFlight()
+        self.model = "gpt-4"
+        # max_tokens è il tetto: il valore effettivo cresce con il numero di prodotti
+        self.max_tokens = 4000
+        self.temperature = 0.7
+        # Token di input (prompt di sistema + prompt utente) oltre i quali i campi liberi vengono compattati
+        self.input_token_budget = 1500
+        # Output strutturato (JSON schema / modalità JSON) sui modelli che lo supportano
+        self.structured_output = True
+        # Verifica parole vietate/obbligatorie e limiti di caratteri, correggendo solo i testi non conformi
+        self.check_constraints = True
+        # Descrizioni più lunghe di così vengono riassunte una volta nel profilo del brand
+        self.brand_summary_tokens = 150
+        self.fallback_model = "gpt-3.5-turbo"
+        # Una cascata condivisa conserva le latenze osservate tra una generazione e l'altra
+        self.cascade = cascade if cascade is not None else ModelCascade(
+            [(self.model, 90.0), (self.fallback_model, 45.0)]
+        )
+        # Il backend (e il suo SDK) viene caricato alla prima chiamata al modello;
+        # un client condiviso (vedi clients.ClientRegistry) riusa le connessioni già aperte
+        self.backend = backend
+        self.client = client
+        self._provider = provider
+        self._provider_lock = threading.Lock()
+    
+    @property
+    def provider(self) -> ChatProvider:
+        """Backend di chat completion, creato al primo utilizzo"""
+        if self._provider is None:
+            with self._provider_lock:
+                if self._provider is None:
+                    self._provider = load_provider(self.backend, self.api_key, self.client)
+        return self._provider
+    
+    def generate_newsletter(
+        self,
+        data: Dict,
+        use_cache: bool = True,
+        stream: bool = False
+    ) -> Union[Optional[Dict], NewsletterStream]:
+        """Genera la newsletter completa usando OpenAI
+        
+        Con stream=True restituisce un NewsletterStream da iterare per ricevere
+        il testo man mano che viene generato.
+        """
+        with self._brand_profile_scope(data):
+            if stream:
+                return self._stream_newsletter(data, use_cache)
+            
+            with self.telemetry.span("generate", mode="newsletter") as span:
+                try:
+                    result, shared = self.single_flight.do(
+                        self._flight_key(data, "newsletter", use_cache),
+                        lambda: self._generate_newsletter(data, use_cache)
+                    )
+                except TimeoutError as e:
+                    result, shared = self._shared_timeout(data, e), True
+                span.set(shared=shared)
+        return result
+    
+    def _shared_timeout(self, data: Dict, error: TimeoutError) -> Dict:
+        """Generazione identica seguita ferma oltre max_age: come gli altri errori, si usa il template"""
+        logger.error("Errore nella generazione condivisa (%s): %s", type(error).__name__, error)
+        return self._generate_fallback_content(data)
+    
+    def _generate_newsletter(self, data: Dict, use_cache: bool) -> Dict:
+        """Generazione completa (cache, cascata di modelli o template), senza unione delle richieste"""
+        try:
+            # Costruire il prompt principale e consultare la cache
+            if use_cache and self.cache is not None:
+                messages, cache_key = self._prepare_request(data)
+                content = self.cache.get(cache_key)
+                annotate(cache_hit=content is not None)
+                if content is not None:
+                    return self.enforce_constraints(self._parse_response(content, data), data)
+            
+            # Circuito aperto: niente attese di timeout, si risponde subito con il template
+            if self.circuit_breaker.is_open():
+                annotate(circuit_open=True)
+                return self._generate_fallback_content(data)
+            
+            # Chiamata a OpenAI lungo la cascata di modelli
+            return self._generate_with_fallback_model(data)
+            
+        except Exception as e:
+            logger.error("Errore nella generazione (%s): %s", type(e).__name__, e)
+            return self._generate_fallback_content(data)
+    
+    def _generate_with_fallback_model(self, data: Dict, max_tokens: Optional[int] = None) -> Dict:
+        """Genera la newsletter con la cascata di modelli (es. GPT-4 -> GPT-3.5 -> template)
+        
+        Se il modello principale è lento parte una richiesta di copertura al modello più
+        veloce e vince la prima risposta valida; se nessun modello risponde in tempo si
+        usa il contenuto di fallback. max_tokens sostituisce il budget calcolato dai prodotti.
+        """
+        max_tokens = max_tokens or self._completion_tokens(data)
+        
+        def call(model: str) -> Dict:
+            messages, cache_key = self._prepare_request(data, model)
+            # Lo scheduler ha già riprovato gli errori temporanei: qui arrivano solo
+            # errori definitivi o tentativi esauriti
+            content = self._chat_completion(
+                messages,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=self.temperature,
+                schema=RESPONSE_SCHEMA
+            )
+            if self._response_format(model, RESPONSE_SCHEMA) is not None:
+                # Output strutturato: decodifica diretta e validata, senza parsing euristico
+                result = decode_structured(content)
+                if result is None:
+                    raise ValueError(f"Risposta non conforme allo schema da {model}")
+                if cache_key is not None:
+                    self.cache.set(cache_key, content)
+                return result
+            
+            parser = IncrementalResponseParser()
+            parser.feed(content)
+            if not (parser.complete and parser.seen_keys.issuperset(RESPONSE_KEYS)):
+                raise ValueError(f"Risposta non valida da {model}")
+            if cache_key is not None:
+                self.cache.set(cache_key, content)
+            return self._parse_response(content, data, parser)
+        
+        result, model = self.cascade.run(call)
+        if result is None:
+            logger.warning("Nessun modello disponibile, uso il template di fallback")
+            return self._generate_fallback_content(data)
+        return self._remember_similar(data, self.enforce_constraints(result, data))
+    
+    def _retry_truncated(self, data: Dict, truncated: TruncatedResponse) -> Dict:
+        """Ripete senza streaming una generazione troncata, con un budget di token più ampio"""
+        try:
+            return self._generate_with_fallback_model(data, self._larger_budget(truncated.model, truncated.max_tokens))
+        except Exception as e:
+            logger.error("Errore nella rigenerazione (%s): %s", type(e).__name__, e)
+            return self._generate_fallback_content(data)
+    
+    def generate_newsletter_pipeline(
+        self,
+        data: Dict,
+        use_cache: bool = True,
+        on_subjects: Optional[Callable[[List[str], List[str]], None]] = None
+    ) -> Dict:
+        """Genera oggetti/anteprime (modello veloce) e corpo (modello principale) in parallelo
+        
+        on_subjects(oggetti, anteprime) viene chiamata nel thread chiamante appena
+        arrivano oggetti e anteprime, senza attendere il corpo della newsletter
+        (alla fine, se la generazione è condivisa con una identica già in corso).
+        """
+        with self._brand_profile_scope(data), self.telemetry.span("generate", mode="pipeline") as span:
+            try:
+                result, shared = self.single_flight.do(
+                    self._flight_key(data, "pipeline", use_cache),
+                    lambda: self._generate_pipeline(data, use_cache, on_subjects)
+                )
+            except TimeoutError as e:
+                result, shared = self._shared_timeout(data, e), True
+            span.set(shared=shared)
+        if shared and on_subjects is not None:
+            on_subjects(result['email_subjects'], result['email_previews'])
+        return result
+    
+    def _generate_pipeline(self, data: Dict, use_cache: bool,
+                           on_subjects: Optional[Callable[[List[str], List[str]], None]]) -> Dict:
+        with ThreadPoolExecutor(max_workers=2, thread_name_prefix="pipeline") as executor:
+            # Ogni thread riceve una copia del contesto, così le sue fasi restano nella stessa traccia
+            subjects_future = executor.submit(
+                contextvars.copy_context().run, self._generate_subjects_and_previews, data, use_cache
+            )
+            body_future = executor.submit(contextvars.copy_context().run, self._generate_body, data, use_cache)
+            
+            pending = {subjects_future, body_future}
+            while subjects_future in pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                if subjects_future in done and on_subjects is not None:
+                    headline = subjects_future.result()
+                    on_subjects(headline['email_subjects'], headline['email_previews'])
+            
+            headline = subjects_future.result()
+            content = body_future.result()
+        
+        if content is None:
+            # Corpo dal template: oggetti e anteprime generati restano, ma il risultato è di fallback
+            return dict(self._generate_fallback_content(data), **headline)
+        return self._remember_similar(data, self.enforce_constraints({
+            "email_subjects": headline['email_subjects'],
+            "email_previews": headline['email_previews'],
+            "newsletter_content": content
+        }, data))
+    
+    def _cached_completion(self, data: Dict, messages: List[Dict], model: str, max_tokens: int,
+                           temperature: float, part: str, use_cache: bool,
+                           schema: Optional[Dict] = None) -> str:
+        """Chiamata chat completion servita dalla cache delle risposte quando possibile"""
+        cache_key = self._completion_cache_key(data, messages, model, max_tokens, temperature, part, schema)
+        if cache_key is not None:
+            if use_cache:
+                content = self.cache.get(cache_key)
+                if content is not None:
+                    return content
+        
+        content = self._chat_completion(
+            messages, model=model, max_tokens=max_tokens, temperature=temperature, schema=schema
+        )
+        if cache_key is not None:
+            self.cache.set(cache_key, content)
+        return content
+    
+    def _completion_cache_key(self, data: Dict, messages: List[Dict], model: str, max_tokens: int,
+                              temperature: float, part: str, schema: Optional[Dict] = None) -> Optional[str]:
+        if self.cache is None:
+            return None
+        return make_cache_key(data, model, messages[0]["content"], {
+            "part": part,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "response_format": self._response_format(model, schema)
+        })
+    
+    def _generate_subjects_and_previews(self, data: Dict, use_cache: bool = True) -> Dict:
+        """Oggetti e anteprime con il modello veloce (pipeline)"""
+        company = data.get('company_name', 'Azienda')
+        try:
+            content = self._cached_completion(
+                data,
+                self._build_messages(data, SUBJECTS_SYSTEM_PROMPT),
+                model=self.fallback_model,
+                max_tokens=300,
+                temperature=0.8,
+                part="subjects",
+                use_cache=use_cache,
+                schema=SUBJECTS_SCHEMA
+            )
+            result = parse_response(content, company)
+        except Exception as e:
+            logger.error("Errore generazione oggetti e anteprime: %s", e)
+            result = self._generate_fallback_content(data)
+        return {"email_subjects": result["email_subjects"], "email_previews": result["email_previews"]}
+    
+    def _generate_body(self, data: Dict, use_cache: bool = True) -> Optional[str]:
+        """Corpo della newsletter in markdown lungo la cascata di modelli (pipeline), None se nessun modello risponde"""
+        messages = self._build_messages(data, BODY_SYSTEM_PROMPT)
+        max_tokens = self._completion_tokens(data)
+        
+        def call(model: str) -> str:
+            content = strip_code_fence(self._cached_completion(
+                data,
+                messages,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=self.temperature,
+                part="body",
+                use_cache=use_cache
+            ))
+            if not content:
+                raise ValueError(f"Contenuto vuoto da {model}")
+            return content
+        
+        content, _ = self.cascade.run(call)
+        if content is None:
+            logger.error("Errore generazione contenuto: nessun modello disponibile")
+        return content
+    
+    def _stream_newsletter(self, data: Dict, use_cache: bool) -> NewsletterStream:
+        """Prepara la generazione in streaming, servendo dalla cache quando possibile"""
+        # La fase termina quando lo stream è stato consumato, non al ritorno di questo metodo
+        span = self.telemetry.start_span("generate", mode="stream")
+        with self.telemetry.use(span):
+            messages, cache_key = self._prepare_request(data)
+        if cache_key is not None and use_cache:
+            cached = self.cache.get(cache_key)
+            span.set(cache_hit=cached is not None)
+            if cached is not None:
+                return NewsletterStream(self, data, iter([cached]), span=span)
+        if self.circuit_breaker.is_open():
+            # Stream vuoto: il risultato è il contenuto di fallback
+            span.set(circuit_open=True)
+            return NewsletterStream(self, data, iter(()), span=span)
+        
+        # Stessa generazione già in corso: si seguono i suoi frammenti invece di aprire un altro stream
+        key = self._flight_key(data, "stream", use_cache)
+        flight, leader = self.single_flight.join(key)
+        span.set(shared=not leader)
+        if not leader:
+            return NewsletterStream(self, data, flight.subscribe(self.single_flight.max_age), shared=flight, span=span)
+        
+        # Lo stream passa per la cascata: se il modello principale non apre lo stream o tarda
+        # il primo frammento, risponde il modello di riserva
+        max_tokens = self._completion_tokens(data)
+        
+        def on_model(model: str) -> None:
+            span.set(model=model)
+            if model != self.model:
+                stream._cache_key = self._request_cache_key(data, model)
+        
+        deltas = self.cascade.stream(
+            lambda model: self._chat_completion_stream(
+                messages,
+                model=model,
+                max_tokens=max_tokens,
+                temperature=self.temperature,
+                schema=RESPONSE_SCHEMA,
+                parent=span
+            ),
+            on_model=on_model
+        )
+        stream = NewsletterStream(
+            self, data, flight.relay(deltas), cache_key,
+            on_done=lambda result: self.single_flight.land(key, flight, result), span=span
+        )
+        return stream
+    
+    async def agenerate_newsletter(self, data: Dict, use_cache: bool = True) -> Dict:
+        """Versione asincrona di generate_newsletter: gli errori vengono propagati al chiamante"""
+        import asyncio
+        
+        profile = None
+        if self.brand_store is not None:
+            # Lettura su SQLite ed eventuale riassunto bloccano: fuori dall'event loop
+            profile = await asyncio.get_running_loop().run_in_executor(None, self._load_brand_profile, data)
+        with self._brand_profile_scope(data, profile):
+            messages, cache_key = self._prepare_request(data)
+        content = None
+        if cache_key is not None and use_cache:
+            content = self.cache.get(cache_key)
+        
+        if content is None:
+            content = await self._achat_completion(
+                messages,
+                model=self.model,
+                max_tokens=self._completion_tokens(data),
+                temperature=self.temperature,
+                schema=RESPONSE_SCHEMA
+            )
+            if cache_key is not None:
+                self.cache.set(cache_key, content)
+        
+        result = await self.aenforce_constraints(self._parse_response(content, data), data)
+        return self._remember_similar(data, result)
+    
+    async def generate_many(
+        self,
+        items: List[Dict],
+        max_concurrency: int = 5,
+        use_cache: bool = True
+    ) -> AsyncIterator[Dict]:
+        """Genera più newsletter in parallelo, restituendo i risultati man mano che sono pronti
+        
+        Ogni elemento prodotto è un dizionario con 'index' (posizione in items),
+        'result' e 'error'. Un errore su una singola newsletter non interrompe le altre:
+        in quel caso 'result' contiene il contenuto di fallback.
+        """
+        import asyncio
+        
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+        
+        async def run(index: int, data: Dict) -> Dict:
+            async with semaphore:
+                try:
+                    result = await self.agenerate_newsletter(data, use_cache=use_cache)
+                    return {"index": index, "result": result, "error": None}
+                except Exception as e:
+                    logger.error("Errore nella generazione %d: %s", index, e)
+                    return {
+                        "index": index,
+                        "result": self._generate_fallback_content(data),
+                        "error": str(e)
+                    }
+        
+        tasks = [asyncio.ensure_future(run(i, data)) for i, data in enumerate(items)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    def _flight_key(self, data: Dict, mode: str, use_cache: bool) -> str:
+        """Impronta canonica della richiesta, per unire le generazioni identiche contemporanee"""
+        return make_cache_key(data, self.model, self._get_system_prompt(), {
+            "mode": mode,
+            "use_cache": use_cache,
+            "max_tokens": self.max_tokens,
+            "temperature": self.temperature,
+            "structured_output": self.structured_output,
+            "check_constraints": self.check_constraints
+        })
+    
+    def _prepare_request(self, data: Dict, model: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """Costruisce i messaggi per il modello e la relativa chiave di cache"""
+        messages = self._build_messages(data)
+        return messages, self._request_cache_key(data, model or self.model)
+    
+    def _request_cache_key(self, data: Dict, model: str) -> Optional[str]:
+        """Chiave di cache della risposta completa per il modello, None senza cache"""
+        if self.cache is None:
+            return None
+        return make_cache_key(data, model, self._get_system_prompt(), {
+            "max_tokens": self._completion_tokens(data),
+            "temperature": self.temperature,
+            "response_format": self._response_format(model, RESPONSE_SCHEMA)
+        })
+    
+    def _response_format(self, model: str, schema: Optional[Dict]) -> Optional[Dict]:
+        """response_format per l'output strutturato, se abilitato e supportato dal modello"""
+        if schema is None or not self.structured_output:
+            return None
+        return response_format_for(model, schema)
+    
+    def _create_completion(self, messages: List[Dict], model: str, max_tokens: int,
+                           temperature: float, schema: Optional[Dict] = None, **kwargs):
+        """Chiamata chat completion grezza con l'SDK disponibile"""
+        response_format = self._response_format(model, schema)
+        if response_format is not None:
+            kwargs["response_format"] = response_format
+        return self.provider.create(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **kwargs
+        )
+    
+    def _chat_completion(self, messages: List[Dict], model: str, max_tokens: int, temperature: float,
+                         schema: Optional[Dict] = None) -> str:
+        """Esegue una chiamata chat completion tramite lo scheduler e restituisce il testo"""
+        return self._chat_choices(messages, model, max_tokens, temperature, schema=schema)[0]
+    
+    def _chat_choices(self, messages: List[Dict], model: str, max_tokens: int, temperature: float,
+                      n: int = 1, schema: Optional[Dict] = None) -> List[str]:
+        """Come _chat_completion, ma restituisce n alternative generate dalla stessa richiesta"""
+        extra = {"n": n} if n > 1 else {}
+        with self.telemetry.span("completion", model=model) as span:
+            response = self.scheduler.run(
+                self._measured(span, lambda: self.circuit_breaker.call(
+                    lambda: self._create_completion(messages, model, max_tokens, temperature, schema, **extra),
+                    self._slow_call_seconds(model)
+                )),
+                estimated_tokens=estimate_request_tokens(messages, max_tokens * n)
+            )
+            span.add_usage(model, self.usage_tracker.record(model, getattr(response, "usage", None)))
+        if any(getattr(choice, "finish_reason", None) == "length" for choice in response.choices):
+            # Testo tagliato: non arriva al chiamante (né in cache), si ripete con più token
+            larger = self._larger_budget(model, max_tokens)
+            return self._chat_choices(messages, model, larger, temperature, n=n, schema=schema)
+        return [choice.message.content or "" for choice in response.choices]
+    
+    def _larger_budget(self, model: str, max_tokens: int) -> int:
+        """max_tokens per ripetere una risposta troncata: il doppio, fino al tetto self.max_tokens
+        
+        Solleva TruncatedResponse se la risposta era già stata troncata al tetto.
         """
+        if max_tokens >= self.max_tokens:
+            raise TruncatedResponse(model, max_tokens)
+        larger = min(self.max_tokens, max_tokens * 2)
+        logger.warning("Risposta di %s troncata a %d token, la ripeto con %d", model, max_tokens, larger)
+        annotate(truncated=True)
+        return larger
+    
+    def _slow_call_seconds(self, model: str) -> Optional[float]:
+        """Soglia di lentezza per il circuito: il budget di latenza del modello nella cascata"""
+        for tier_model, budget in self.cascade.tiers:
+            if tier_model == model:
+                return budget
+        return None
+    
+    def _measured(self, span: Span, func: Callable):
+        """Avvolge un tentativo di chiamata registrando sulla fase attesa in coda, durata di rete e tentativi"""
+        def attempt():
+            started = time.perf_counter()
+            if "queue_ms" not in span.attrs:
+                span.set(queue_ms=round((started - span.started) * 1e3, 3))
+            span.set(attempts=span.attrs.get("attempts", 0) + 1)
+            try:
+                return func()
+            finally:
+                span.set(network_ms=round((time.perf_counter() - started) * 1e3, 3))
+        return attempt
+    
+    def _ameasured(self, span: Span, func: Callable):
+        """Versione asincrona di _measured"""
+        async def attempt():
+            started = time.perf_counter()
+            if "queue_ms" not in span.attrs:
+                span.set(queue_ms=round((started - span.started) * 1e3, 3))
+            span.set(attempts=span.attrs.get("attempts", 0) + 1)
+            try:
+                return await func()
+            finally:
+                span.set(network_ms=round((time.perf_counter() - started) * 1e3, 3))
+        return attempt
+    
+    def _chat_completion_stream(self, messages: List[Dict], model: str, max_tokens: int,
+                                temperature: float, schema: Optional[Dict] = None,
+                                parent: Optional[Span] = None) -> Iterator[str]:
+        """Come _chat_completion, ma restituisce i frammenti di testo man mano che arrivano"""
+        # Con l'SDK nuovo l'ultimo frammento riporta l'uso dei token
+        provider = self.provider
+        extra = {"stream_options": {"include_usage": True}} if provider.stream_usage else {}
+        span = self.telemetry.start_span("completion", parent=parent, model=model, stream=True)
+        try:
+            # Gli errori di rate limit arrivano all'apertura dello stream, che quindi passa dallo scheduler
+            response = self.scheduler.run(
+                self._measured(span, lambda: self.circuit_breaker.call(
+                    lambda: self._create_completion(messages, model, max_tokens, temperature, schema, stream=True, **extra),
+                    self._slow_call_seconds(model)
+                )),
+                estimated_tokens=estimate_request_tokens(messages, max_tokens)
+            )
+            finish_reason = None
+            for chunk in response:
+                if getattr(chunk, "usage", None) is not None:
+                    span.add_usage(model, self.usage_tracker.record(model, chunk.usage))
+                if chunk.choices:
+                    finish_reason = getattr(chunk.choices[0], "finish_reason", None) or finish_reason
+                content = provider.chunk_text(chunk)
+                if content:
+                    if "ttfb_ms" not in span.attrs:
+                        span.set(ttfb_ms=round((time.perf_counter() - span.started) * 1e3, 3))
+                    yield content
+            if finish_reason == "length":
+                # I frammenti sono già arrivati al chiamante: è lui a scartarli e a ripetere (NewsletterStream)
+                raise TruncatedResponse(model, max_tokens)
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.end()
+    
+    async def _achat_completion(self, messages: List[Dict], model: str, max_tokens: int, temperature: float,
+                                schema: Optional[Dict] = None) -> str:
+        """Versione asincrona di _chat_completion"""
+        extra = {}
+        response_format = self._response_format(model, schema)
+        if response_format is not None:
+            extra["response_format"] = response_format
+        create = lambda: self.provider.acreate(
+            model=model,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            **extra
+        )
+        with self.telemetry.span("completion", model=model) as span:
+            response = await self.scheduler.arun(
+                self._ameasured(span, lambda: self.circuit_breaker.acall(create, self._slow_call_seconds(model))),
+                estimated_tokens=estimate_request_tokens(messages, max_tokens)
+            )
+            span.add_usage(model, self.usage_tracker.record(model, getattr(response, "usage", None)))
+        if getattr(response.choices[0], "finish_reason", None) == "length":
+            larger = self._larger_budget(model, max_tokens)
+            return await self._achat_completion(messages, model, larger, temperature, schema=schema)
+        return response.choices[0].message.content
+    
+    def _generate_fallback_content(self, data: Dict) -> Dict:
+        """Genera contenuto di fallback in caso di errore (template precompilato, senza chiamate)
+        
+        Il risultato ha 'fallback': True, così chi lo riceve (es. la CLI) sa che va rigenerato.
+        """
+        annotate(fallback=True)
+        return dict(render_fallback(data), fallback=True)
+    
+    def _get_system_prompt(self) -> str:
+        """Prompt di sistema per definire il comportamento dell'AI (identico per ogni richiesta)"""
+        return STATIC_SYSTEM_PROMPT
+    
+    def _build_messages(self, data: Dict, system_prompt: Optional[str] = None) -> List[Dict]:
+        """Messaggi dal più stabile al più variabile: sistema e regole, brand, campagna
+        
+        Richieste successive per lo stesso brand condividono il prefisso fino al blocco
+        della campagna, che il provider può servire dalla cache dei prompt.
+        """
+        with self.telemetry.span("build_prompt"):
+            data = self._prepare_prompt_data(data)
+            return [
+                {"role": "system", "content": system_prompt or self._get_system_prompt()},
+                {"role": "user", "content": self._render_brand_block(data)},
+                {"role": "user", "content": self._render_campaign_block(data)}
+            ]
     
     def _build_prompt(self, data: Dict) -> str:
-        """Costruisce il prompt personalizzato con i dati dell'utente"""
+        """Costruisce il prompt personalizzato con i dati dell'utente, entro il budget di input"""
+        with self.telemetry.span("build_prompt"):
+            data = self._prepare_prompt_data(data)
+            return self._render_brand_block(data) + "\n\n" + self._render_campaign_block(data)
+    
+    def _prepare_prompt_data(self, data: Dict) -> Dict:
+        """Applica il profilo del brand e il budget di input ai dati del prompt"""
+        if self.brand_store is not None:
+            data = self._apply_brand_profile(data)
+        return self._fit_input_budget(data)
+    
+    @contextmanager
+    def _brand_profile_scope(self, data: Dict, profile: Optional[Dict] = None) -> Iterator[None]:
+        """Risolve il profilo del brand una volta per generazione (o usa quello già letto)
         
-        # Informazioni base
-        prompt = f"""
-        Genera una newsletter ottimizzata per:
-
-        **AZIENDA:** {data['company_name']}
-        **SITO WEB:** {data.get('website_url', 'Non specificato')}
-        **DESCRIZIONE:** {data['company_description']}
-
-        **TIPO EMAIL:** {data['email_type']}
-        **OBIETTIVO:** {data['email_objective']}
-        **BRIEF CONTENUTO:** {data['content_brief']}
-
-        **TARGET:** {data['target_audience']}
-        **SEGMENTI MERCATO:** {', '.join([s for s in data['market_segments'] if s])}
-        **TONE OF VOICE:** {data['tone_of_voice']}
-        **LINGUA:** {data['language']}
+        I prompt costruiti all'interno, anche nei thread della pipeline e della cascata,
+        riusano lo stesso profilo invece di rileggerlo o riassumerlo di nuovo.
         """
+        if self.brand_store is None:
+            yield
+            return
+        if profile is None:
+            profile = self._load_brand_profile(data)
+        token = _brand_profile.set((self._brand_fingerprint(data), profile))
+        try:
+            yield
+        finally:
+            _brand_profile.reset(token)
+    
+    def _brand_fingerprint(self, data: Dict) -> str:
+        return brand_key(data.get('company_name', ''), data.get('website_url', '')) + "|" + source_hash(data)
+    
+    def _load_brand_profile(self, data: Dict) -> Optional[Dict]:
+        """Profilo del brand dall'archivio, riassumendo la descrizione se manca (None se non disponibile)"""
+        try:
+            return self.brand_store.get_or_create(data, self._summarize_brand)
+        except Exception as e:
+            logger.warning("Profilo brand non disponibile: %s", e)
+            return None
+    
+    def _apply_brand_profile(self, data: Dict) -> Dict:
+        """Sostituisce la descrizione aziendale con il riassunto salvato nel profilo del brand"""
+        scoped = _brand_profile.get()
+        if scoped is not None and scoped[0] == self._brand_fingerprint(data):
+            profile = scoped[1]
+        else:
+            profile = self._load_brand_profile(data)
+        if profile is None:
+            return data
+        return dict(
+            data,
+            company_description=profile['summary'],
+            tone_of_voice=data.get('tone_of_voice') or profile['tone_of_voice']
+        )
+    
+    def _summarize_brand(self, data: Dict) -> str:
+        """Riassunto della descrizione aziendale, da calcolare una sola volta per brand"""
+        description = collapse_whitespace(data.get('company_description', ''))
+        if estimate_tokens(description, self.model) <= self.brand_summary_tokens:
+            return description
+        
+        prompt = (
+            f"Riassumi in massimo {self.brand_summary_tokens // 2} parole la descrizione dell'azienda "
+            f"{data.get('company_name', '')}, mantenendo settore, prodotti o servizi principali, "
+            "punti di forza e valori. Rispondi solo con il riassunto.\n\n"
+            f"{description}"
+        )
+        summary = self._chat_completion(
+            [{"role": "user", "content": prompt}],
+            model=self.fallback_model,
+            max_tokens=self.brand_summary_tokens * 2,
+            temperature=0.2
+        ).strip()
+        if not summary:
+            raise ValueError("Riassunto vuoto")
+        return summary
+    
+    def _fit_input_budget(self, data: Dict) -> Dict:
+        """Compatta descrizione, brief e USP se il prompt supera input_token_budget"""
+        fixed_data = dict(data, **{field: "" for field in COMPACTABLE_FIELDS})
+        fixed_tokens = (
+            estimate_tokens(self._get_system_prompt(), self.model)
+            + estimate_tokens(self._render_brand_block(fixed_data), self.model)
+            + estimate_tokens(self._render_campaign_block(fixed_data), self.model)
+        )
+        return compact_fields(data, self.input_token_budget - fixed_tokens, self.model)
+    
+    def _completion_tokens(self, data: Dict) -> int:
+        """max_tokens per la generazione, proporzionato al numero di prodotti"""
+        return completion_budget(len(data.get('products') or []), cap=self.max_tokens)
+    
+    def _render_brand_block(self, data: Dict) -> str:
+        """Dati del brand, stabili tra una campagna e l'altra"""
+        prompt = (
+            "Genera una newsletter ottimizzata per:\n\n"
+            f"**AZIENDA:** {data['company_name']}\n"
+            f"**SITO WEB:** {data.get('website_url') or 'Non specificato'}\n"
+            f"**DESCRIZIONE:** {data['company_description']}\n"
+            f"**TONE OF VOICE:** {data['tone_of_voice']}"
+        )
+        
+        # USP/Benefit
+        if data.get('usp_benefit'):
+            prompt += f"\n**USP/BENEFIT:** {data['usp_benefit']}"
+        
+        # Parole vietate
+        if data.get('forbidden_words'):
+            prompt += f"\n**PAROLE DA EVITARE:** {', '.join(data['forbidden_words'])}"
+        
+        return prompt
+    
+    def _render_campaign_block(self, data: Dict) -> str:
+        """Dati della singola campagna"""
+        prompt = (
+            f"**TIPO EMAIL:** {data['email_type']}\n"
+            f"**OBIETTIVO:** {data['email_objective']}\n"
+            f"**BRIEF CONTENUTO:** {data['content_brief']}\n\n"
+            f"**TARGET:** {data['target_audience']}\n"
+            f"**SEGMENTI MERCATO:** {', '.join([s for s in data['market_segments'] if s])}\n"
+            f"**LINGUA:** {data['language']}"
+        )
         
         # Prodotti
         if data.get('products'):
-            prompt += "\n**PRODOTTI DA INCLUDERE:**\n"
+            prompt += "\n\n**PRODOTTI DA INCLUDERE:**"
             for i, product in enumerate(data['products'], 1):
-                prompt += f"{i}. {product['name']}"
+                prompt += f"\n{i}. {product['name']}"
                 if product.get('link'):
                     prompt += f" - Link: {product['link']}"
-                prompt += "\n"
-        
-        # USP/Benefit
-        if data.get('usp_benefit'):
-            prompt += f"\n**USP/BENEFIT:** {data['usp_benefit']}"
         
         # Codici sconto
         if data.get('discount_codes'):
             prompt += f"\n**CODICI SCONTO:** {', '.join(data['discount_codes'])}"
         
-        # Parole vietate
-        if data.get('forbidden_words'):
-            prompt += f"\n**PAROLE DA EVITARE:** {', '.join(data['forbidden_words'])}"
-        
         # Parole richieste
         if data.get('required_words'):
             prompt += f"\n**PAROLE DA INCLUDERE:** {', '.join(data['required_words'])}"
         
-        prompt += """
-
-        Genera:
-        1. 3 oggetti email accattivanti (MAX 40 caratteri)
-        2. 3 anteprime email persuasive (MAX 100 caratteri)  
-        3. Newsletter completa con struttura professionale
+        return prompt
+    
+    def _parse_response(self, content: str, data: Dict,
+                        parser: Optional[IncrementalResponseParser] = None) -> Dict:
+        """Parsing della risposta OpenAI"""
+        with self.telemetry.span("parse_response"):
+            try:
+                return parse_response(content, data.get('company_name', 'Azienda'), parser)
+            except Exception as e:
+                logger.error("Errore nel parsing: %s", e)
+                # Fallback completo
+                return self._generate_fallback_content(data)
 
-        Per la newsletter, includi:
-        - Titolo coinvolgente
-        - Paragrafo introduttivo che catturi l'attenzione
-        - Call to action principale
-        - Sezioni prodotto dettagliate (se presenti) con descrizioni, benefici e CTA
-        - Chiusura persuasiva con CTA finale
-        
-        Usa un linguaggio adatto al tone of voice e al target specificato.
-        Rispetta RIGOROSAMENTE i limiti di caratteri per oggetti e anteprime.
+    def enforce_constraints(self, result: Dict, data: Dict) -> Dict:
+        """Verifica il risultato e corregge solo oggetti, anteprime o paragrafi non conformi
+        
+        Le correzioni avvengono con una sola richiesta breve al modello veloce, salvata nella
+        cache delle risposte: un risultato letto dalla cache riusa la correzione già pagata.
+        I problemi rimasti dopo la correzione sono elencati in result['constraint_issues'].
+        """
+        result = {key: value for key, value in result.items() if key != 'constraint_issues'}
+        checker = self._constraint_checker(data)
+        violations = checker.check(result) if checker is not None else []
+        if not violations:
+            return result
+        with self.telemetry.span("constraints", violations=len(violations)):
+            try:
+                # Correzione in cache: i risultati serviti dalla cache non la ripagano a ogni lettura
+                messages = build_repair_messages(violations, checker.forbidden)
+                content = self._cached_completion(
+                    {"repair": messages[1]["content"]},
+                    messages,
+                    model=self.fallback_model,
+                    max_tokens=repair_max_tokens(violations),
+                    temperature=0.4,
+                    part="repair",
+                    use_cache=True,
+                    schema=REPAIR_SCHEMA
+                )
+                result = apply_repairs(result, violations, content)
+            except Exception as e:
+                logger.warning("Errore nella correzione dei vincoli: %s", e)
+        return self._with_constraint_issues(result, checker)
+    
+    async def aenforce_constraints(self, result: Dict, data: Dict) -> Dict:
+        """Versione asincrona di enforce_constraints"""
+        result = {key: value for key, value in result.items() if key != 'constraint_issues'}
+        checker = self._constraint_checker(data)
+        violations = checker.check(result) if checker is not None else []
+        if not violations:
+            return result
+        with self.telemetry.span("constraints", violations=len(violations)):
+            try:
+                messages = build_repair_messages(violations, checker.forbidden)
+                max_tokens = repair_max_tokens(violations)
+                cache_key = self._completion_cache_key(
+                    {"repair": messages[1]["content"]}, messages, self.fallback_model, max_tokens, 0.4,
+                    "repair", REPAIR_SCHEMA
+                )
+                content = self.cache.get(cache_key) if cache_key is not None else None
+                if content is None:
+                    content = await self._achat_completion(
+                        messages,
+                        model=self.fallback_model,
+                        max_tokens=max_tokens,
+                        temperature=0.4,
+                        schema=REPAIR_SCHEMA
+                    )
+                    if cache_key is not None:
+                        self.cache.set(cache_key, content)
+                result = apply_repairs(result, violations, content)
+            except Exception as e:
+                logger.warning("Errore nella correzione dei vincoli: %s", e)
+        return self._with_constraint_issues(result, checker)
+    
+    def _constraint_checker(self, data: Dict) -> Optional[ConstraintChecker]:
+        if not self.check_constraints:
+            return None
+        return ConstraintChecker(data.get('forbidden_words') or [], data.get('required_words') or [])
+    
+    def _with_constraint_issues(self, result: Dict, checker: ConstraintChecker) -> Dict:
+        """Aggiunge al risultato i problemi ancora presenti dopo la correzione"""
+        remaining = checker.check(result)
+        if remaining:
+            return dict(result, constraint_issues=describe_violations(remaining))
+        return result
+    
+    def find_similar(self, data: Dict, threshold: Optional[float] = None) -> Optional[Dict]:
+        """Risultato di una richiesta precedente quasi identica, da proporre subito come bozza
+        
+        Restituisce un dizionario con 'result' e 'similarity' (0-1), oppure None. Se la
+        richiesta identica è nella cache delle risposte restituisce None: la generazione
+        la servirà dalla cache, senza bisogno di una bozza.
+        """
+        if self.similarity_cache is None:
+            return None
+        try:
+            cache_key = self._request_cache_key(data, self.model)
+            if cache_key is not None and self.cache.get(cache_key) is not None:
+                return None
+            return self.similarity_cache.lookup(data, threshold)
+        except Exception as e:
+            logger.warning("Errore nella ricerca di richieste simili: %s", e)
+            return None
+    
+    def adapt_similar(self, match: Dict, data: Dict) -> Dict:
+        """Adatta la bozza trovata da find_similar ai dati attuali con il modello veloce
+        
+        Costa meno di una generazione completa con il modello principale; in caso di
+        errore restituisce la bozza invariata.
+        """
+        draft = {key: match['result'].get(key) for key in RESPONSE_KEYS}
+        messages = self._build_messages(data, ADAPT_SYSTEM_PROMPT)
+        messages.append({
+            "role": "user",
+            "content": "**BOZZA DA ADATTARE:**\n" + json.dumps(draft, ensure_ascii=False)
+        })
+        try:
+            content = self._chat_completion(
+                messages,
+                model=self.fallback_model,
+                max_tokens=self._completion_tokens(data),
+                temperature=0.3,
+                schema=RESPONSE_SCHEMA
+            )
+        except Exception as e:
+            logger.warning("Errore nell'adattamento della bozza: %s", e)
+            return match['result']
+        result = self.enforce_constraints(self._parse_response(content, data), data)
+        return self._remember_similar(data, result)
+    
+    def _remember_similar(self, data: Dict, result: Dict) -> Dict:
+        """Registra il risultato nell'indice delle richieste simili (non i contenuti di fallback)"""
+        if self.similarity_cache is not None and not result.get('fallback'):
+            try:
+                self.similarity_cache.add(data, result)
+            except Exception as e:
+                logger.warning("Errore nel salvataggio della richiesta simile: %s", e)
+        return result
+    
+    def get_sections(self, result: Dict, data: Dict) -> List[Dict]:
+        """Sezioni del contenuto (title, intro, cta, product-N, section-N, closing)"""
+        return split_sections(result.get('newsletter_content', ''), data.get('products'))
+    
+    def regenerate_section(self, result: Dict, section_id: str, data: Dict) -> Dict:
+        """Rigenera una sola sezione del contenuto e la reinserisce nel risultato
+        
+        Al modello vengono inviati solo la sezione e il contesto minimo per riscriverla;
+        in caso di errore il risultato viene restituito invariato.
         """
+        content = result.get('newsletter_content', '')
+        sections = split_sections(content, data.get('products'))
+        section = find_section(sections, section_id)
+        if section is None:
+            raise KeyError(f"Sezione inesistente: {section_id}")
         
+        messages = [
+            {"role": "system", "content": SECTION_SYSTEM_PROMPT},
+            {"role": "user", "content": self._render_section_prompt(data, sections, section)}
+        ]
+        try:
+            text = strip_code_fence(self._chat_completion(
+                messages,
+                model=self.model,
+                max_tokens=min(self.max_tokens, estimate_tokens(section['text'], self.model) * 2 + 100),
+                temperature=self.temperature
+            ))
+        except Exception as e:
+            logger.error("Errore nella rigenerazione della sezione %s: %s", section_id, e)
+            return result
+        if not text:
+            return result
+        
+        updated = dict(
+            result,
+            newsletter_content=replace_section(content, section_id, text, data.get('products'))
+        )
+        return self.enforce_constraints(updated, data)
+    
+    def _render_section_prompt(self, data: Dict, sections: List[Dict], section: Dict) -> str:
+        """Contesto minimo per riscrivere la sezione: brand, campagna e parti pertinenti"""
+        prompt = (
+            f"**AZIENDA:** {data['company_name']}\n"
+            f"**TONE OF VOICE:** {data['tone_of_voice']}\n"
+            f"**TARGET:** {data['target_audience']}\n"
+            f"**LINGUA:** {data['language']}\n"
+            f"**OBIETTIVO:** {data['email_objective']}"
+        )
+        if section['kind'] == 'product':
+            product = data['products'][int(section['id'].split('-')[1]) - 1]
+            prompt += f"\n**PRODOTTO:** {product['name']}"
+            if product.get('link'):
+                prompt += f" - Link: {product['link']}"
+        elif section['kind'] in ('cta', 'closing') and data.get('discount_codes'):
+            prompt += f"\n**CODICI SCONTO:** {', '.join(data['discount_codes'])}"
+        if data.get('forbidden_words'):
+            prompt += f"\n**PAROLE DA EVITARE:** {', '.join(data['forbidden_words'])}"
+        
+        title = find_section(sections, 'title')
+        if title is not None and title is not section:
+            prompt += f"\n**TITOLO NEWSLETTER:** {title['heading']}"
+        prompt += f"\n\n**SEZIONE DA RISCRIVERE ({section_label(section)}):**\n{section['text'].strip()}"
         return prompt
     
-    def _parse_response(self, content: str, data: Dict) -> Dict:
-        """Parsing della risposta OpenAI"""
+    def generate_subject_variants(self, data: Dict, count: int = 15, similarity_threshold: float = 0.6) -> Dict:
+        """Genera molte varianti di oggetto e anteprima per test A/B con una sola richiesta
+        
+        Usa il parametro n dell'API per ottenere più alternative insieme, scarta quelle
+        oltre i limiti di 40/100 caratteri e le quasi-duplicate (similarità MinHash).
+        Restituisce fino a count oggetti e count anteprime.
+        """
+        # Ogni alternativa propone 3 oggetti: si chiede un margine per compensare gli scarti
+        n = max(1, math.ceil(count * 1.5 / 3))
         try:
-            # Tentativo di parsing JSON diretto
-            if content.strip().startswith('{'):
-                result = json.loads(content)
-                # Verifica che abbia tutti i campi necessari
-                if all(key in result for key in ['email_subjects', 'email_previews', 'newsletter_content']):
-                    return result
-            
-            # Se non è JSON valido, prova a estrarre il contenuto manualmente
-            lines = content.strip().split('\n')
-            
-            subjects = []
-            previews = []
-            newsletter_content = ""
-            
-            current_section = None
-            content_lines = []
-            
-            for line in lines:
-                line = line.strip()
-                
-                if any(word in line.lower() for word in ["oggett", "subject"]):
-                    current_section = "subjects"
-                elif any(word in line.lower() for word in ["anteprima", "preview"]):
-                    current_section = "previews"
-                elif any(word in line.lower() for word in ["contenuto", "newsletter", "content"]):
-                    current_section = "content"
-                elif line and current_section:
-                    if current_section == "subjects" and len(subjects) < 3:
-                        # Pulire la linea e prendere solo il testo
-                        clean_line = line.replace("1.", "").replace("2.", "").replace("3.", "").replace("-", "").strip()
-                        clean_line = clean_line.replace('"', '').replace("'", "")
-                        if clean_line and len(clean_line) <= 40:
-                            subjects.append(clean_line)
-                    elif current_section == "previews" and len(previews) < 3:
-                        clean_line = line.replace("1.", "").replace("2.", "").replace("3.", "").replace("-", "").strip()
-                        clean_line = clean_line.replace('"', '').replace("'", "")
-                        if clean_line and len(clean_line) <= 100:
-                            previews.append(clean_line)
-                    elif current_section == "content":
-                        content_lines.append(line)
-            
-            # Se non abbiamo abbastanza oggetti/anteprime, generali di default
-            company = data.get('company_name', 'Azienda')
-            while len(subjects) < 3:
-                subjects.append(f"Newsletter {company}"[:40])
-            
-            while len(previews) < 3:
-                previews.append(f"Scopri le novità di {company}"[:100])
-            
-            newsletter_content = '\n'.join(content_lines) if content_lines else content
-            
-            return {
-                "email_subjects": subjects[:3],
-                "email_previews": previews[:3], 
-                "newsletter_content": newsletter_content
-            }
-            
+            choices = self._chat_choices(
+                self._build_messages(data, SUBJECTS_SYSTEM_PROMPT),
+                model=self.fallback_model,
+                max_tokens=300,
+                temperature=1.0,
+                n=n,
+                schema=SUBJECTS_SCHEMA
+            )
         except Exception as e:
-            print(f"Errore nel parsing: {str(e)}")
-            # Fallback completo
-            return self._generate_fallback_content(data)
-
+            logger.error("Errore generazione varianti: %s", e)
+            choices = []
+        
+        subjects = []
+        previews = []
+        for content in choices:
+            parser = IncrementalResponseParser()
+            parser.feed(content)
+            subjects.extend(s for s in parser.subjects if 0 < len(s) <= 40)
+            previews.extend(p for p in parser.previews if 0 < len(p) <= 100)
+        
+        return {
+            "email_subjects": prune_near_duplicates(subjects, similarity_threshold)[:count],
+            "email_previews": prune_near_duplicates(previews, similarity_threshold)[:count]
+        }
+    
     def generate_subjects_only(self, data: Dict) -> List[str]:
         """Genera solo gli oggetti email"""
         try:
@@ -310,22 +1244,12 @@ Il team di {company}
             Rispondi solo con i 3 oggetti, uno per riga, senza numerazione.
             """
             
-            if NEW_OPENAI:
-                response = self.client.chat.completions.create(
-                    model="gpt-3.5-turbo",
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=200,
-                    temperature=0.8
-                )
-                content = response.choices[0].message.content.strip()
-            else:
-                response = openai.ChatCompletion.create(
-                    model="gpt-3.5-turbo",
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=200,
-                    temperature=0.8
-                )
-                content = response.choices[0].message.content.strip()
+            content = self._chat_completion(
+                [{"role": "user", "content": prompt}],
+                model="gpt-3.5-turbo",
+                max_tokens=200,
+                temperature=0.8
+            ).strip()
             
             subjects = [line.strip() for line in content.split('\n') if line.strip()]
             
@@ -339,7 +1263,7 @@ Il team di {company}
             return valid_subjects[:3]
             
         except Exception as e:
-            print(f"Errore generazione oggetti: {str(e)}")
+            logger.error("Errore generazione oggetti: %s", e)
             return [
                 f"News {data['company_name']}"[:40],
                 f"Novità {data['company_name']}"[:40], 
@@ -0,0 +1,135 @@
+import math
+import re
+from typing import Dict, Iterable, List, Optional
+
+# Campi testuali liberi che possono essere compattati se il prompt supera il budget
+COMPACTABLE_FIELDS = ("company_description", "content_brief", "usp_benefit")
+MIN_FIELD_TOKENS = 40
+
+# Token di completamento: struttura fissa (oggetti, anteprime, intro, chiusura) + una sezione per prodotto.
+# Misurata sulle risposte registrate in benchmarks/responses.jsonl: ~260 token (~350 con i ~3 caratteri
+# per token dell'italiano) con due prodotti, ~1350 (~1800) per json_lungo, una newsletter lunga a più
+# sezioni. Una risposta troncata viene comunque ripetuta con un budget più ampio
+# (vedi NewsletterGenerator._larger_budget)
+BASE_COMPLETION_TOKENS = 2500
+TOKENS_PER_PRODUCT = 350
+
+_SENTENCE_SPLIT = re.compile(r'(?<=[.!?])\s+')
+_encodings: Dict[str, object] = {}
+
+
+def _get_encoding(model: str):
+    """Encoding tiktoken per il modello, se tiktoken è installato"""
+    if model in _encodings:
+        return _encodings[model]
+    try:
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except ImportError:
+        encoding = None
+    _encodings[model] = encoding
+    return encoding
+
+
+def estimate_tokens(text: str, model: str = "gpt-4") -> int:
+    """Numero di token del testo (tiktoken se disponibile, altrimenti ~4 caratteri per token)"""
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return math.ceil(len(text) / 4)
+
+
+def estimate_messages_tokens(messages: Iterable[Dict], model: str = "gpt-4") -> int:
+    """Token del prompt, inclusi i ~4 token di struttura per messaggio"""
+    return sum(estimate_tokens(m.get("content") or "", model) + 4 for m in messages) + 2
+
+
+def completion_budget(products_count: int, cap: int = 4000) -> int:
+    """max_tokens proporzionato al numero di prodotti da descrivere"""
+    return min(cap, BASE_COMPLETION_TOKENS + TOKENS_PER_PRODUCT * max(0, products_count))
+
+
+def collapse_whitespace(text: str) -> str:
+    """Riduce spazi, tabulazioni e righe vuote consecutive, mantenendo i paragrafi"""
+    paragraphs = [" ".join(p.split()) for p in re.split(r'\n\s*\n', text or "")]
+    return "\n".join(p for p in paragraphs if p)
+
+
+def dedupe_sentences(text: str) -> str:
+    """Rimuove le frasi ripetute (confronto senza maiuscole e spazi)"""
+    seen = set()
+    kept: List[str] = []
+    for paragraph in text.split("\n"):
+        sentences = []
+        for sentence in _SENTENCE_SPLIT.split(paragraph):
+            key = " ".join(sentence.lower().split())
+            if key and key not in seen:
+                seen.add(key)
+                sentences.append(sentence)
+        if sentences:
+            kept.append(" ".join(sentences))
+    return "\n".join(kept)
+
+
+def truncate_sentences(text: str, max_tokens: int, model: str = "gpt-4") -> str:
+    """Tiene le frasi iniziali che rientrano nel budget; taglia a parole solo la prima se serve"""
+    kept: List[str] = []
+    used = 0
+    for paragraph in text.split("\n"):
+        for sentence in _SENTENCE_SPLIT.split(paragraph):
+            cost = estimate_tokens(sentence + " ", model)
+            if used + cost > max_tokens:
+                if not kept:
+                    words = sentence.split()
+                    while words and estimate_tokens(" ".join(words) + "…", model) > max_tokens:
+                        words = words[:max(1, len(words) * 3 // 4)] if len(words) > 1 else []
+                    return " ".join(words) + "…" if words else ""
+                return " ".join(kept).strip()
+            kept.append(sentence)
+            used += cost
+        if kept:
+            kept[-1] += "\n"
+    return " ".join(kept).strip()
+
+
+def compact_text(text: str, max_tokens: int, model: str = "gpt-4") -> str:
+    """Compatta il testo in modo deterministico finché rientra in max_tokens"""
+    text = collapse_whitespace(text)
+    if estimate_tokens(text, model) <= max_tokens:
+        return text
+    text = dedupe_sentences(text)
+    if estimate_tokens(text, model) <= max_tokens:
+        return text
+    return truncate_sentences(text, max_tokens, model)
+
+
+def compact_fields(data: Dict, available_tokens: int, model: str = "gpt-4",
+                   fields: Optional[Iterable[str]] = None) -> Dict:
+    """Restituisce una copia di data con i campi liberi compattati entro available_tokens
+
+    Gli spazi superflui vengono sempre rimossi; se i campi superano comunque il budget,
+    ognuno riceve una quota proporzionale alla sua lunghezza (con un minimo garantito).
+    """
+    fields = tuple(fields or COMPACTABLE_FIELDS)
+    compacted = dict(data)
+    sizes = {}
+    for field in fields:
+        if compacted.get(field):
+            compacted[field] = collapse_whitespace(compacted[field])
+            sizes[field] = estimate_tokens(compacted[field], model)
+
+    total = sum(sizes.values())
+    if total <= available_tokens:
+        return compacted
+
+    available = max(available_tokens, MIN_FIELD_TOKENS * len(sizes))
+    for field, size in sizes.items():
+        share = max(MIN_FIELD_TOKENS, available * size // total)
+        if size > share:
+            compacted[field] = compact_text(compacted[field], share, model)
+    return compacted
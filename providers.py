@@ -0,0 +1,282 @@
+import abc
+import json
+import os
+import threading
+import time
+from types import SimpleNamespace
+from typing import Dict, Iterator, List, Optional
+
+# Backend scelto se non indicato esplicitamente (es. NEWSLETTER_PROVIDER=stub per lavorare senza rete)
+DEFAULT_BACKEND = os.environ.get("NEWSLETTER_PROVIDER", "auto")
+BACKENDS = ("auto", "openai", "openai-legacy", "http", "stub")
+# Endpoint del backend http (es. il server locale di benchmarks/fake_openai.py)
+DEFAULT_BASE_URL = os.environ.get("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+
+class ProviderUnavailable(ImportError):
+    """Il backend richiesto non è utilizzabile (SDK non installato)"""
+
+
+class ChatProvider(abc.ABC):
+    """Backend di chat completion con risposte nel formato dell'SDK OpenAI (choices, usage)
+
+    Gli SDK vengono importati solo quando il backend viene creato, non all'import del modulo.
+    """
+
+    name = "base"
+    # True se lo stream può riportare l'uso dei token nell'ultimo frammento (stream_options)
+    stream_usage = False
+
+    @abc.abstractmethod
+    def create(self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs):
+        """Risposta completa, o iteratore di frammenti con stream=True"""
+
+    @abc.abstractmethod
+    async def acreate(self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs):
+        """Versione asincrona di create"""
+
+    def chunk_text(self, chunk) -> Optional[str]:
+        """Testo di un frammento dello stream (None se il frammento non ne contiene)"""
+        if not chunk.choices:
+            return None
+        return chunk.choices[0].delta.content
+
+
+class OpenAIProvider(ChatProvider):
+    """SDK OpenAI >= 1.0"""
+
+    name = "openai"
+    stream_usage = True
+
+    def __init__(self, api_key: str, client=None):
+        from openai import OpenAI
+
+        self.api_key = api_key
+        # I tentativi sono gestiti da scheduler.RequestScheduler, non dall'SDK
+        self.client = client if client is not None else OpenAI(api_key=api_key, max_retries=0)
+        self._async_client = None
+        self._lock = threading.Lock()
+
+    def create(self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs):
+        return self.client.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, **kwargs
+        )
+
+    async def acreate(self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs):
+        with self._lock:
+            if self._async_client is None:
+                from openai import AsyncOpenAI
+                self._async_client = AsyncOpenAI(api_key=self.api_key, max_retries=0)
+        return await self._async_client.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, temperature=temperature, **kwargs
+        )
+
+
+class LegacyOpenAIProvider(ChatProvider):
+    """SDK OpenAI legacy (< 1.0); l'API key viene passata a ogni chiamata, non impostata globalmente"""
+
+    name = "openai-legacy"
+
+    def __init__(self, api_key: str):
+        import openai
+
+        if not hasattr(openai, "ChatCompletion"):
+            raise ProviderUnavailable("L'SDK OpenAI installato non è la versione legacy")
+        self.api_key = api_key
+        self._openai = openai
+
+    def create(self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs):
+        return self._openai.ChatCompletion.create(
+            api_key=self.api_key, model=model, messages=messages,
+            max_tokens=max_tokens, temperature=temperature, **kwargs
+        )
+
+    async def acreate(self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs):
+        return await self._openai.ChatCompletion.acreate(
+            api_key=self.api_key, model=model, messages=messages,
+            max_tokens=max_tokens, temperature=temperature, **kwargs
+        )
+
+    def chunk_text(self, chunk) -> Optional[str]:
+        if not chunk.choices:
+            return None
+        return chunk.choices[0].delta.get("content")
+
+
+class HTTPStatusError(Exception):
+    """Risposta di errore dell'endpoint, con stato e header (es. Retry-After) come negli SDK"""
+
+    def __init__(self, status_code: int, message: str, headers=None):
+        super().__init__(f"Error code: {status_code} - {message}")
+        self.status_code = status_code
+        self.headers = headers
+
+
+class APIConnectionError(ConnectionError):
+    """Endpoint non raggiungibile"""
+
+
+class APITimeoutError(TimeoutError):
+    """Endpoint che non risponde entro il timeout"""
+
+
+def _namespace(value):
+    """JSON della risposta con accesso ad attributi, come gli oggetti dell'SDK"""
+    if isinstance(value, dict):
+        return SimpleNamespace(**{key: _namespace(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return [_namespace(item) for item in value]
+    return value
+
+
+class HTTPProvider(ChatProvider):
+    """Chat completions via HTTP con la sola libreria standard, senza SDK
+
+    Parla con qualunque endpoint compatibile (base_url, di default OPENAI_BASE_URL).
+    """
+
+    name = "http"
+    stream_usage = True
+
+    def __init__(self, api_key: str, base_url: str = DEFAULT_BASE_URL, timeout: float = 120.0):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _post(self, payload: Dict):
+        import urllib.error
+        import urllib.request
+
+        request = urllib.request.Request(
+            f"{self.base_url}/chat/completions",
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"},
+            method="POST",
+        )
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            raise HTTPStatusError(e.code, e.read().decode("utf-8", "replace"), e.headers) from None
+        except urllib.error.URLError as e:
+            if isinstance(e.reason, TimeoutError):
+                raise APITimeoutError(str(e.reason)) from None
+            raise APIConnectionError(str(e.reason)) from None
+
+    def create(self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs):
+        payload = dict(kwargs, model=model, messages=messages, max_tokens=max_tokens, temperature=temperature)
+        response = self._post(payload)
+        if payload.get("stream"):
+            return self._stream(response)
+        with response:
+            return _namespace(json.load(response))
+
+    def _stream(self, response) -> Iterator:
+        """Frammenti dello stream server-sent events, fino a [DONE]"""
+        with response:
+            for line in response:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    return
+                yield _namespace(json.loads(data))
+
+    async def acreate(self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs):
+        import asyncio
+
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.create(model, messages, max_tokens, temperature, **kwargs)
+        )
+
+    def chunk_text(self, chunk) -> Optional[str]:
+        if not chunk.choices:
+            return None
+        return getattr(chunk.choices[0].delta, "content", None)
+
+
+STUB_RESPONSE = json.dumps({
+    "email_subjects": ["Le novità della settimana", "Scopri cosa c'è di nuovo", "Solo per te"],
+    "email_previews": [
+        "Abbiamo preparato qualcosa di speciale per te",
+        "Tutte le novità in un'unica email",
+        "Non perdere gli aggiornamenti di questa settimana",
+    ],
+    "newsletter_content": (
+        "# Le novità della settimana\n\n"
+        "Contenuto di prova generato senza chiamare alcun modello.\n\n"
+        "**[SCOPRI DI PIÙ]**\n\n---\n\nGrazie per averci letto.\n\n**[VISITA IL SITO]**"
+    ),
+}, ensure_ascii=False)
+
+
+class StubProvider(ChatProvider):
+    """Backend locale senza rete né SDK: risposte fisse, per sviluppo, demo e benchmark"""
+
+    name = "stub"
+    stream_usage = True
+
+    def __init__(self, content: str = STUB_RESPONSE, latency: float = 0.0, chunk_size: int = 20):
+        self.content = content
+        self.latency = latency
+        self.chunk_size = chunk_size
+
+    def _content_for(self, kwargs: Dict) -> str:
+        response_format = kwargs.get("response_format") or {}
+        if response_format.get("json_schema", {}).get("name") == "newsletter_repairs":
+            return json.dumps({"items": []})
+        return self.content
+
+    def _response(self, content: str, messages: List[Dict], n: int = 1):
+        prompt_tokens = sum(len(m.get("content") or "") for m in messages) // 4
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens, completion_tokens=len(content) // 4, prompt_tokens_details=None
+        )
+        choices = [
+            SimpleNamespace(index=i, message=SimpleNamespace(role="assistant", content=content), finish_reason="stop")
+            for i in range(n)
+        ]
+        return SimpleNamespace(choices=choices, usage=usage)
+
+    def _stream(self, content: str, messages: List[Dict]) -> Iterator:
+        for i in range(0, len(content), self.chunk_size):
+            delta = SimpleNamespace(content=content[i:i + self.chunk_size])
+            yield SimpleNamespace(choices=[SimpleNamespace(index=0, delta=delta)], usage=None)
+        yield SimpleNamespace(choices=[], usage=self._response(content, messages).usage)
+
+    def create(self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        content = self._content_for(kwargs)
+        if kwargs.get("stream"):
+            return self._stream(content, messages)
+        return self._response(content, messages, kwargs.get("n", 1))
+
+    async def acreate(self, model: str, messages: List[Dict], max_tokens: int, temperature: float, **kwargs):
+        if self.latency:
+            import asyncio
+            await asyncio.sleep(self.latency)
+        return self._response(self._content_for(kwargs), messages, kwargs.get("n", 1))
+
+
+def load_provider(backend: str = DEFAULT_BACKEND, api_key: str = "", client=None) -> ChatProvider:
+    """Crea il backend richiesto, importando l'SDK corrispondente solo ora
+
+    Con "auto" usa l'SDK OpenAI nuovo se disponibile, altrimenti quello legacy.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend sconosciuto: {backend} (disponibili: {', '.join(BACKENDS)})")
+    if backend == "stub":
+        return StubProvider()
+    if backend == "http":
+        return HTTPProvider(api_key)
+    if backend in ("auto", "openai"):
+        try:
+            return OpenAIProvider(api_key, client)
+        except ImportError:
+            if backend == "openai":
+                raise ProviderUnavailable("SDK OpenAI >= 1.0 non installato: esegui pip install -r requirements.txt")
+    try:
+        return LegacyOpenAIProvider(api_key)
+    except ImportError:
+        raise ProviderUnavailable("SDK OpenAI non installato: esegui pip install -r requirements.txt")
@@ -0,0 +1,389 @@
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+
+SUBJECTS_KEY = "email_subjects"
+PREVIEWS_KEY = "email_previews"
+CONTENT_KEY = "newsletter_content"
+RESPONSE_KEYS = (SUBJECTS_KEY, PREVIEWS_KEY, CONTENT_KEY)
+
+# Dentro una stringa JSON gli unici caratteri da esaminare sono le virgolette e il backslash
+_STRING_SPECIAL = re.compile(r'["\\]')
+# Fuori dalle stringhe si salta direttamente al prossimo carattere strutturale
+_STRUCTURAL = re.compile(r'["{}\[\]:,]')
+_SIMPLE_ESCAPES = {
+    '"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'
+}
+_LIST_PREFIX = re.compile(r'^(?:\d+[.)]|[-*•])\s*')
+
+MAX_SUBJECT_LENGTH = 40
+MAX_PREVIEW_LENGTH = 100
+
+
+def _string_list_schema(max_length: int, description: str) -> Dict:
+    # Il limite di caratteri è espresso con pattern, supportato dalla modalità strict
+    return {
+        "type": "array",
+        "description": description,
+        "minItems": 3,
+        "maxItems": 3,
+        "items": {"type": "string", "pattern": f"^[^\\n]{{1,{max_length}}}$"},
+    }
+
+
+SUBJECTS_SCHEMA = {
+    "name": "email_headlines",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            SUBJECTS_KEY: _string_list_schema(MAX_SUBJECT_LENGTH, "3 oggetti email, massimo 40 caratteri"),
+            PREVIEWS_KEY: _string_list_schema(MAX_PREVIEW_LENGTH, "3 anteprime email, massimo 100 caratteri"),
+        },
+        "required": [SUBJECTS_KEY, PREVIEWS_KEY],
+        "additionalProperties": False,
+    },
+}
+
+RESPONSE_SCHEMA = {
+    "name": "newsletter",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": dict(
+            SUBJECTS_SCHEMA["schema"]["properties"],
+            **{CONTENT_KEY: {"type": "string", "description": "Contenuto completo della newsletter in markdown"}}
+        ),
+        "required": list(RESPONSE_KEYS),
+        "additionalProperties": False,
+    },
+}
+
+# Modelli con output strutturato (JSON schema) e con la sola modalità JSON
+_JSON_SCHEMA_MODELS = ("gpt-4o", "gpt-4.1", "gpt-5", "o1", "o3", "o4")
+_JSON_OBJECT_MODELS = ("gpt-4-turbo", "gpt-4-1106", "gpt-4-0125", "gpt-3.5-turbo")
+_LEGACY_SNAPSHOTS = ("-0301", "-0314", "-0613")
+
+
+def response_format_for(model: str, schema: Dict) -> Optional[Dict]:
+    """response_format da usare per il modello, oppure None se il modello non supporta output JSON"""
+    if model.endswith(_LEGACY_SNAPSHOTS):
+        return None
+    if model.startswith(_JSON_SCHEMA_MODELS):
+        return {"type": "json_schema", "json_schema": schema}
+    if model.startswith(_JSON_OBJECT_MODELS):
+        return {"type": "json_object"}
+    return None
+
+
+def decode_structured(content: str, keys=RESPONSE_KEYS) -> Optional[Dict]:
+    """Decodifica e valida una risposta in output strutturato; None se non rispetta lo schema"""
+    try:
+        result = json.loads(content)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(result, dict):
+        return None
+    for key in keys:
+        value = result.get(key)
+        if key == CONTENT_KEY:
+            if not isinstance(value, str) or not value.strip():
+                return None
+        elif not isinstance(value, list) or not value or not all(isinstance(v, str) for v in value):
+            return None
+    return {key: result[key] for key in keys}
+
+
+class IncrementalResponseParser:
+    """Parser JSON incrementale a passaggio singolo per le risposte del modello
+
+    Riceve il testo a frammenti tramite feed() e restituisce gli eventi man mano che
+    sono disponibili: ('subject', testo) e ('preview', testo) quando la stringa
+    corrispondente si chiude, ('content', frammento) per il contenuto della newsletter.
+    Ignora il testo prima della prima '{' (ad esempio i blocchi ```json) e tutto ciò che
+    segue la chiusura dell'oggetto; finish() recupera quanto possibile da un JSON troncato.
+    """
+
+    def __init__(self):
+        self.subjects: List[str] = []
+        self.previews: List[str] = []
+        self.seen_keys = set()
+        self.started = False
+        self.complete = False
+        self._content_parts: List[str] = []
+        self._stack: List[str] = []
+        self._expecting_key = False
+        self._current_key: Optional[str] = None
+        self._in_string = False
+        self._role: Optional[str] = None
+        self._raw: List[str] = []
+        self._pending = ""
+        self._high_surrogate: Optional[str] = None
+
+    @property
+    def content(self) -> str:
+        return "".join(self._content_parts)
+
+    def feed(self, chunk: str) -> List[Tuple[str, str]]:
+        """Elabora un frammento di testo e restituisce gli eventi prodotti"""
+        events: List[Tuple[str, str]] = []
+        if self.complete or not chunk:
+            return events
+
+        text = self._pending + chunk
+        self._pending = ""
+        i = 0
+        n = len(text)
+
+        if not self.started:
+            i = text.find("{")
+            if i < 0:
+                return events
+
+        content_delta: List[str] = []
+        while i < n:
+            if self._in_string:
+                match = _STRING_SPECIAL.search(text, i)
+                end = match.start() if match else n
+                if end > i:
+                    self._append_string(text[i:end], content_delta)
+                if match is None:
+                    break
+                if text[end] == '"':
+                    i = end + 1
+                    self._close_string(events)
+                    continue
+                # Sequenza di escape: se incompleta si attende il frammento successivo
+                escape, consumed = self._read_escape(text, end)
+                if consumed == 0:
+                    self._pending = text[end:]
+                    break
+                self._append_escape(escape, text[end:end + consumed], content_delta)
+                i = end + consumed
+                continue
+
+            match = _STRUCTURAL.search(text, i)
+            if match is None:
+                break
+            char = match.group()
+            i = match.end()
+            if char == '"':
+                self._open_string()
+            elif char == "{":
+                self.started = True
+                self._stack.append("{")
+                self._expecting_key = len(self._stack) == 1
+            elif char == "[":
+                self._stack.append("[")
+            elif char in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if not self._stack:
+                    self.complete = True
+                    break
+            elif char == ":" and len(self._stack) == 1:
+                self._expecting_key = False
+            elif char == "," and len(self._stack) == 1:
+                self._expecting_key = True
+
+        if content_delta:
+            delta = "".join(content_delta)
+            self._content_parts.append(delta)
+            events.append(("content", delta))
+        return events
+
+    def finish(self) -> Optional[Dict]:
+        """Chiude il parsing e restituisce i campi estratti, oppure None se non c'era JSON"""
+        if not self.started:
+            return None
+        if self._in_string and self._role == "content" and self._high_surrogate:
+            self._content_parts.append(self._high_surrogate)
+            self._high_surrogate = None
+        return {
+            SUBJECTS_KEY: list(self.subjects),
+            PREVIEWS_KEY: list(self.previews),
+            CONTENT_KEY: self.content,
+        }
+
+    def _open_string(self) -> None:
+        depth = len(self._stack)
+        if depth == 1 and self._expecting_key:
+            role = "key"
+        elif depth == 1 and self._current_key == CONTENT_KEY:
+            role = "content"
+        elif depth == 2 and self._stack[1] == "[" and self._current_key in (SUBJECTS_KEY, PREVIEWS_KEY):
+            role = "item"
+        else:
+            role = "other"
+        if role == "content":
+            self.seen_keys.add(CONTENT_KEY)
+        self._in_string = True
+        self._role = role
+        self._raw = []
+
+    def _close_string(self, events: List[Tuple[str, str]]) -> None:
+        self._in_string = False
+        role = self._role
+        self._role = None
+        if role == "content":
+            if self._high_surrogate:
+                self._content_parts.append(self._high_surrogate)
+                self._high_surrogate = None
+            return
+
+        raw = "".join(self._raw)
+        self._raw = []
+        if role == "key":
+            self._current_key = _decode_json_string(raw)
+            if self._current_key in RESPONSE_KEYS:
+                self.seen_keys.add(self._current_key)
+        elif role == "item":
+            value = _decode_json_string(raw).strip()
+            if self._current_key == SUBJECTS_KEY:
+                self.subjects.append(value)
+                events.append(("subject", value))
+            else:
+                self.previews.append(value)
+                events.append(("preview", value))
+
+    def _append_string(self, piece: str, content_delta: List[str]) -> None:
+        if self._role == "content":
+            if self._high_surrogate:
+                content_delta.append(self._high_surrogate)
+                self._high_surrogate = None
+            content_delta.append(piece)
+        elif self._role != "other":
+            self._raw.append(piece)
+
+    def _append_escape(self, escape: str, raw: str, content_delta: List[str]) -> None:
+        if self._role != "content":
+            if self._role != "other":
+                self._raw.append(raw)
+            return
+
+        # Le emoji fuori dal BMP arrivano come due escape \u separati (coppia surrogata)
+        if "\ud800" <= escape <= "\udbff":
+            if self._high_surrogate:
+                content_delta.append(self._high_surrogate)
+            self._high_surrogate = escape
+            return
+        if self._high_surrogate and "\udc00" <= escape <= "\udfff":
+            pair = self._high_surrogate + escape
+            escape = pair.encode("utf-16", "surrogatepass").decode("utf-16")
+        elif self._high_surrogate:
+            content_delta.append(self._high_surrogate)
+        self._high_surrogate = None
+        content_delta.append(escape)
+
+    @staticmethod
+    def _read_escape(text: str, start: int) -> Tuple[str, int]:
+        """Decodifica l'escape che inizia in text[start] ('\\'); consumed=0 se incompleto"""
+        if start + 1 >= len(text):
+            return "", 0
+        kind = text[start + 1]
+        if kind == "u":
+            digits = text[start + 2:start + 6]
+            if len(digits) < 4:
+                return "", 0
+            try:
+                return chr(int(digits, 16)), 6
+            except ValueError:
+                return digits, 6
+        return _SIMPLE_ESCAPES.get(kind, kind), 2
+
+
+def _decode_json_string(raw: str) -> str:
+    """Decodifica il contenuto grezzo di una stringa JSON"""
+    if "\\" not in raw:
+        return raw
+    try:
+        return json.loads('"' + raw + '"')
+    except ValueError:
+        return raw
+
+
+def parse_text_response(content: str, company: str) -> Dict:
+    """Estrae oggetti, anteprime e contenuto da una risposta non JSON (modelli legacy)"""
+    subjects = []
+    previews = []
+    content_lines = []
+    current_section = None
+
+    for line in content.strip().split('\n'):
+        line = line.strip()
+        lower = line.lower()
+
+        if "oggett" in lower or "subject" in lower:
+            current_section = "subjects"
+        elif "anteprima" in lower or "preview" in lower:
+            current_section = "previews"
+        elif "contenuto" in lower or "newsletter" in lower or "content" in lower:
+            current_section = "content"
+        elif line and current_section:
+            if current_section == "content":
+                content_lines.append(line)
+            elif current_section == "subjects" and len(subjects) < 3:
+                clean_line = _clean_list_line(line)
+                if clean_line and len(clean_line) <= 40:
+                    subjects.append(clean_line)
+            elif current_section == "previews" and len(previews) < 3:
+                clean_line = _clean_list_line(line)
+                if clean_line and len(clean_line) <= 100:
+                    previews.append(clean_line)
+
+    return _complete_result(subjects, previews, '\n'.join(content_lines) if content_lines else content, company)
+
+
+def _clean_list_line(line: str) -> str:
+    """Rimuove numerazione, puntati e virgolette da una riga di elenco"""
+    return _LIST_PREFIX.sub("", line).replace('"', '').replace("'", "").strip()
+
+
+def _complete_result(subjects: List[str], previews: List[str], newsletter_content: str, company: str) -> Dict:
+    """Completa oggetti e anteprime mancanti con valori di default"""
+    subjects = [s for s in subjects if s][:3]
+    previews = [p for p in previews if p][:3]
+    while len(subjects) < 3:
+        subjects.append(f"Newsletter {company}"[:40])
+    while len(previews) < 3:
+        previews.append(f"Scopri le novità di {company}"[:100])
+    return {
+        SUBJECTS_KEY: subjects,
+        PREVIEWS_KEY: previews,
+        CONTENT_KEY: newsletter_content,
+    }
+
+
+def parse_response(content: str, company: str = "Azienda",
+                   parser: Optional[IncrementalResponseParser] = None) -> Dict:
+    """Parsing della risposta del modello
+
+    Se viene passato un parser già alimentato durante lo streaming, il testo non viene
+    riletto. Il parsing euristico riga per riga viene usato solo se la risposta non
+    contiene JSON.
+    """
+    if parser is None:
+        # Percorso veloce: l'oggetto JSON è valido (anche dentro un blocco ``` o del testo)
+        start = content.find("{")
+        end = content.rfind("}")
+        if 0 <= start < end:
+            try:
+                result = json.loads(content[start:end + 1])
+            except ValueError:
+                result = None
+            if isinstance(result, dict) and all(key in result for key in RESPONSE_KEYS):
+                return result
+
+        parser = IncrementalResponseParser()
+        parser.feed(content)
+    result = parser.finish()
+
+    if result is not None and (result[SUBJECTS_KEY] or result[PREVIEWS_KEY] or result[CONTENT_KEY]):
+        if parser.complete and parser.seen_keys.issuperset(RESPONSE_KEYS):
+            return result
+        # JSON troncato o incompleto: si tiene quanto estratto e si completano i campi mancanti
+        return _complete_result(
+            result[SUBJECTS_KEY], result[PREVIEWS_KEY], result[CONTENT_KEY] or content, company
+        )
+
+    return parse_text_response(content, company)
@@ -0,0 +1,223 @@
+import logging
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Stati HTTP per cui ha senso riprovare dopo un'attesa
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+# Eccezioni di rete/timeout dell'SDK nuovo e legacy, riconosciute per nome per non importare openai
+RETRYABLE_ERRORS = {
+    "APIConnectionError", "APITimeoutError", "InternalServerError", "RateLimitError",
+    "ServiceUnavailableError", "Timeout", "TimeoutError", "TryAgain", "ConnectionError",
+}
+
+
+def error_status(error: Exception) -> Optional[int]:
+    """Stato HTTP associato a un errore dell'SDK OpenAI (nuovo o legacy), se presente"""
+    for candidate in (
+        getattr(error, "status_code", None),
+        getattr(error, "http_status", None),
+        getattr(getattr(error, "response", None), "status_code", None),
+    ):
+        if isinstance(candidate, int):
+            return candidate
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """Distingue gli errori temporanei (da riprovare) da quelli definitivi"""
+    # Credito esaurito: non passa aspettando
+    if "insufficient_quota" in str(getattr(error, "code", "") or "") or "insufficient_quota" in str(error):
+        return False
+    status = error_status(error)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Secondi di attesa indicati dal provider (Retry-After / retry-after-ms), se presenti"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "headers", None)
+    if not headers:
+        return None
+    try:
+        value = headers.get("retry-after-ms")
+        if value is not None:
+            return max(0.0, float(value) / 1000)
+        value = headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            import email.utils
+            parsed = email.utils.parsedate_to_datetime(value)
+            return max(0.0, parsed.timestamp() - time.time())
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+class TokenBucket:
+    """Token bucket con ricarica continua; il saldo può andare in negativo (debito)"""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Prenota amount token e restituisce quanti secondi attendere prima di usarli"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        # Una richiesta più grande della capacità non deve bloccare per sempre
+        self.tokens -= min(amount, self.capacity)
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def pause(self, seconds: float, now: float) -> None:
+        """Svuota il bucket: la prossima prenotazione dovrà attendere almeno seconds secondi"""
+        self.reserve(0, now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+
+class RequestScheduler:
+    """Esegue le chiamate al provider rispettando i limiti di richieste e token al minuto
+
+    Gli errori temporanei (429, 5xx, timeout) vengono riprovati con backoff
+    esponenziale con jitter, rispettando Retry-After quando presente; gli errori
+    definitivi (chiave non valida, richiesta errata, credito esaurito) vengono
+    propagati subito. Un 429 rallenta tutte le richieste in coda, non solo quella
+    che lo ha ricevuto.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 40000,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+        max_delay: float = 60.0,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._retries = 0
+        self._throttled_seconds = 0.0
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        with self._lock:
+            now = time.monotonic()
+            wait = max(
+                self._requests.reserve(1, now),
+                self._tokens.reserve(estimated_tokens, now),
+            )
+            self._throttled_seconds += wait
+            return wait
+
+    def _backoff(self, error: Exception, attempt: int) -> float:
+        delay = retry_after(error)
+        if delay is None:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        else:
+            delay = min(self.max_delay, delay) + random.uniform(0, self.base_delay / 4)
+        if error_status(error) == 429:
+            # L'attesa viene applicata al bucket, così rallentano anche le altre richieste in coda
+            with self._lock:
+                self._requests.pause(delay, time.monotonic())
+            return 0.0
+        return delay
+
+    def _on_error(self, error: Exception, attempt: int) -> Optional[float]:
+        """Restituisce l'attesa prima del prossimo tentativo, oppure None se bisogna arrendersi"""
+        with self._lock:
+            self._in_flight -= 1
+            if not is_retryable(error) or attempt >= self.max_retries:
+                self._failed += 1
+                return None
+            self._retries += 1
+            self._waiting += 1
+        logger.warning(
+            "Errore temporaneo (%s), nuovo tentativo %d/%d", type(error).__name__, attempt + 1, self.max_retries
+        )
+        return self._backoff(error, attempt)
+
+    def run(self, func: Callable[[], T], estimated_tokens: int = 0) -> T:
+        """Esegue func rispettando i limiti e riprovando gli errori temporanei"""
+        with self._lock:
+            self._waiting += 1
+        attempt = 0
+        while True:
+            wait = self._reserve(estimated_tokens)
+            if wait > 0:
+                time.sleep(wait)
+            with self._lock:
+                self._waiting -= 1
+                self._in_flight += 1
+            try:
+                result = func()
+            except Exception as e:
+                delay = self._on_error(e, attempt)
+                if delay is None:
+                    raise
+                if delay > 0:
+                    time.sleep(delay)
+                attempt += 1
+                continue
+            with self._lock:
+                self._in_flight -= 1
+                self._completed += 1
+            return result
+
+    async def arun(self, func: Callable[[], Awaitable[T]], estimated_tokens: int = 0) -> T:
+        """Versione asincrona di run"""
+        # asyncio è importato solo da chi usa l'API asincrona: pesa sull'avvio dei processi
+        import asyncio
+
+        with self._lock:
+            self._waiting += 1
+        attempt = 0
+        while True:
+            wait = self._reserve(estimated_tokens)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            with self._lock:
+                self._waiting -= 1
+                self._in_flight += 1
+            try:
+                result = await func()
+            except Exception as e:
+                delay = self._on_error(e, attempt)
+                if delay is None:
+                    raise
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            with self._lock:
+                self._in_flight -= 1
+                self._completed += 1
+            return result
+
+    def metrics(self) -> Dict:
+        """Profondità della coda e contatori delle richieste"""
+        with self._lock:
+            return {
+                "queue_depth": self._waiting,
+                "in_flight": self._in_flight,
+                "completed": self._completed,
+                "failed": self._failed,
+                "retries": self._retries,
+                "throttled_seconds": round(self._throttled_seconds, 3),
+            }
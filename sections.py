@@ -0,0 +1,158 @@
+import re
+from typing import Dict, List, Optional
+
+from constraints import fold
+
+_HEADING = re.compile(r'^(#{1,6})\s+(.*?)\s*#*\s*$')
+_RULE = re.compile(r'^\s*(?:-{3,}|\*{3,}|_{3,})\s*$')
+# Riga con solo un pulsante: **[TESTO]**, **[TESTO](link)** o [**TESTO**](link)
+_CTA = re.compile(r'^\s*(?:\*\*\[[^\]]+\](?:\([^)]*\))?\*\*|\[\*\*[^\]]+\*\*\]\([^)]*\))\s*$')
+_WORD = re.compile(r'\w+')
+
+SECTION_LABELS = {
+    "title": "Titolo",
+    "intro": "Introduzione",
+    "cta": "Call to action",
+    "product": "Prodotto",
+    "section": "Sezione",
+    "closing": "Chiusura",
+}
+
+
+def split_sections(content: str, products: Optional[List[Dict]] = None) -> List[Dict]:
+    """Divide il markdown della newsletter in sezioni indirizzabili
+
+    Ogni sezione è un dizionario con 'id' (title, intro, cta, product-N, section-N, closing),
+    'kind', 'heading' e 'text'. I testi concatenati riproducono esattamente il contenuto.
+    Le sezioni prodotto sono riconosciute dal titolo, confrontato con i nomi in products
+    (N è la posizione del prodotto, da 1).
+    """
+    product_names = [_words((p or {}).get("name", "")) for p in (products or [])]
+    used_products = set()
+    sections: List[Dict] = []
+    pending = ""
+
+    def start(kind: str, heading: str = "", product: Optional[int] = None) -> None:
+        nonlocal pending
+        sections.append({"kind": kind, "heading": heading, "product": product, "has_cta": False, "text": pending})
+        pending = ""
+
+    for line in (content or "").splitlines(keepends=True):
+        stripped = line.strip()
+        current = sections[-1]["kind"] if sections else None
+        heading = _HEADING.match(stripped)
+
+        if not stripped:
+            if sections:
+                sections[-1]["text"] += line
+            else:
+                pending += line
+            continue
+
+        if heading:
+            level, title = len(heading.group(1)), heading.group(2)
+            if current is None and level == 1:
+                start("title", title)
+            else:
+                product = _match_product(title, product_names, used_products)
+                if product is not None:
+                    used_products.add(product)
+                    start("product", title, product)
+                else:
+                    start("section", title)
+        elif _RULE.match(stripped):
+            start("closing")
+        elif _CTA.match(stripped) and current in (None, "title", "intro") \
+                and not any(s["kind"] == "cta" for s in sections):
+            start("cta")
+        elif current in (None, "title"):
+            start("intro")
+        elif current == "product" and sections[-1]["has_cta"] and not _CTA.match(stripped):
+            # Testo dopo il pulsante del prodotto: non fa più parte della scheda prodotto
+            start("section")
+        if _CTA.match(stripped):
+            sections[-1]["has_cta"] = True
+        sections[-1]["text"] += line
+
+    if pending and sections:
+        sections[-1]["text"] += pending
+
+    # Una sola chiusura (dopo l'ultimo separatore); senza separatore la chiude l'ultima sezione generica
+    closings = [s for s in sections if s["kind"] == "closing"]
+    for section in closings[:-1]:
+        section["kind"] = "section"
+    if not closings and sections and sections[-1]["kind"] == "section":
+        sections[-1]["kind"] = "closing"
+
+    counter = 0
+    for section in sections:
+        if section["kind"] == "product":
+            section["id"] = f"product-{section['product'] + 1}"
+        elif section["kind"] == "section":
+            counter += 1
+            section["id"] = f"section-{counter}"
+        else:
+            section["id"] = section["kind"]
+        del section["product"], section["has_cta"]
+    return sections
+
+
+def _words(text: str) -> List[str]:
+    """Parole del testo senza accenti né maiuscole, senza punteggiatura ed emoji"""
+    return _WORD.findall(fold(text))
+
+
+def _contains(words: List[str], part: List[str]) -> bool:
+    """True se part compare in words come sequenza di parole intere"""
+    size = len(part)
+    return any(words[i:i + size] == part for i in range(len(words) - size + 1))
+
+
+def _match_product(title: str, product_names: List[List[str]], used: set) -> Optional[int]:
+    """Indice del prodotto citato nel titolo della sezione, se non già assegnato
+
+    Prima il titolo uguale al nome, poi il nome contenuto nel titolo (o il titolo nel
+    nome) a parole intere, preferendo il nome più lungo: "Pro" non prende il titolo
+    "Zaino Pro Max" se esiste il prodotto "Zaino Pro Max".
+    """
+    words = _words(title)
+    if not words:
+        return None
+    candidates = [(index, name) for index, name in enumerate(product_names) if name and index not in used]
+    for index, name in candidates:
+        if name == words:
+            return index
+    best, best_size = None, 0
+    for index, name in candidates:
+        if len(name) > best_size and (_contains(words, name) or _contains(name, words)):
+            best, best_size = index, len(name)
+    return best
+
+
+def join_sections(sections: List[Dict]) -> str:
+    return "".join(section["text"] for section in sections)
+
+
+def find_section(sections: List[Dict], section_id: str) -> Optional[Dict]:
+    return next((s for s in sections if s["id"] == section_id), None)
+
+
+def section_label(section: Dict) -> str:
+    """Etichetta leggibile della sezione, per l'interfaccia"""
+    label = SECTION_LABELS.get(section["kind"], section["kind"])
+    return f"{label}: {section['heading']}" if section["heading"] else label
+
+
+def replace_section(content: str, section_id: str, new_text: str,
+                    products: Optional[List[Dict]] = None) -> str:
+    """Sostituisce il testo di una sezione, mantenendo la spaziatura con quelle successive"""
+    sections = split_sections(content, products)
+    section = find_section(sections, section_id)
+    if section is None:
+        raise KeyError(section_id)
+    old = section["text"]
+    trailing = old[len(old.rstrip()):]
+    section["text"] = new_text.strip() + (trailing or "\n\n")
+    if section is sections[-1]:
+        section["text"] = section["text"].rstrip() + trailing
+    return join_sections(sections)
@@ -0,0 +1,93 @@
+import hashlib
+import re
+import unicodedata
+from typing import Iterable, List, Optional, Sequence, Set
+
+_MAX_HASH = (1 << 32) - 1
+_NON_WORD = re.compile(r"[^\w\s]+")
+
+
+def normalize_text(text: str) -> str:
+    """Minuscole, senza accenti, punteggiatura e spazi ripetuti"""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+
+def shingles(text: str, k: int = 3) -> Set[str]:
+    """Insieme dei k-shingle di caratteri del testo normalizzato"""
+    text = normalize_text(text)
+    if len(text) <= k:
+        return {text} if text else set()
+    return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+
+def word_shingles(text: str, k: int = 2) -> Set[str]:
+    """Insieme dei k-shingle di parole del testo normalizzato (meno numerosi per testi lunghi)"""
+    words = normalize_text(text).split()
+    if len(words) <= k:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + k]) for i in range(len(words) - k + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+def _hash64(item: str) -> int:
+    return int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class MinHasher:
+    """Firme MinHash deterministiche (stabili tra processi, quindi salvabili su disco)
+
+    Ogni shingle viene hashato una sola volta a 64 bit; le permutazioni sono XOR con
+    maschere casuali, molto più economiche di una funzione di hash per permutazione.
+    """
+
+    def __init__(self, num_perm: int = 64, seed: int = 1):
+        self.num_perm = num_perm
+        # Generatore lineare congruenziale: maschere riproducibili senza dipendere da random
+        state = seed
+        self._masks = []
+        for _ in range(num_perm):
+            state = (state * 6364136223846793005 + 1442695040888963407) % (1 << 64)
+            self._masks.append(state)
+
+    def signature(self, items: Iterable[str]) -> List[int]:
+        hashes = [_hash64(item) for item in items]
+        if not hashes:
+            return [_MAX_HASH] * self.num_perm
+        return [min(map(mask.__xor__, hashes)) & _MAX_HASH for mask in self._masks]
+
+    def text_signature(self, text: str, k: int = 3) -> List[int]:
+        return self.signature(shingles(text, k))
+
+
+def estimate_similarity(sig_a: Sequence[int], sig_b: Sequence[int]) -> float:
+    """Stima della similarità di Jaccard dalle firme MinHash"""
+    if not sig_a:
+        return 0.0
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+def prune_near_duplicates(texts: Iterable[str], threshold: float = 0.6,
+                          hasher: Optional[MinHasher] = None) -> List[str]:
+    """Mantiene i testi nell'ordine dato, scartando quelli troppo simili a uno già tenuto"""
+    hasher = hasher or MinHasher(num_perm=32)
+    kept: List[str] = []
+    signatures: List[List[int]] = []
+    seen = set()
+    for text in texts:
+        key = normalize_text(text)
+        if not key or key in seen:
+            continue
+        sig = hasher.text_signature(text)
+        if any(estimate_similarity(sig, other) >= threshold for other in signatures):
+            continue
+        seen.add(key)
+        kept.append(text)
+        signatures.append(sig)
+    return kept
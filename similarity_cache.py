@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from cache import DEFAULT_CACHE_DIR
+from similarity import MinHasher, estimate_similarity, normalize_text, word_shingles
+
+DEFAULT_SIMILARITY_PATH = os.path.join(DEFAULT_CACHE_DIR, "similar.sqlite")
+
+# Campi che devono coincidere (a meno di maiuscole, spazi e punteggiatura) perché una bozza sia riusabile.
+# Descrizione, USP e segmenti del brand stanno qui: nella firma una descrizione lunga coprirebbe
+# le differenze di obiettivo e brief, facendo sembrare simili due campagne diverse dello stesso brand
+SCOPE_FIELDS = (
+    "company_name", "website_url", "company_description", "usp_benefit", "market_segments",
+    "email_type", "target_audience", "tone_of_voice", "language",
+    "products", "discount_codes", "forbidden_words", "required_words",
+)
+# Campi della campagna confrontati per similarità
+TEXT_FIELDS = ("email_objective", "content_brief")
+
+
+def _as_text(value: Any) -> str:
+    if isinstance(value, dict):
+        return " ".join(_as_text(value[k]) for k in sorted(value))
+    if isinstance(value, (list, tuple)):
+        return " | ".join(_as_text(v) for v in value)
+    return str(value or "")
+
+
+def request_scope(data: Dict) -> str:
+    """Impronta dei campi che devono coincidere esattamente"""
+    raw = "\x1f".join(normalize_text(_as_text(data.get(field))) for field in SCOPE_FIELDS)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def request_text(data: Dict) -> str:
+    """Testo normalizzato dei campi liberi della richiesta"""
+    return " \n ".join(normalize_text(_as_text(data.get(field))) for field in TEXT_FIELDS)
+
+
+class SimilarityCache:
+    """Indice MinHash LSH delle richieste già generate, persistito su SQLite
+
+    Trova il risultato di una richiesta precedente quasi identica (stesso brand, prodotti
+    e vincoli; brief e obiettivo che differiscono per spazi, punteggiatura o poche parole).
+    L'indice a bande resta in memoria, quindi la ricerca non tocca il disco finché non
+    c'è un candidato sopra la soglia.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_SIMILARITY_PATH,
+        threshold: float = 0.85,
+        num_perm: int = 32,
+        bands: int = 8,
+        max_entries: int = 100_000,
+    ):
+        if num_perm % bands:
+            raise ValueError("num_perm deve essere un multiplo di bands")
+        self.path = path
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_entries = max_entries
+        self.hasher = MinHasher(num_perm=num_perm)
+        self.lookups = 0
+        self.hits = 0
+        self._lock = threading.Lock()
+        # Bucket LSH: chiave di banda -> id (o lista di id se più di uno)
+        self._buckets: Dict[int, Any] = {}
+        self._signatures: Dict[int, array] = {}
+        self._scopes: Dict[int, str] = {}
+        self._order: deque = deque()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS similar_requests (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                scope TEXT NOT NULL,
+                num_perm INTEGER NOT NULL,
+                signature BLOB NOT NULL,
+                result TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+        self._load()
+
+    def _load(self) -> None:
+        rows = self._conn.execute(
+            "SELECT id, scope, signature FROM similar_requests WHERE num_perm = ? ORDER BY id",
+            (self.hasher.num_perm,),
+        )
+        for entry_id, scope, blob in rows:
+            signature = array("I")
+            signature.frombytes(blob)
+            self._index(entry_id, scope, signature)
+
+    def _band_keys(self, scope: str, signature) -> List[int]:
+        rows = self.rows
+        return [
+            hash((scope, band, tuple(signature[band * rows:(band + 1) * rows])))
+            for band in range(self.bands)
+        ]
+
+    def _index(self, entry_id: int, scope: str, signature: array) -> None:
+        self._signatures[entry_id] = signature
+        self._scopes[entry_id] = scope
+        self._order.append(entry_id)
+        for key in self._band_keys(scope, signature):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                self._buckets[key] = entry_id
+            elif isinstance(bucket, list):
+                bucket.append(entry_id)
+            else:
+                self._buckets[key] = [bucket, entry_id]
+
+    def _unindex(self, entry_id: int) -> None:
+        signature = self._signatures.pop(entry_id)
+        scope = self._scopes.pop(entry_id)
+        for key in self._band_keys(scope, signature):
+            bucket = self._buckets.get(key)
+            if isinstance(bucket, list):
+                bucket.remove(entry_id)
+                if len(bucket) == 1:
+                    self._buckets[key] = bucket[0]
+            elif bucket == entry_id:
+                del self._buckets[key]
+
+    def _nearest(self, scope: str, signature: array):
+        """(id, similarità) del candidato più simile nello stesso ambito, oppure (None, 0)"""
+        candidates = set()
+        for key in self._band_keys(scope, signature):
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                continue
+            if isinstance(bucket, list):
+                candidates.update(bucket)
+            else:
+                candidates.add(bucket)
+
+        best_id, best = None, 0.0
+        for entry_id in candidates:
+            if self._scopes[entry_id] != scope:
+                continue
+            similarity = estimate_similarity(signature, self._signatures[entry_id])
+            if similarity > best:
+                best_id, best = entry_id, similarity
+        return best_id, best
+
+    def signature(self, data: Dict) -> array:
+        return array("I", self.hasher.signature(word_shingles(request_text(data))))
+
+    def lookup(self, data: Dict, threshold: Optional[float] = None) -> Optional[Dict]:
+        """Risultato della richiesta precedente più simile, con 'similarity' e 'result'"""
+        threshold = self.threshold if threshold is None else threshold
+        scope = request_scope(data)
+        signature = self.signature(data)
+        with self._lock:
+            self.lookups += 1
+            entry_id, similarity = self._nearest(scope, signature)
+            if entry_id is None or similarity < threshold:
+                return None
+            row = self._conn.execute(
+                "SELECT result, created_at FROM similar_requests WHERE id = ?", (entry_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            self.hits += 1
+        return {"id": entry_id, "similarity": similarity, "result": json.loads(row[0]), "created_at": row[1]}
+
+    def add(self, data: Dict, result: Dict) -> int:
+        """Registra il risultato; una richiesta praticamente identica viene sostituita"""
+        scope = request_scope(data)
+        signature = self.signature(data)
+        payload = json.dumps(result, ensure_ascii=False)
+        with self._lock:
+            entry_id, similarity = self._nearest(scope, signature)
+            if entry_id is not None and similarity >= 1.0:
+                self._conn.execute(
+                    "UPDATE similar_requests SET result = ?, created_at = ? WHERE id = ?",
+                    (payload, time.time(), entry_id),
+                )
+                self._conn.commit()
+                return entry_id
+
+            cursor = self._conn.execute(
+                "INSERT INTO similar_requests (scope, num_perm, signature, result, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (scope, self.hasher.num_perm, signature.tobytes(), payload, time.time()),
+            )
+            entry_id = cursor.lastrowid
+            self._index(entry_id, scope, signature)
+
+            # Oltre il limite si eliminano le voci più vecchie
+            evicted = []
+            while len(self._order) > self.max_entries:
+                old_id = self._order.popleft()
+                self._unindex(old_id)
+                evicted.append((old_id,))
+            if evicted:
+                self._conn.executemany("DELETE FROM similar_requests WHERE id = ?", evicted)
+            self._conn.commit()
+        return entry_id
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM similar_requests")
+            self._conn.commit()
+            self._buckets.clear()
+            self._signatures.clear()
+            self._scopes.clear()
+            self._order.clear()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._signatures),
+                "lookups": self.lookups,
+                "hits": self.hits,
+                "hit_rate": self.hits / self.lookups if self.lookups else 0.0,
+            }
@@ -0,0 +1,126 @@
+import copy
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, TypeVar
+
+T = TypeVar("T")
+
+
+class Flight:
+    """Richiesta in corso condivisa: frammenti pubblicati finora, risultato o errore finale"""
+
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.items: List[Any] = []
+        self.done = False
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self._cond = threading.Condition()
+
+    def publish(self, item: Any) -> None:
+        with self._cond:
+            self.items.append(item)
+            self._cond.notify_all()
+
+    def finish(self, result: Any = None, error: Optional[BaseException] = None) -> None:
+        with self._cond:
+            if self.done:
+                return
+            self.result = result
+            self.error = error
+            self.done = True
+            self._cond.notify_all()
+
+    def relay(self, items: Iterable[Any]) -> Iterator[Any]:
+        """Inoltra gli elementi al chiamante pubblicandoli anche per chi attende la stessa richiesta"""
+        for item in items:
+            self.publish(item)
+            yield item
+
+    def subscribe(self, timeout: Optional[float] = None) -> Iterator[Any]:
+        """Tutti gli elementi pubblicati, dal primo, man mano che arrivano e fino alla fine"""
+        index = 0
+        while True:
+            with self._cond:
+                if not self._cond.wait_for(lambda: index < len(self.items) or self.done, timeout):
+                    raise TimeoutError("Richiesta condivisa non completata in tempo")
+                pending = self.items[index:]
+                done = self.done
+            yield from pending
+            index += len(pending)
+            if done and index >= len(self.items):
+                return
+
+    def wait(self, timeout: Optional[float] = None) -> Any:
+        """Risultato della richiesta (l'errore del chiamante che la esegue viene rilanciato)"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self.done, timeout):
+                raise TimeoutError("Richiesta condivisa non completata in tempo")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class SingleFlight:
+    """Unisce le chiamate identiche contemporanee: una sola viene eseguita, le altre ne attendono l'esito
+
+    La chiave è l'impronta canonica della richiesta. Chi arriva mentre una chiamata
+    con la stessa chiave è in corso riceve una copia del suo risultato invece di
+    ripeterla; una chiamata ferma da più di max_age secondi non viene più condivisa.
+    """
+
+    def __init__(self, max_age: float = 600.0):
+        self.max_age = max_age
+        self.calls = 0
+        self.leaders = 0
+        self.collapsed = 0
+        self._flights: Dict[str, Flight] = {}
+        self._lock = threading.Lock()
+
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        """(volo, True) se il chiamante deve eseguire la richiesta, (volo, False) se deve attenderla"""
+        with self._lock:
+            self.calls += 1
+            flight = self._flights.get(key)
+            if flight is not None and not flight.done and time.monotonic() - flight.started_at < self.max_age:
+                self.collapsed += 1
+                return flight, False
+            flight = Flight()
+            self._flights[key] = flight
+            self.leaders += 1
+            return flight, True
+
+    def land(self, key: str, flight: Flight, result: Any = None, error: Optional[BaseException] = None) -> None:
+        """Pubblica l'esito della richiesta eseguita e la toglie da quelle condivisibili
+
+        Il volo conserva una copia privata del risultato: chi lo ha eseguito può modificare
+        il proprio mentre gli altri ne stanno ancora facendo la copia.
+        """
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(copy.deepcopy(result), error)
+
+    def do(self, key: str, func: Callable[[], T], timeout: Optional[float] = None) -> Tuple[T, bool]:
+        """Esegue func oppure attende la chiamata identica in corso; restituisce (risultato, condiviso)"""
+        flight, leader = self.join(key)
+        if not leader:
+            # Ognuno riceve la propria copia: i risultati vengono poi modificati dai chiamanti
+            return copy.deepcopy(flight.wait(timeout if timeout is not None else self.max_age)), True
+        try:
+            result = func()
+        except BaseException as e:
+            self.land(key, flight, error=e)
+            raise
+        self.land(key, flight, result)
+        return result, False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "leaders": self.leaders,
+                "collapsed": self.collapsed,
+                "collapse_rate": self.collapsed / self.calls if self.calls else 0.0,
+                "in_flight": len(self._flights),
+            }
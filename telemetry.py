@@ -0,0 +1,322 @@
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from itertools import count
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Prezzi indicativi in dollari per milione di token: (input, input dalla cache del prompt, output).
+# Si usa il prefisso più lungo che corrisponde al nome del modello.
+MODEL_PRICES: Dict[str, Tuple[float, float, float]] = {
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4-turbo": (10.00, 10.00, 30.00),
+    "gpt-4": (30.00, 30.00, 60.00),
+    "gpt-3.5-turbo": (0.50, 0.50, 1.50),
+}
+
+# Estremi superiori (in secondi) dei bucket degli istogrammi di durata
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+# Identificativi delle fasi: un contatore basta a distinguerle all'interno di una traccia
+_span_ids = count(1)
+
+
+def estimate_cost(model: str, counts: Optional[Dict[str, int]]) -> Optional[float]:
+    """Costo stimato in dollari di una chiamata, dai conteggi di usage.usage_counts"""
+    if not counts:
+        return None
+    prefix = max((p for p in MODEL_PRICES if model.startswith(p)), key=len, default=None)
+    if prefix is None:
+        return None
+    price_input, price_cached, price_output = MODEL_PRICES[prefix]
+    cached = counts.get("cached_tokens", 0)
+    return (
+        (counts.get("prompt_tokens", 0) - cached) * price_input
+        + cached * price_cached
+        + counts.get("completion_tokens", 0) * price_output
+    ) / 1_000_000
+
+
+class Span:
+    """Fase misurata di una generazione, con attributi (modello, token, costo, cache...)"""
+
+    def __init__(self, telemetry: "Telemetry", name: str, parent: Optional["Span"] = None, **attrs):
+        self.telemetry = telemetry
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else os.urandom(8).hex()
+        self.span_id = f"{next(_span_ids) & 0xFFFFFFFF:08x}"
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attrs: Dict[str, Any] = {k: v for k, v in attrs.items() if v is not None}
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self._token = None
+
+    def __enter__(self) -> "Span":
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        _current_span.reset(self._token)
+        self.end()
+
+    def set(self, **attrs) -> None:
+        self.attrs.update((k, v) for k, v in attrs.items() if v is not None)
+
+    def add_usage(self, model: str, counts: Optional[Dict[str, int]]) -> None:
+        """Token e costo stimato della chiamata, sommati a quelli già registrati sulla fase"""
+        if not counts:
+            return
+        self.attrs["model"] = model
+        for key in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+            self.attrs[key] = self.attrs.get(key, 0) + counts.get(key, 0)
+        cost = estimate_cost(model, counts)
+        if cost is not None:
+            self.attrs["cost_usd"] = self.attrs.get("cost_usd", 0.0) + cost
+
+    def end(self, duration: Optional[float] = None) -> None:
+        if self.duration is not None:
+            return
+        self.duration = duration if duration is not None else time.perf_counter() - self.started
+        self.telemetry.record(self)
+
+    def to_dict(self) -> Dict:
+        return {
+            "span": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "duration_ms": round(self.duration * 1e3, 3) if self.duration is not None else None,
+            **self.attrs,
+        }
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def annotate(**attrs) -> None:
+    """Aggiunge attributi alla fase in corso, se c'è"""
+    span = _current_span.get()
+    if span is not None:
+        span.set(**attrs)
+
+
+class _Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent: Deque[float] = deque(maxlen=500)
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect_left(DURATION_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+
+class Telemetry:
+    """Fasi misurate, token e costi delle generazioni, esposti come log JSON e metriche Prometheus
+
+    Ogni fase chiusa viene scritta nel log (logger "telemetry", livello INFO) e
+    aggregata in istogrammi di durata e contatori di token e costo per modello.
+    Le metriche si leggono con render_prometheus(), da un file aggiornato
+    periodicamente (metrics_path) o da un endpoint HTTP (serve_metrics).
+    """
+
+    def __init__(self, metrics_path: Optional[str] = None, metrics_interval: float = 10.0):
+        self.metrics_path = metrics_path
+        self.metrics_interval = metrics_interval
+        self._lock = threading.Lock()
+        self._histograms: Dict[str, _Histogram] = {}
+        self._tokens: Dict[Tuple[str, str], int] = {}
+        self._costs: Dict[str, float] = {}
+        self._events: Dict[Tuple[str, str], int] = {}
+        self._last_write = 0.0
+        self._server = None
+
+    def start_span(self, name: str, parent: Optional[Span] = None, **attrs) -> Span:
+        """Fase da chiudere con end(), figlia di parent (o di quella in corso) ma senza diventare quella in corso
+
+        Serve per le fasi che attraversano più iterazioni di uno stream.
+        """
+        return Span(self, name, parent if parent is not None else _current_span.get(), **attrs)
+
+    @contextmanager
+    def use(self, span: Span) -> Iterator[Span]:
+        """Rende span la fase in corso nel blocco, senza chiuderla all'uscita"""
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            _current_span.reset(token)
+
+    def span(self, name: str, **attrs) -> Span:
+        """Fase da usare con with: misura il blocco e le fasi aperte al suo interno ne diventano figlie"""
+        return Span(self, name, _current_span.get(), **attrs)
+
+    def record(self, span: Span) -> None:
+        attrs = span.attrs
+        with self._lock:
+            histogram = self._histograms.get(span.name)
+            if histogram is None:
+                histogram = self._histograms[span.name] = _Histogram()
+            histogram.observe(span.duration)
+            model = attrs.get("model")
+            if model and "prompt_tokens" in attrs:
+                for kind in ("prompt", "completion", "cached"):
+                    key = (model, kind)
+                    self._tokens[key] = self._tokens.get(key, 0) + attrs.get(f"{kind}_tokens", 0)
+                if "cost_usd" in attrs:
+                    self._costs[model] = self._costs.get(model, 0.0) + attrs["cost_usd"]
+            for flag in ("cache_hit", "fallback", "shared", "error"):
+                if flag in attrs:
+                    key = (span.name, f"{flag}={attrs[flag]}")
+                    self._events[key] = self._events.get(key, 0) + 1
+            write = self.metrics_path is not None and time.monotonic() - self._last_write >= self.metrics_interval
+            if write:
+                self._last_write = time.monotonic()
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("span %s", span.name, extra={"telemetry": span.to_dict()})
+        if write:
+            self.write_metrics()
+
+    def summary(self) -> Dict:
+        """Per fase: numero, media, p50 e p95 (ms) sulle misure recenti; totali di token e costo"""
+        with self._lock:
+            spans = {}
+            for name, histogram in self._histograms.items():
+                recent = sorted(histogram.recent)
+                spans[name] = {
+                    "count": histogram.count,
+                    "mean_ms": histogram.sum / histogram.count * 1e3,
+                    "p50_ms": recent[len(recent) // 2] * 1e3,
+                    "p95_ms": recent[min(len(recent) - 1, int(len(recent) * 0.95))] * 1e3,
+                }
+            tokens = dict(self._tokens)
+            costs = dict(self._costs)
+        return {
+            "spans": spans,
+            "tokens": {f"{model}:{kind}": count for (model, kind), count in tokens.items()},
+            "cost_usd": sum(costs.values()),
+        }
+
+    def render_prometheus(self) -> str:
+        """Metriche nel formato testuale di Prometheus"""
+        lines = [
+            "# HELP newsletter_span_duration_seconds Durata delle fasi di generazione",
+            "# TYPE newsletter_span_duration_seconds histogram",
+        ]
+        with self._lock:
+            for name, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS, histogram.buckets):
+                    cumulative += count
+                    lines.append(f'newsletter_span_duration_seconds_bucket{{span="{name}",le="{bound:g}"}} {cumulative}')
+                lines.append(f'newsletter_span_duration_seconds_bucket{{span="{name}",le="+Inf"}} {histogram.count}')
+                lines.append(f'newsletter_span_duration_seconds_sum{{span="{name}"}} {histogram.sum:.6f}')
+                lines.append(f'newsletter_span_duration_seconds_count{{span="{name}"}} {histogram.count}')
+            lines += [
+                "# HELP newsletter_tokens_total Token consumati per modello",
+                "# TYPE newsletter_tokens_total counter",
+            ]
+            lines += [
+                f'newsletter_tokens_total{{model="{model}",kind="{kind}"}} {count}'
+                for (model, kind), count in sorted(self._tokens.items())
+            ]
+            lines += [
+                "# HELP newsletter_cost_usd_total Costo stimato in dollari per modello",
+                "# TYPE newsletter_cost_usd_total counter",
+            ]
+            lines += [f'newsletter_cost_usd_total{{model="{model}"}} {cost:.6f}' for model, cost in sorted(self._costs.items())]
+            lines += [
+                "# HELP newsletter_span_events_total Fasi per esito (cache, fallback, unione, errore)",
+                "# TYPE newsletter_span_events_total counter",
+            ]
+            for (name, event), count in sorted(self._events.items()):
+                label, _, value = event.partition("=")
+                lines.append(f'newsletter_span_events_total{{span="{name}",{label}="{value}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path: Optional[str] = None) -> None:
+        """Scrive le metriche su file (sostituzione atomica, per il textfile collector di node_exporter)"""
+        path = path or self.metrics_path
+        if path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(self.render_prometheus())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Scrittura delle metriche non riuscita: %s", e)
+
+    def serve_metrics(self, port: int, host: str = "127.0.0.1"):
+        """Avvia in background un endpoint HTTP con le metriche su /metrics"""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        telemetry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.rstrip("/") != "/metrics":
+                    self.send_error(404)
+                    return
+                body = telemetry.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args) -> None:
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+        self._server = server
+        return server
+
+
+class JsonFormatter(logging.Formatter):
+    """Un oggetto JSON per riga: istante, livello, logger, messaggio e attributi della fase"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update(getattr(record, "telemetry", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def configure_logging(level: str = "INFO", json_logs: bool = True, stream=None) -> None:
+    """Configura il logging dell'applicazione (una sola volta), in JSON o testo semplice"""
+    root = logging.getLogger()
+    if any(getattr(handler, "_newsletter", False) for handler in root.handlers):
+        return
+    handler = logging.StreamHandler(stream)
+    handler._newsletter = True
+    handler.setFormatter(JsonFormatter() if json_logs else logging.Formatter("%(levelname)s %(name)s: %(message)s"))
+    root.addHandler(handler)
+    root.setLevel(level)
@@ -0,0 +1,61 @@
+import threading
+from typing import Any, Dict, Optional
+
+
+def _field(obj: Any, name: str) -> Any:
+    """Legge un campo sia da oggetti dell'SDK nuovo sia da dizionari dell'SDK legacy"""
+    if obj is None:
+        return None
+    if isinstance(obj, dict):
+        return obj.get(name)
+    return getattr(obj, name, None)
+
+
+def usage_counts(usage: Any) -> Optional[Dict[str, int]]:
+    """Estrae i conteggi di token dal campo usage di una risposta (None se assente)"""
+    if usage is None:
+        return None
+    details = _field(usage, "prompt_tokens_details")
+    return {
+        "prompt_tokens": _field(usage, "prompt_tokens") or 0,
+        "completion_tokens": _field(usage, "completion_tokens") or 0,
+        "cached_tokens": _field(details, "cached_tokens") or 0,
+    }
+
+
+class UsageTracker:
+    """Token consumati per modello, inclusi quelli serviti dalla cache del prefisso del provider"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models: Dict[str, Dict[str, int]] = {}
+
+    def record(self, model: str, usage: Any) -> Optional[Dict[str, int]]:
+        counts = usage_counts(usage)
+        if counts is None:
+            return None
+        with self._lock:
+            totals = self._models.setdefault(model, {
+                "requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                "cached_tokens": 0, "cache_hit_requests": 0,
+            })
+            totals["requests"] += 1
+            totals["prompt_tokens"] += counts["prompt_tokens"]
+            totals["completion_tokens"] += counts["completion_tokens"]
+            totals["cached_tokens"] += counts["cached_tokens"]
+            if counts["cached_tokens"]:
+                totals["cache_hit_requests"] += 1
+        return counts
+
+    def summary(self) -> Dict:
+        """Totali per modello e quota di token di prompt serviti dalla cache del prefisso"""
+        with self._lock:
+            models = {model: dict(totals) for model, totals in self._models.items()}
+        prompt = sum(t["prompt_tokens"] for t in models.values())
+        cached = sum(t["cached_tokens"] for t in models.values())
+        return {
+            "models": models,
+            "prompt_tokens": prompt,
+            "cached_tokens": cached,
+            "cached_ratio": cached / prompt if prompt else 0.0,
+        }
@@ -114,6 +114,62 @@ def parse_comma_separated(text: str) -> List[str]:
         return []
     return [item.strip() for item in text.split(',') if item.strip()]
 
+def build_newsletter_data(row: Dict) -> Dict:
+    """Costruisce il dizionario dati della newsletter a partire da una riga di input
+    
+    Accetta sia i valori grezzi del form / di un CSV (stringhe separate da virgola,
+    colonne market_segment_N, product_N e product_link_N) sia righe JSONL con liste già pronte.
+    """
+    def as_text(key: str, default: str = "") -> str:
+        value = row.get(key)
+        return str(value).strip() if value is not None else default
+    
+    def as_list(key: str) -> List[str]:
+        value = row.get(key)
+        if isinstance(value, list):
+            return [str(item).strip() for item in value if item and str(item).strip()]
+        return parse_comma_separated(value or "")
+    
+    # Segmenti di mercato: lista, stringa separata da virgole o colonne numerate
+    if row.get('market_segments'):
+        market_segments = as_list('market_segments')
+    else:
+        market_segments = [as_text(f'market_segment_{i}') for i in range(1, 4)]
+    
+    # Prodotti: lista di dizionari (JSONL) o colonne numerate (form/CSV)
+    products = []
+    if isinstance(row.get('products'), list):
+        for product in row['products']:
+            if isinstance(product, dict) and product.get('name'):
+                products.append({"name": str(product['name']).strip(), "link": str(product.get('link') or '').strip()})
+            elif isinstance(product, str) and product.strip():
+                products.append({"name": product.strip(), "link": ""})
+    else:
+        i = 1
+        while f'product_{i}' in row or f'product_link_{i}' in row:
+            name = as_text(f'product_{i}')
+            if name:
+                products.append({"name": name, "link": as_text(f'product_link_{i}')})
+            i += 1
+    
+    return {
+        "company_name": as_text('company_name'),
+        "website_url": as_text('website_url'),
+        "company_description": as_text('company_description'),
+        "email_type": as_text('email_type') or "Newsletter",
+        "email_objective": as_text('email_objective'),
+        "content_brief": as_text('content_brief'),
+        "target_audience": as_text('target_audience') or "B2B",
+        "market_segments": market_segments,
+        "tone_of_voice": as_text('tone_of_voice') or "Professionale",
+        "products": products,
+        "usp_benefit": as_text('usp_benefit'),
+        "language": as_text('language') or "Italiano",
+        "forbidden_words": as_list('forbidden_words'),
+        "required_words": as_list('required_words'),
+        "discount_codes": as_list('discount_codes')
+    }
+
 def validate_character_limits(subjects: List[str], previews: List[str]) -> Dict:
     """Valida i limiti di caratteri per oggetti e anteprime"""
     issues = {
@@ -172,7 +228,11 @@ Il team di {company}
     }
 
 def markdown_to_mailchimp_format(content: str) -> str:
-    """Converte markdown in formato più compatibile con builder email"""
+    """Converte markdown in formato più compatibile con builder email
+
+    Produce testo con etichette (TITOLO:, GRASSETTO:...); per l'HTML pronto da inviare
+    si usa email_renderer.
+    """
     
     # Sostituisce headers markdown
     content = re.sub(r'^# (.*)', r'TITOLO: \1', content, flags=re.MULTILINE)